@@ -3,5 +3,12 @@ from .compile import (
     find_all_word_string,
     find_word_string_r,
     find_all_word_string_r,
-    compile_regex
-)
\ No newline at end of file
+    finditer_word_string,
+    finditer_word_string_r,
+    compile_regex,
+    compile_cache_info,
+    compile_cache_clear,
+    set_compile_cache_size,
+    BudgetExhausted,
+    EngineWarning,
+)
@@ -0,0 +1,272 @@
+from dataclasses import dataclass, field
+from collections import OrderedDict
+import threading
+from syntax.code import Code, CodeType
+from runner import (
+    Runner,
+    MatchState,
+    match_word_shape,
+    match_word_set,
+    match_position,
+)
+from program import Program, FLAG_LONGEST
+from typing import List, Set, Callable, Optional
+
+# 把回溯虚拟机的指令序列生成为Python源码
+# 从每个入口出发，沿arg[0]把顺序执行的指令合并为一个块函数：
+# 叶指令内联为比较，Alt内联为回溯点，其它指令调用虚拟机的处理函数
+# 块函数返回下一个块的入口，执行循环只在块之间分派
+# 回溯栈的格式与虚拟机相同，失败时直接使用虚拟机的backtrack
+
+# 指令数超过上限时不生成源码，使用虚拟机执行
+CODEGEN_MAX_CODES = 5000
+
+# 源码 => 编译结果，相同的程序只编译一次
+CODEGEN_CACHE_SIZE = 256
+
+# 内联生成的指令，其余指令调用虚拟机的处理函数
+INLINE_TYPES = (
+    CodeType.Nop,
+    CodeType.Alt,
+    CodeType.SetMark,
+    CodeType.CaptureMark,
+    CodeType.Word,
+    CodeType.WordSet,
+    CodeType.DynamicWord,
+    CodeType.DynamicWordSet,
+    CodeType.Any,
+    CodeType.Position,
+)
+
+_code_cache: "OrderedDict[str, object]" = OrderedDict()
+_code_cache_lock = threading.Lock()
+
+
+def compile_source(source: str):
+    with _code_cache_lock:
+        code_obj = _code_cache.get(source)
+        if code_obj is not None:
+            _code_cache.move_to_end(source)
+            return code_obj
+    code_obj = compile(source, "<regex codegen>", "exec")
+    with _code_cache_lock:
+        _code_cache[source] = code_obj
+        while len(_code_cache) > CODEGEN_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    return code_obj
+
+
+# 块的入口：起始指令、回溯时进入的分支、调用处理函数的指令的后继、有多个前驱的指令
+# 内联的Alt首先进入第一个分支，第一个分支接在Alt之后生成
+def block_entries(codes: List[Code], inline: Set[int]) -> Set[int]:
+    entries = {0, len(codes) - 1}
+    indegree = [0] * len(codes)
+    for code in codes:
+        if not code.arg:
+            continue
+        if code.id not in inline:
+            entries.update(code.arg)
+        elif code.t == CodeType.Alt:
+            entries.update(code.arg[1:])
+        for a in code.arg:
+            indegree[a] += 1
+    for pc, n in enumerate(indegree):
+        if n > 1:
+            entries.add(pc)
+    return entries
+
+
+@dataclass
+class SourceWriter:
+    lines: List[str] = field(default_factory=list)
+
+    def emit(self, depth, line):
+        self.lines.append("    " * depth + line)
+
+    def source(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def gen_leaf(out: SourceWriter, code: Code, pc, prog: Program):
+    rtl = code.RightToLeft
+    t = code.t
+    if t == CodeType.Word or t == CodeType.WordSet:
+        if t == CodeType.Word:
+            out.emit(1, f"p = match_word_shape(S{pc}, enc.shapes, pos, end, {rtl})")
+        else:
+            longest = bool(prog.flags[pc] & FLAG_LONGEST)
+            out.emit(
+                1, f"p = match_word_set(S{pc}, enc.shapes, pos, end, {rtl}, {longest})"
+            )
+        out.emit(1, "if p < 0:")
+        out.emit(2, "return fail(st)")
+        out.emit(1, "pos = p")
+        return
+    if t == CodeType.Position:
+        out.emit(
+            1,
+            f"if not match_position({prog.param[pc]}, enc.lineBreaks, pos, end):",
+        )
+        out.emit(2, "return fail(st)")
+        return
+    # 以下指令消耗一个词
+    if rtl:
+        out.emit(1, "if pos <= 0:")
+        out.emit(2, "return fail(st)")
+        out.emit(1, "pos -= 1")
+    else:
+        out.emit(1, "if pos >= end:")
+        out.emit(2, "return fail(st)")
+    # 谓词取值在执行前已算出，只需查位
+    if t == CodeType.DynamicWord:
+        out.emit(1, f"if not st.predBits[{prog.param[pc]}][pos]:")
+        out.emit(2, "return fail(st)")
+    elif t == CodeType.DynamicWordSet:
+        out.emit(1, f"if not st.setBits[{prog.param[pc]}][pos]:")
+        out.emit(2, "return fail(st)")
+    if not rtl:
+        out.emit(1, "pos += 1")
+
+
+# 生成模块源码，每个入口一个块函数，BLOCKS为入口 => 块函数
+def gen_source(codes: List[Code], prog: Program, memoize=False) -> str:
+    inline = {
+        code.id
+        for code in codes
+        if code.t in INLINE_TYPES and not (memoize and code.t == CodeType.Alt)
+    }
+    entries = sorted(block_entries(codes, inline))
+    out = SourceWriter()
+    for entry in entries:
+        out.emit(0, f"def b{entry}(st):")
+        pc = entry
+        seen = set()
+        out.emit(1, "enc = st.sentence")
+        out.emit(1, "end = st.wordEnd")
+        out.emit(1, "pos = st.wordPos")
+        steps_line = len(out.lines)
+        out.emit(1, "")
+        count = 0
+        while True:
+            code = codes[pc]
+            count += 1
+            t = code.t
+            if t == CodeType.Stop:
+                out.emit(1, "st.wordPos = pos")
+                out.emit(1, f"return {pc}")
+                break
+            if pc not in inline:
+                out.emit(1, "st.wordPos = pos")
+                out.emit(1, f"ops[{pc}](st, {pc})")
+                out.emit(1, "return st.codePos")
+                break
+            if t == CodeType.Alt:
+                out.emit(1, f"st.trackStack += (pos, 0, {pc})")
+            elif t == CodeType.SetMark:
+                out.emit(1, "st.paramStack += (pos, -1, -1)")
+                out.emit(1, f"st.trackStack.append({pc})")
+            elif t == CodeType.CaptureMark:
+                cap_id = code.params["cap_id"]
+                out.emit(1, "ps = st.paramStack")
+                out.emit(1, "start = ps[-3]")
+                out.emit(1, "del ps[-3:]")
+                out.emit(1, f"prev = st.matches.get({cap_id})")
+                out.emit(1, "if prev is None:")
+                out.emit(2, f"st.trackStack += (-1, -1, start, {cap_id}, {pc})")
+                out.emit(1, "else:")
+                out.emit(2, f"st.trackStack += (prev[0], prev[1], start, {cap_id}, {pc})")
+                out.emit(1, f"st.matches[{cap_id}] = [start, pos]")
+            elif t != CodeType.Nop:
+                gen_leaf(out, code, pc, prog)
+            nxt = code.arg[0]
+            if nxt in entries or nxt in seen:
+                out.emit(1, "st.wordPos = pos")
+                out.emit(1, f"return {nxt}")
+                break
+            seen.add(pc)
+            pc = nxt
+        out.lines[steps_line] = "    " + (
+            f"st.steps += {count}\n"
+            "    if st.steps >= st.stepLimit:\n"
+            "        st.charge()"
+        )
+    out.emit(0, "BLOCKS = {" + ", ".join(f"{e}: b{e}" for e in entries) + "}")
+    return out.source()
+
+
+# 指令序列生成的块函数执行回溯匹配，结果与Runner相同
+@dataclass(repr=False)
+class CompiledRunner(Runner):
+    blocks: Optional[List[Callable[[MatchState], int]]] = field(
+        default=None, init=False, compare=False
+    )
+    source: str = field(default="", init=False, compare=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        if len(self.codes) <= CODEGEN_MAX_CODES:
+            self.blocks = self.build_blocks()
+
+    # 生成失败时返回None，由虚拟机执行
+    def build_blocks(self) -> Optional[List[Callable[[MatchState], int]]]:
+        try:
+            self.source = gen_source(self.codes, self.program, self.memoize)
+            code_obj = compile_source(self.source)
+        except (SyntaxError, RecursionError, MemoryError, ValueError) as e:
+            print(f"codegen error: {e}")
+            return None
+        backtrack = self.backtrack
+
+        def fail(st):
+            backtrack(st)
+            return st.codePos
+
+        namespace = {
+            "ops": self.ops,
+            "fail": fail,
+            "match_word_shape": match_word_shape,
+            "match_word_set": match_word_set,
+            "match_position": match_position,
+        }
+        prog = self.program
+        for code in self.codes:
+            if code.t == CodeType.Word:
+                namespace[f"S{code.id}"] = code.wordn.shape
+            elif code.t == CodeType.WordSet:
+                namespace[f"S{code.id}"] = prog.wordSets[prog.param[code.id]]
+        exec(code_obj, namespace)
+        blocks = [None] * len(self.codes)
+        for pc, block in namespace["BLOCKS"].items():
+            blocks[pc] = block
+        return blocks
+
+    def execute(self, st: MatchState, DEBUG=False, search=False) -> bool:
+        if DEBUG or self.blocks is None:
+            return super().execute(st, DEBUG, search)
+        if self.memoize:
+            st.memo_table(len(self.codes))
+        self.bind_sentence(st, search)
+        if not self.may_match(st.sentence):
+            return True
+        blocks = self.blocks
+        stop = len(self.codes) - 1  # 最后一条指令为Stop，回溯栈为空时codePos为-1，同样到达Stop
+        pc = 0
+        if search:
+            i = self.next_start(st, st.wordStart)
+            if i < 0:
+                return True
+            st.restart(i)
+        while True:
+            pc = blocks[pc](st)
+            if pc == stop:
+                # 0号Alt的第二个分支直接跳到Stop，此时没有整体捕获，表示当前起点匹配失败
+                if search and not st.matched():
+                    i = self.next_start(st, st.wordStart + 1)
+                    if i >= 0:
+                        st.restart(i)
+                        pc = 0
+                        continue
+                return True
+
+    def __repr__(self):
+        return "Compiled" + super().__repr__()
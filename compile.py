@@ -1,26 +1,238 @@
 ########   3个主要API
 from syntax.parser import regex_to_tree
+from syntax.tree import length_bounds, has_empty_loop
 from syntax.code import tree_to_code, dump_codes, CodeType
-from runner import Runner
-from typing import Optional, Tuple, List, Dict, Any, Text
+from syntax.peephole import optimize_codes
+from runner import Runner, memo_supported, BudgetExhausted
+from pikevm import PikeRunner, pike_supported
+from lazydfa import DFARunner
+from codegen import CompiledRunner
+from prefilter import feature_filter
+from typing import (
+    Optional,
+    Tuple,
+    List,
+    Dict,
+    Any,
+    Text,
+    NamedTuple,
+    Hashable,
+    Iterator,
+)
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+import warnings
 
 
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+# 进程级编译结果缓存，键为 正则文本 + regex_others宏定义，按LRU淘汰
+@dataclass
+class CompileCache:
+    maxsize: int = 512
+    hits: int = 0
+    misses: int = 0
+    entries: "OrderedDict[Hashable, Runner]" = field(default_factory=OrderedDict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self, key) -> Optional[Runner]:
+        with self.lock:
+            runner = self.entries.get(key)
+            if runner is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return runner
+
+    def put(self, key, runner: Runner):
+        with self.lock:
+            if self.maxsize <= 0:
+                return
+            self.entries[key] = runner
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def resize(self, maxsize: int):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.entries) > max(maxsize, 0):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+
+_compile_cache = CompileCache()
+
+
+def compile_cache_info() -> CacheInfo:
+    return _compile_cache.info()
+
+
+def compile_cache_clear():
+    _compile_cache.clear()
+
+
+# maxsize<=0 关闭缓存
+def set_compile_cache_size(maxsize: int):
+    _compile_cache.resize(maxsize)
+
+
+def _cache_key(
+    regex_raw, regex_others, engine, memoize, longest_wordset
+) -> Optional[Hashable]:
+    others = tuple(sorted(regex_others.items())) if regex_others else ()
+    key = (regex_raw, others, engine, memoize, longest_wordset)
+    try:
+        hash(key)
+    except TypeError:  # 宏定义不是字符串时不缓存
+        return None
+    return key
+
+
+# 执行引擎
+# backtrack: 回溯虚拟机，支持全部语法
+# pike: Pike VM，不支持反向引用，没有零宽断言时匹配时间与句子长度成线性关系
+# auto: 能在Pike VM上执行时使用pike，含反向引用或展开后过大的计数循环时发出EngineWarning并使用backtrack
+# dfa: 惰性DFA排除不可能匹配的起点，再用回溯虚拟机填充捕获
+# codegen: 把回溯虚拟机的指令生成为Python源码执行，生成失败时退回虚拟机
+ENGINES = ("backtrack", "pike", "auto", "dfa", "codegen")
+
+
+# 请求的引擎无法按原方式执行、改用其他方式时发出
+class EngineWarning(UserWarning):
+    pass
+
+
+# memoize: 回溯虚拟机记录失败的(指令,位置)，最坏情况下匹配时间为多项式
+#          只用于backtrack、dfa和codegen引擎；含反向引用、零宽断言或循环体可以不消耗词的正则不支持，此时发出EngineWarning后按原方式回溯，runner.memoize为False
+# longest_wordset: 词形集合取消耗词数最多的词形，默认取列表中最靠前的可匹配词形
 def compile_regex(
-    regex_raw, DEBUG=False, regex_others=None
+    regex_raw,
+    DEBUG=False,
+    regex_others=None,
+    use_cache=True,
+    engine="backtrack",
+    memoize=False,
+    longest_wordset=False,
+) -> Tuple[Optional[Runner], bool]:
+    if engine not in ENGINES:
+        print(f"unknown engine {engine}")
+        return None, False
+    if memoize and engine not in ("backtrack", "dfa", "codegen"):
+        print(f"memoize is not supported by engine {engine}")
+        return None, False
+    # DEBUG模式需要打印树和指令，不走缓存
+    key = None
+    if use_cache and not DEBUG:
+        key = _cache_key(regex_raw, regex_others, engine, memoize, longest_wordset)
+        if key is not None:
+            runner = _compile_cache.get(key)
+            if runner is not None:
+                return runner, True
+    runner, ok = _compile_regex(
+        regex_raw, DEBUG, regex_others, engine, memoize, longest_wordset
+    )
+    if ok and key is not None:
+        _compile_cache.put(key, runner)
+    return runner, ok
+
+
+# 提示位置为调用compile_regex处
+def engine_warning(message):
+    warnings.warn(message, EngineWarning, stacklevel=4)
+
+
+def _compile_regex(
+    regex_raw,
+    DEBUG=False,
+    regex_others=None,
+    engine="backtrack",
+    memoize=False,
+    longest_wordset=False,
 ) -> Tuple[Optional[Runner], bool]:
+    # regex_to_tree会把宏定义替换为语法树，复制一份以免修改调用方的字典
+    if regex_others is not None:
+        regex_others = dict(regex_others)
     t, ok = regex_to_tree(regex_raw, regex_others)
     if not ok:
         print("regex to tree error")
         return None, False
     if DEBUG:
         print(t.to_string())
-    codes, groupsInfo, ok = tree_to_code(t)
+    # 回溯虚拟机用计数循环指令执行{m,n}、用SetLoop执行单个词的循环，
+    # 其余引擎和记忆化回溯使用在树上展开、只有Alt循环的指令
+    # Pike VM用RepeatStart/RepeatCheck判断循环体可以不消耗词的*、+的空迭代
+    loop_ops = engine in ("backtrack", "codegen") and not memoize
+    codes, groupsInfo, ok = tree_to_code(t, loop_ops, engine in ("auto", "pike"))
+    use_pike = engine == "auto" and ok and pike_supported(codes)
+    if engine == "auto" and not use_pike:
+        engine_warning(
+            f"pike engine does not support back reference or large counted loop, using backtrack: {regex_raw}"
+        )
+    # 记忆化不可用时发出EngineWarning，之后与不记忆化相同，使用计数循环
+    # 循环体可以不消耗词时，空迭代回到同一(Alt,位置)会被当作失败，与不记忆化的结果不同
+    memo_ok = memoize and ok and memo_supported(codes) and not has_empty_loop(t)
+    if memoize and not memo_ok:
+        engine_warning(
+            f"memoize does not support back reference, lookaround, counted loop or loop that can match empty, disabled; engine='auto' handles these without back reference: {regex_raw}"
+        )
+    if not loop_ops and engine in ("auto", "backtrack", "codegen"):
+        # 展开后过大时改用计数循环，auto只在Pike VM可用时保留展开的指令
+        if not ok or (engine == "auto" and not use_pike) or (memoize and not memo_ok):
+            codes, groupsInfo, ok = tree_to_code(t)
     if not ok:
         print("tree to code error")
         return None, False
+    # 窥孔优化，连续的Any只在回溯虚拟机上合并为SetLoop
+    raw_count = len(codes)
+    codes = optimize_codes(
+        codes,
+        not memo_ok
+        and (engine in ("backtrack", "codegen") or (engine == "auto" and not use_pike)),
+    )
     if DEBUG:
-        print(dump_codes(codes))
-    return Runner(codes=codes, matchesInfo=groupsInfo), True
+        print(dump_codes(codes, raw_count))
+    options = {
+        "codes": codes,
+        "matchesInfo": groupsInfo,
+        "longestWordSet": longest_wordset,
+        "featureFilter": feature_filter(t),
+        "minLength": length_bounds(t)[0],
+    }
+    if engine == "codegen":
+        return CompiledRunner(memoize=memo_ok, **options), True
+    if engine == "dfa":
+        # DFA只能使用Alt循环的指令，记忆化之外回溯虚拟机仍使用计数循环和SetLoop，
+        # 循环体可以不消耗词的Alt循环在回溯虚拟机上不会结束
+        if memo_ok:
+            return DFARunner(memoize=memo_ok, **options), True
+        loop_codes, _, _ = tree_to_code(t)
+        options["codes"] = optimize_codes(loop_codes)
+        return DFARunner(dfaCodes=codes, **options), True
+    if use_pike:
+        return PikeRunner(**options), True
+    if engine == "pike":
+        if not pike_supported(codes):
+            print("pike engine does not support back reference")
+            return None, False
+        return PikeRunner(**options), True
+    return Runner(memoize=memo_ok, **options), True
 
 
 # 从第一个词对象开始进行一次匹配
@@ -44,32 +256,45 @@ def find_all_word_string(
     return find_all_word_string_r(r, words_lst, DEBUG)
 
 
+# max_steps/deadline为执行预算，用尽时抛出BudgetExhausted，与匹配失败区分
 def find_word_string_r(
-    runner, words_lst, DEBUG=False
+    runner, words_lst, DEBUG=False, max_steps=None, deadline=None
 ) -> Tuple[List[Dict[Text, Any]], bool]:
-    for i in range(len(words_lst)):
-        matches = runner.run(words_lst, i, DEBUG)
-        if matches is not None:
-            res = {}
-            for k, v in matches.items():
-                res[k] = words_lst[v[0] : v[1]]
-            return res, True
+    m = runner.search(words_lst, 0, DEBUG, max_steps=max_steps, deadline=deadline)
+    if m is not None:
+        return m.groupdict(), True
     print("fail match")
     return None, False
 
 
 def find_all_word_string_r(
-    runner, words_lst, DEBUG=False
+    runner, words_lst, DEBUG=False, max_steps=None, deadline=None
 ) -> Tuple[List[List[Dict[Text, Any]]], bool]:
-    all_res = []
-    for i in range(len(words_lst)):
-        matches = runner.run(words_lst, i, DEBUG)
-        if matches is not None:
-            res = {}
-            for k, v in matches.items():
-                res[k] = words_lst[v[0] : v[1]]
-            all_res.append(res)
+    # 保持原有语义：每个起点各取一个结果，结果之间可以重叠
+    all_res = list(
+        finditer_word_string_r(
+            runner, words_lst, DEBUG, True, max_steps=max_steps, deadline=deadline
+        )
+    )
     if len(all_res) == 0:
         print("fail match")
         return None, False
     return all_res, True
+
+
+# 逐个产出互不重叠的匹配结果，下一次从上个匹配的结尾继续
+def finditer_word_string(
+    regex_raw, words_lst, DEBUG=False, options_regex=None, overlapped=False
+) -> Iterator[Dict[Text, Any]]:
+    r, ok = compile_regex(regex_raw, DEBUG, options_regex)
+    if not ok:
+        print("compile error")
+        return
+    yield from finditer_word_string_r(r, words_lst, DEBUG, overlapped)
+
+
+def finditer_word_string_r(
+    runner, words_lst, DEBUG=False, overlapped=False, max_steps=None, deadline=None
+) -> Iterator[Dict[Text, Any]]:
+    for m in runner.finditer(words_lst, 0, overlapped, DEBUG, max_steps, deadline):
+        yield m.groupdict()
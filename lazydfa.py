@@ -0,0 +1,451 @@
+from dataclasses import dataclass, field
+import threading
+from syntax.code import Code, CodeType
+from runner import Runner, MatchState
+from program import Program, pack_codes
+from sentence import EncodedSentence
+from typing import List, Any, Dict, Tuple, FrozenSet, Set
+
+# 惰性DFA：按需把指令序列的NFA状态集合确定化，并缓存状态之间的转移
+# 词对象按叶指令谓词的取值划分为等价类，同一等价类的词转移相同
+# DFA只回答"是否可能匹配、匹配可能在哪里结束"，捕获仍由回溯虚拟机完成
+# 零宽断言和位置限定当作空转移，反向引用当作任意词序列，
+# 因此DFA接受的语言是回溯虚拟机的超集，判定为不匹配时一定不匹配
+
+# NFA状态：(指令位置, WordSet中的词形序号, 词形中已匹配的字符数)
+NState = Tuple[int, int, int]
+
+# 反向DFA中表示"此处可以作为匹配起点"的状态
+START: NState = (-1, 0, 0)
+
+# 缓存中状态数与转移数之和的上限，超出后清空缓存重新构建
+DFA_CACHE_SIZE = 50000
+
+# 会消耗词的叶指令
+LEAF_TYPES = (
+    CodeType.Word,
+    CodeType.WordSet,
+    CodeType.DynamicWord,
+    CodeType.DynamicWordSet,
+    CodeType.Any,
+    CodeType.Ref,
+)
+
+
+# 已确定化的状态及转移，超出上限时整体替换，正在使用旧缓存的匹配不受影响
+@dataclass
+class DFACache:
+    states: List[FrozenSet[NState]] = field(default_factory=list)
+    stateIds: Dict[FrozenSet[NState], int] = field(default_factory=dict)
+    accepting: List[bool] = field(default_factory=list)
+    endAccepting: List[bool] = field(default_factory=list)
+    trans: Dict[Tuple[int, Any, bool], int] = field(default_factory=dict)
+    dead: int = -1
+    start: int = -1
+    final: int = -1  # 反向DFA在句末的初始状态
+
+
+# 按需计算句子中每个词的等价类，只扫描部分句子时不必计算整句
+# 动态词谓词的取值读取DFA的程序在句子上一次算出的位
+class TokenClasses:
+    __slots__ = ("dfa", "shapes", "predBits", "setBits", "classes")
+
+    def __init__(self, dfa, enc: EncodedSentence):
+        self.dfa = dfa
+        self.shapes = enc.shapes
+        self.predBits, self.setBits = dfa.program.pred_bits(enc)
+        self.classes = {}
+
+    def __getitem__(self, pos):
+        cls = self.classes.get(pos)
+        if cls is None:
+            cls = self.classes[pos] = self.dfa.token_class(self, pos)
+        return cls
+
+
+@dataclass(repr=False)
+class LazyDFA:
+    codes: List[Code] = None
+    # codes打包后的程序，用于计算动态词谓词的取值，没有给出时自行打包
+    program: Program = None
+    cacheSize: int = DFA_CACHE_SIZE
+    # 动态词谓词：指令位置 => 谓词序号
+    predIndex: Dict[int, int] = field(default_factory=dict)
+    # 每个谓词序号的(是否为谓词集合, 程序旁表下标)
+    predCols: List[Tuple[bool, int]] = field(default_factory=list)
+    # 词形字面量的所有子串 => 编号，词形不在其中的词不可能参与Word/WordSet匹配
+    shapeIds: Dict[str, int] = field(default_factory=dict)
+    shapes: List[str] = field(default_factory=list)
+    startSet: FrozenSet[NState] = None
+    finalSet: FrozenSet[NState] = None
+    cache: DFACache = None
+    resetCount: int = 0
+    # 只在构建新状态时加锁，命中缓存的转移不加锁
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        if self.program is None:
+            self.program = pack_codes(self.codes)
+        for code in self.codes:
+            if code.t in (CodeType.DynamicWord, CodeType.DynamicWordSet):
+                self.predIndex[code.id] = len(self.predIndex)
+                self.predCols.append(
+                    (code.t == CodeType.DynamicWordSet, self.program.param[code.id])
+                )
+            elif code.t == CodeType.Word:
+                self.add_shape(code.wordn.shape)
+            elif code.t == CodeType.WordSet:
+                for wn in code.wordn.word_list:
+                    self.add_shape(wn.shape)
+        self.init_sets()
+        self.cache = self.new_cache()
+
+    # 0号Alt的第一个分支为匹配主体
+    def init_sets(self):
+        self.startSet = self.closure([self.codes[0].arg[0]])
+
+    def add_shape(self, shape):
+        for i in range(len(shape)):
+            for j in range(i + 1, len(shape) + 1):
+                s = shape[i:j]
+                if s not in self.shapeIds:
+                    self.shapeIds[s] = len(self.shapes)
+                    self.shapes.append(s)
+
+    def new_cache(self) -> DFACache:
+        cache = DFACache()
+        cache.dead = self.state_id(cache, frozenset())
+        cache.start = self.state_id(cache, self.startSet)
+        if self.finalSet is not None:
+            cache.final = self.state_id(cache, self.finalSet)
+        return cache
+
+    # 第pos个词的等价类：(满足的动态词谓词位图, 词形编号)
+    def token_class(self, classes: TokenClasses, pos):
+        bits = 0
+        for ind, (is_set, param) in enumerate(self.predCols):
+            row = classes.setBits[param] if is_set else classes.predBits[param]
+            if row[pos]:
+                bits |= 1 << ind
+        return bits, self.shapeIds.get(classes.shapes[pos], -1)
+
+    # 空转移闭包，只保留需要消耗词的状态和Stop
+    def closure(self, pcs) -> FrozenSet[NState]:
+        codes = self.codes
+        res = set()
+        seen = set()
+        stack = list(pcs)
+        while stack:
+            pc = stack.pop()
+            if pc in seen:
+                continue
+            seen.add(pc)
+            code = codes[pc]
+            t = code.t
+            if t == CodeType.Alt:
+                stack.extend(code.arg)
+            elif t == CodeType.SetJump:
+                # 忽略断言，直接进入断言之后的指令
+                stack.append(codes[code.params["fore_id"]].arg[0])
+            elif t == CodeType.BackJump:
+                continue
+            elif t == CodeType.WordSet:
+                for e in range(len(code.wordn.word_list)):
+                    res.add((pc, e, 0))
+            elif t in (
+                CodeType.Word,
+                CodeType.DynamicWord,
+                CodeType.DynamicWordSet,
+                CodeType.Any,
+                CodeType.Stop,
+            ):
+                res.add((pc, 0, 0))
+            elif t == CodeType.Ref:
+                # 反向引用看作任意长度的词序列
+                res.add((pc, 0, 0))
+                stack.append(code.arg[0])
+            else:  # Nop SetMark CaptureMark Position ForeJump
+                stack.append(code.arg[0])
+        return frozenset(res)
+
+    def is_accepting(self, s) -> bool:
+        return any(self.codes[pc].t == CodeType.Stop for pc, _, _ in s)
+
+    # 句末时Word指令可以只匹配词形的前缀(与回溯虚拟机一致)
+    def is_end_accepting(self, s) -> bool:
+        codes = self.codes
+        for pc, _, i in s:
+            if i > 0 and codes[pc].t == CodeType.Word:
+                nxt = self.closure([codes[pc].arg[0]])
+                if any(codes[p].t == CodeType.Stop for p, _, _ in nxt):
+                    return True
+        return False
+
+    def state_id(self, cache: DFACache, s: FrozenSet[NState]) -> int:
+        sid = cache.stateIds.get(s)
+        if sid is not None:
+            return sid
+        accepting = self.is_accepting(s)
+        sid = len(cache.states)
+        cache.states.append(s)
+        cache.accepting.append(accepting)
+        cache.endAccepting.append(accepting or self.is_end_accepting(s))
+        cache.stateIds[s] = sid
+        return sid
+
+    # 返回转移后的(缓存,状态)，缓存可能因超出上限被替换
+    def step(self, cache: DFACache, sid, cls, unanchored) -> Tuple[DFACache, int]:
+        nxt = cache.trans.get((sid, cls, unanchored))
+        if nxt is not None:
+            return cache, nxt
+        with self.lock:
+            if cache is not self.cache:  # 其它线程已替换缓存
+                sid = self.state_id(self.cache, cache.states[sid])
+                cache = self.cache
+            elif len(cache.states) + len(cache.trans) >= self.cacheSize:
+                # 超出内存上限，丢弃已构建的状态和转移
+                self.resetCount += 1
+                s = cache.states[sid]
+                cache = self.cache = self.new_cache()
+                sid = self.state_id(cache, s)
+            nxt = self.state_id(cache, self.next_set(cache.states[sid], cls, unanchored))
+            cache.trans[(sid, cls, unanchored)] = nxt
+        return cache, nxt
+
+    def next_set(self, s, cls, unanchored) -> FrozenSet[NState]:
+        codes = self.codes
+        bits, shape_id = cls
+        shape = self.shapes[shape_id] if shape_id >= 0 else ""
+        pcs = []
+        res = set()
+        for pc, e, i in s:
+            code = codes[pc]
+            t = code.t
+            if t == CodeType.Any:
+                pcs.append(code.arg[0])
+            elif t == CodeType.DynamicWord or t == CodeType.DynamicWordSet:
+                if bits >> self.predIndex[pc] & 1:
+                    pcs.append(code.arg[0])
+            elif t == CodeType.Word or t == CodeType.WordSet:
+                if shape == "":
+                    continue
+                if t == CodeType.Word:
+                    code_shape = code.wordn.shape
+                else:
+                    code_shape = code.wordn.word_list[e].shape
+                if not code_shape.startswith(shape, i):
+                    continue
+                ni = i + len(shape)
+                if ni == len(code_shape):
+                    pcs.append(code.arg[0])
+                else:
+                    res.add((pc, e, ni))
+            elif t == CodeType.Ref:
+                res.add((pc, 0, 0))
+                pcs.append(code.arg[0])
+        res |= self.closure(pcs)
+        if unanchored:
+            res |= self.startSet
+        return frozenset(res)
+
+    # 从start向后扫描一遍，同时回答是否可能匹配以及匹配最远可能在哪里结束
+    # 不可能匹配时返回-1，否则返回扫描的右边界：
+    # 第一个使DFA进入死状态的词之后的位置，没有这样的词时为end
+    # 右边界保留了使DFA死亡的那个词，回溯虚拟机在边界内的行为与整句相同
+    # 找到最早的可接受位置后，最多再扫描同样长的距离，仍未死亡时不缩小边界，
+    # 使扫描的代价不超过回溯虚拟机找到第一个匹配所需工作量的两倍
+    # 每次转移计入st的执行步数，受执行预算限制
+    def match_limit(self, st: MatchState, classes, start, end) -> int:
+        cache = self.cache
+        sid = cache.start
+        pos = start
+        stop = -1  # 放弃缩小边界的位置
+        while pos < end:
+            if stop < 0 and cache.accepting[sid]:
+                stop = pos + max(pos - start, 1)
+            elif pos == stop:
+                return end
+            st.steps += 1
+            if st.steps >= st.stepLimit:
+                st.charge()
+            cache, sid = self.step(cache, sid, classes[pos], False)
+            pos += 1
+            if sid == cache.dead:
+                return pos if stop >= 0 else -1
+        return end if stop >= 0 or cache.endAccepting[sid] else -1
+
+
+# 反向DFA：从句末向前扫描一遍，找出所有可能的匹配起点
+# 状态中的(pc,e,j)表示左侧的词还需要由叶指令pc匹配，j为词形末尾已匹配的字符数
+@dataclass(repr=False)
+class ReverseDFA(LazyDFA):
+    # 叶指令 => 可以紧接在它之前的叶指令状态
+    pred: Dict[int, Set[NState]] = field(default_factory=dict)
+    # 匹配主体开头可以出现的叶指令
+    entryLeaves: Set[int] = field(default_factory=set)
+
+    def init_sets(self):
+        codes = self.codes
+        entry = self.closure([codes[0].arg[0]])
+        self.entryLeaves = {pc for pc, _, _ in entry}
+        end_set = set()
+        final_set = set()
+        if any(codes[pc].t == CodeType.Stop for pc in self.entryLeaves):
+            end_set.add(START)  # 可以匹配空序列
+        for code in codes:
+            if code.t not in LEAF_TYPES:
+                continue
+            entries = self.entries(code.id)
+            succ = self.closure([code.arg[0]])
+            for pc, _, _ in succ:
+                self.pred.setdefault(pc, set()).update(entries)
+            if any(codes[pc].t == CodeType.Stop for pc, _, _ in succ):
+                end_set.update(entries)
+                if code.t == CodeType.Word:
+                    # 句末的Word可以只匹配词形的前缀
+                    for j in range(1, len(code.wordn.shape)):
+                        final_set.add((code.id, 0, j))
+        self.startSet = frozenset(end_set)
+        self.finalSet = frozenset(end_set | final_set)
+
+    def entries(self, pc) -> List[NState]:
+        code = self.codes[pc]
+        if code.t == CodeType.WordSet:
+            return [(pc, e, 0) for e in range(len(code.wordn.word_list))]
+        return [(pc, 0, 0)]
+
+    def is_accepting(self, s) -> bool:
+        return START in s
+
+    def is_end_accepting(self, s) -> bool:
+        return False
+
+    def next_set(self, s, cls, unanchored) -> FrozenSet[NState]:
+        codes = self.codes
+        bits, shape_id = cls
+        shape = self.shapes[shape_id] if shape_id >= 0 else ""
+        done = []  # 匹配完成的叶指令
+        res = set()
+        for pc, e, j in s:
+            if pc < 0:
+                continue
+            code = codes[pc]
+            t = code.t
+            if t == CodeType.Any:
+                done.append(pc)
+            elif t == CodeType.DynamicWord or t == CodeType.DynamicWordSet:
+                if bits >> self.predIndex[pc] & 1:
+                    done.append(pc)
+            elif t == CodeType.Word or t == CodeType.WordSet:
+                if shape == "":
+                    continue
+                if t == CodeType.Word:
+                    code_shape = code.wordn.shape
+                else:
+                    code_shape = code.wordn.word_list[e].shape
+                if not code_shape.endswith(shape, 0, len(code_shape) - j):
+                    continue
+                nj = j + len(shape)
+                if nj == len(code_shape):
+                    done.append(pc)
+                else:
+                    res.add((pc, e, nj))
+            elif t == CodeType.Ref:
+                res.add((pc, 0, 0))
+                done.append(pc)
+        for pc in done:
+            res |= self.pred.get(pc, set())
+            if pc in self.entryLeaves:
+                res.add(START)
+        if unanchored:
+            res |= self.startSet
+        return frozenset(res)
+
+    # [start,end)中每个位置是否可能作为匹配起点
+    def viable_starts(self, st: MatchState, classes, start, end) -> bytearray:
+        viable = bytearray(end)
+        cache = self.cache
+        sid = cache.final
+        pos = end
+        while pos > start:
+            pos -= 1
+            st.steps += 1
+            if st.steps >= st.stepLimit:
+                st.charge()
+            cache, sid = self.step(cache, sid, classes[pos], True)
+            if cache.accepting[sid]:
+                viable[pos] = 1
+        return viable
+
+
+# 零宽断言会读取匹配区间之外的词，此时不能缩小回溯虚拟机的扫描范围
+def dfa_narrowable(codes: List[Code]) -> bool:
+    for code in codes:
+        if code.t == CodeType.SetJump and not code.params["RightToLeft"]:
+            return False
+    return True
+
+
+# 先用反向DFA一次扫描找出可能的起点，再用正向DFA确定每个起点的扫描右边界，
+# 只在可能匹配的起点和区间上运行回溯虚拟机填充捕获
+@dataclass(repr=False)
+class DFARunner(Runner):
+    # DFA使用的只有Alt循环的指令，没有给出时与回溯虚拟机的指令相同
+    dfaCodes: List[Code] = field(default=None, compare=False)
+    dfa: LazyDFA = field(init=False, compare=False)
+    reverseDfa: ReverseDFA = field(init=False, compare=False)
+    narrowable: bool = field(init=False, compare=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        codes, program = self.dfaCodes, None
+        if codes is None:
+            codes, program = self.codes, self.program
+        self.dfa = LazyDFA(codes=codes, program=program)
+        self.reverseDfa = ReverseDFA(codes=codes, program=self.dfa.program)
+        self.narrowable = dfa_narrowable(codes)
+
+    # 在[wordStart,limit)内执行回溯虚拟机
+    def execute_in(self, st: MatchState, limit, DEBUG=False) -> bool:
+        end = st.wordEnd
+        if self.narrowable:
+            st.wordEnd = limit
+        try:
+            return super().execute(st, DEBUG) and st.matched()
+        finally:
+            st.wordEnd = end
+
+    def execute(self, st: MatchState, DEBUG=False, search=False) -> bool:
+        if not self.may_match(st.encode()):
+            return False
+        dfa = self.dfa
+        end = st.wordEnd
+        # 两个DFA的等价类划分相同，共用一份
+        classes = st.inputCache.get("tokenClasses")
+        if classes is None:
+            classes = st.inputCache["tokenClasses"] = TokenClasses(dfa, st.encode())
+        if not search:
+            limit = dfa.match_limit(st, classes, st.wordStart, end)
+            if limit < 0:
+                return False
+            return self.execute_in(st, limit, DEBUG)
+        # 可能的起点只与起点之后的词有关，finditer多次搜索时复用
+        lo, viable = st.inputCache.get("viableStarts", (end, None))
+        if viable is None or st.wordStart < lo:
+            lo = st.wordStart
+            viable = self.reverseDfa.viable_starts(st, classes, lo, end)
+            st.inputCache["viableStarts"] = (lo, viable)
+        for i in range(st.wordStart, end):
+            if not viable[i]:
+                continue
+            limit = dfa.match_limit(st, classes, i, end)
+            if limit < 0:
+                continue
+            st.restart(i)
+            if self.execute_in(st, limit, DEBUG):
+                return True
+        st.matches.clear()
+        return False
+
+    def __repr__(self):
+        return "DFA" + super().__repr__()
@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+from collections.abc import Sequence
+from typing import List, Any, Text, Dict, Tuple, Union, Optional
+
+GroupKey = Union[int, Text]
+
+
+# 输入序列某个区间的只读视图，不复制词对象
+class SpanView(Sequence):
+    __slots__ = ("inputLst", "start", "end")
+
+    def __init__(self, input_lst, start, end):
+        self.inputLst = input_lst
+        self.start = start
+        self.end = max(start, end)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.inputLst[j] for j in range(self.start, self.end)[i]]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("SpanView index out of range")
+        return self.inputLst[self.start + i]
+
+    def __iter__(self):
+        for j in range(self.start, self.end):
+            yield self.inputLst[j]
+
+    def to_list(self) -> List[Any]:
+        return self.inputLst[self.start : self.end]
+
+    def __repr__(self):
+        return f"SpanView({self.start},{self.end})"
+
+
+# 一次匹配的结果，只保存各分组的区间，访问分组内容时才切片
+@dataclass(repr=False)
+class Match:
+    inputLst: Sequence = None
+    pos: int = -1  # 本次匹配尝试的起点
+    spans: Dict[int, Tuple[int, int]] = None  # cap_id => (start,end)
+    groupsInfo: Dict[int, Text] = None  # cap_id => name
+    groupIndex: Dict[Text, int] = None  # name => cap_id
+
+    def _index(self, g: GroupKey) -> int:
+        if isinstance(g, int):
+            if g not in self.groupsInfo:
+                raise IndexError(f"no such group: {g}")
+            return g
+        ind = self.groupIndex.get(g)
+        if ind is None:
+            raise IndexError(f"no such group: {g}")
+        return ind
+
+    # 未参与匹配的分组返回(-1,-1)
+    def span(self, g: GroupKey = 0) -> Tuple[int, int]:
+        return self.spans.get(self._index(g), (-1, -1))
+
+    def start(self, g: GroupKey = 0) -> int:
+        return self.span(g)[0]
+
+    def end(self, g: GroupKey = 0) -> int:
+        return self.span(g)[1]
+
+    # 分组对应的词对象列表，未参与匹配时为None
+    def group(self, g: GroupKey = 0) -> Optional[List[Any]]:
+        span = self.spans.get(self._index(g))
+        if span is None:
+            return None
+        return self.inputLst[span[0] : span[1]]
+
+    # 分组对应的零拷贝视图
+    def view(self, g: GroupKey = 0) -> Optional[SpanView]:
+        span = self.spans.get(self._index(g))
+        if span is None:
+            return None
+        return SpanView(self.inputLst, span[0], span[1])
+
+    def __getitem__(self, g: GroupKey):
+        return self.group(g)
+
+    # name => 词对象列表，与find_word_string_r的返回格式一致
+    def groupdict(self) -> Dict[Text, List[Any]]:
+        res = {}
+        for ind, group_name in self.groupsInfo.items():
+            span = self.spans.get(ind)
+            if span is not None:
+                res[group_name] = self.inputLst[span[0] : span[1]]
+        return res
+
+    # name => [start,end]，与Runner.run的返回格式一致
+    def spandict(self) -> Dict[Text, List[int]]:
+        res = {}
+        for ind, group_name in self.groupsInfo.items():
+            span = self.spans.get(ind)
+            if span is not None:
+                res[group_name] = [span[0], span[1]]
+        return res
+
+    def __repr__(self):
+        return f"Match(pos={self.pos},spans={self.spandict()})"
@@ -0,0 +1,261 @@
+from dataclasses import dataclass, field
+from syntax.code import Code, CodeType
+from syntax.tree import UNBOUNDED
+from runner import (
+    Runner,
+    MatchState,
+    is_dynamic_word_match,
+    match_word_shape,
+    match_word_set,
+    match_position,
+)
+from program import FLAG_LONGEST
+from typing import List, Tuple, Optional
+
+# Pike VM：把指令序列当作Thompson NFA，所有线程按优先级同步推进
+# 每个(指令,位置)最多出现一个线程，没有零宽断言时匹配时间与句子长度成线性关系
+# 循环体可以不消耗词的循环按在当前位置进入过的循环区分空转移的状态，状态数只与正则有关
+# 零宽断言在每个位置各执行一次子模拟，子模拟可能扫描到句末，最坏为平方时间
+# 反向引用依赖已捕获的内容，无法用该方法执行
+
+# 线程的捕获槽：0号为本次匹配的起点，之后每个分组占3个槽(SetMark位置,起点,终点)
+ORIGIN_SLOT = 0
+
+
+# 计数循环的迭代次数不在线程状态中，{m,n}需在树上展开后再生成指令
+# 循环体可以不消耗词的*、+生成RepeatStart/RepeatCheck，只需判断空迭代，不需要计数
+def pike_supported(codes: List[Code]) -> bool:
+    for code in codes:
+        if code.t in (CodeType.Ref, CodeType.GetJump):
+            return False
+        if code.t == CodeType.RepeatCheck and not (
+            code.params["min"] <= 1 and code.params["max"] == UNBOUNDED
+        ):
+            return False
+    return True
+
+
+@dataclass(repr=False)
+class PikeRunner(Runner):
+    capCount: int = field(init=False, compare=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+        cap_count = 0
+        for code in self.codes:
+            if code.t == CodeType.SetMark or code.t == CodeType.CaptureMark:
+                cap_count = max(cap_count, code.params["cap_id"] + 1)
+        self.capCount = cap_count
+
+    def empty_caps(self) -> Tuple[int, ...]:
+        return (-1,) * (1 + 3 * self.capCount)
+
+    # 叶指令匹配成功时返回消耗的词数，失败返回-1
+    def consume(self, pc, st: MatchState, pos, end, DEBUG=False) -> int:
+        sentence = st.sentence
+        code = self.codes[pc]
+        prog = self.program
+        rtl = code.RightToLeft
+        if code.t == CodeType.Word:
+            p = match_word_shape(code.wordn.shape, sentence.shapes, pos, end, rtl)
+        elif code.t == CodeType.WordSet:
+            p = match_word_set(
+                prog.wordSets[prog.param[pc]],
+                sentence.shapes,
+                pos,
+                end,
+                rtl,
+                prog.flags[pc] & FLAG_LONGEST,
+            )
+        else:
+            if rtl:
+                if pos <= 0:
+                    return -1
+                i = pos - 1
+            else:
+                if pos >= end:
+                    return -1
+                i = pos
+            if code.t == CodeType.DynamicWord:
+                if not st.predBits[prog.param[pc]][i]:
+                    if DEBUG:
+                        is_dynamic_word_match(code.wordn, sentence[i], True)
+                    return -1
+            elif code.t == CodeType.DynamicWordSet:
+                if not st.setBits[prog.param[pc]][i]:
+                    return -1
+            elif code.t != CodeType.Any:
+                return -1
+            return 1
+        if p < 0:
+            return -1
+        return p - pos if not rtl else pos - p
+
+    # 从pc出发沿空转移展开线程，按优先级顺序加入lst
+    # loops为当前路径上在pos处进入循环体的RepeatCheck，路径再次到达它时这次迭代没有消耗词，
+    # 与回溯虚拟机相同，接受这次空迭代后只能退出循环
+    def add_thread(self, ctx, lst, seen, pc, caps, pos):
+        codes = self.codes
+        stack = [(pc, caps, ())]
+        while stack:
+            pc, caps, loops = stack.pop()
+            code = codes[pc]
+            t = code.t
+            if t == CodeType.RepeatCheck and pc in loops:
+                stack.append((code.arg[1], caps, loops))
+                continue
+            # 同一指令在不同循环状态下之后的转移不同，分开去重
+            if (pc, loops) in seen:
+                continue
+            seen.add((pc, loops))
+            if t == CodeType.Nop:
+                stack.append((code.arg[0], caps, loops))
+            elif t == CodeType.Alt:
+                for nxt in reversed(code.arg):
+                    stack.append((nxt, caps, loops))
+            elif t == CodeType.SetMark:
+                slot = 1 + 3 * code.params["cap_id"]
+                caps = caps[:slot] + (pos,) + caps[slot + 1 :]
+                stack.append((code.arg[0], caps, loops))
+            elif t == CodeType.CaptureMark:
+                slot = 1 + 3 * code.params["cap_id"]
+                caps = caps[: slot + 1] + (caps[slot], pos) + caps[slot + 3 :]
+                stack.append((code.arg[0], caps, loops))
+            elif t == CodeType.RepeatStart:
+                # 首次进入循环时+只能进入循环体
+                check = codes[code.arg[0]]
+                self.push_loop(stack, check, caps, loops, check.params["min"] == 0)
+            elif t == CodeType.RepeatCheck:
+                self.push_loop(stack, code, caps, loops, True)
+            elif t == CodeType.SetJump:
+                sub_caps = self.assert_at(ctx, pc, pos)
+                if code.params["is_positive"]:
+                    if sub_caps is None:
+                        continue
+                    # 0号槽是外层匹配的起点，不覆盖
+                    caps = caps[:1] + tuple(
+                        c if s == -1 else s for c, s in zip(caps[1:], sub_caps[1:])
+                    )
+                elif sub_caps is not None:
+                    continue
+                fore = codes[code.params["fore_id"]]
+                stack.append((fore.arg[0], caps, loops))
+            elif t == CodeType.Position:
+                sentence, end = ctx["sentence"], ctx["end"]
+                if match_position(
+                    code.params.get("position_type"), sentence.lineBreaks, pos, end
+                ):
+                    stack.append((code.arg[0], caps, loops))
+            elif (pc, 0) not in seen:  # 叶指令、Stop以及断言子程序的终点ForeJump/BackJump
+                seen.add((pc, 0))
+                lst.append((pc, 0, caps))
+
+    # 循环体和出口按贪婪或非贪婪的顺序入栈，进入循环体的路径记下该RepeatCheck
+    def push_loop(self, stack, check: Code, caps, loops, can_exit):
+        body, exit_pc = check.arg
+        branches = [(body, caps, loops + (check.id,))]
+        if can_exit:
+            if check.params["is_nongreedy"]:
+                branches.insert(0, (exit_pc, caps, loops))
+            else:
+                branches.append((exit_pc, caps, loops))
+        stack.extend(reversed(branches))
+
+    # 在pos处执行零宽断言的子程序，成立时返回子程序内设置的捕获槽
+    def assert_at(self, ctx, setjump_pc, pos) -> Optional[Tuple[int, ...]]:
+        key = (setjump_pc, pos)
+        memo = ctx["memo"]
+        if key in memo:
+            return memo[key]
+        # 断言体执行期间再次进入同一断言时按不成立处理，避免无限递归
+        memo[key] = None
+        params = self.codes[setjump_pc].params
+        accept = params["fore_id"] if params["is_positive"] else params["back_id"]
+        matched = self.simulate(
+            ctx, params["test_id"], accept, pos, pos, True, params["RightToLeft"]
+        )
+        memo[key] = None if matched is None else matched[1]
+        return memo[key]
+
+    # 同步推进所有线程，返回最高优先级线程到达accept时的(位置,捕获槽)
+    def simulate(
+        self, ctx, entry, accept, start, stop, anchored, RightToLeft=False, DEBUG=False
+    ):
+        codes = self.codes
+        end = ctx["end"]
+        step = -1 if RightToLeft else 1
+        matched = None
+        st = ctx["state"]
+        clist, cseen = [], set()
+        pos = start
+        while 0 <= pos <= end:
+            st.steps += len(clist) + 1
+            if st.steps >= st.stepLimit:
+                st.charge()
+            # 新起点的优先级最低，排在已有线程之后
+            if matched is None and (pos == start or (not anchored and pos < stop)):
+                caps = (pos,) + self.empty_caps()[1:]
+                self.add_thread(ctx, clist, cseen, entry, caps, pos)
+            if not clist:
+                if matched is not None or anchored or pos + step >= stop:
+                    break
+                # 当前起点没有线程存活，直接尝试下一个起点
+                clist, cseen = [], set()
+                pos += step
+                continue
+            if DEBUG:
+                print(f"wordpos:{pos} threads(codepos,wait):{[t[:2] for t in clist]}")
+            nlist, nseen = [], set()
+            for pc, wait, caps in clist:
+                if wait > 0:
+                    if wait == 1:
+                        self.add_thread(ctx, nlist, nseen, pc, caps, pos + step)
+                    elif (pc, wait - 1) not in nseen:
+                        nseen.add((pc, wait - 1))
+                        nlist.append((pc, wait - 1, caps))
+                    continue
+                if pc == accept:
+                    matched = (pos, caps)
+                    break  # 丢弃优先级更低的线程
+                code = codes[pc]
+                if code.t in (CodeType.Stop, CodeType.ForeJump, CodeType.BackJump):
+                    continue
+                k = self.consume(pc, st, pos, end, DEBUG)
+                if k < 1:
+                    continue
+                nxt = code.arg[0]
+                if k == 1:
+                    self.add_thread(ctx, nlist, nseen, nxt, caps, pos + step)
+                elif (nxt, k - 1) not in nseen:
+                    # Word指令跨多个词时，线程在后续位置等待k-1步
+                    nseen.add((nxt, k - 1))
+                    nlist.append((nxt, k - 1, caps))
+            clist, cseen = nlist, nseen
+            pos += step
+        return matched
+
+    def execute(self, st: MatchState, DEBUG=False, search=False) -> bool:
+        # memo缓存断言结果 (SetJump id,位置) => 断言内的捕获槽，None表示不成立
+        self.bind_sentence(st)
+        if not self.may_match(st.sentence):
+            return False
+        ctx = {"sentence": st.sentence, "end": st.wordEnd, "memo": {}, "state": st}
+        stop = len(self.codes) - 1  # 最后一条指令为Stop
+        # 0号Alt的第一个分支为匹配主体，第二个分支直接到Stop表示失败
+        entry = self.codes[0].arg[0]
+        matched = self.simulate(
+            ctx, entry, stop, st.wordStart, st.wordEnd, not search, DEBUG=DEBUG
+        )
+        st.matches.clear()
+        if matched is None:
+            return False
+        _, caps = matched
+        st.wordStart = caps[ORIGIN_SLOT]
+        for cap_id in range(self.capCount):
+            slot = 1 + 3 * cap_id
+            if caps[slot + 1] != -1:
+                st.matches[cap_id] = [caps[slot + 1], caps[slot + 2]]
+        return True
+
+    def __repr__(self):
+        return "Pike" + super().__repr__()
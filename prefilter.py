@@ -0,0 +1,368 @@
+from dataclasses import dataclass, field
+from collections import deque
+from syntax.code import Code, CodeType
+from syntax.tree import (
+    Node,
+    ConcatenateNode,
+    AlternateNode,
+    CaptureNode,
+    RepeatNode,
+    ConditionNode,
+    WordNode,
+    WordSetNode,
+    DynamicWordNode,
+    DynamicWordSetNode,
+    length_bounds,
+)
+from sentence import EncodedSentence, union_bits
+from typing import List, Dict, Optional, Iterator, Tuple, FrozenSet
+
+# 执行回溯虚拟机之前的静态分析和预筛选，只排除不可能匹配的起点，结果是可能起点的超集
+
+# 不消耗词的指令，分析匹配开头时直接越过
+EMPTY_TYPES = (CodeType.Nop, CodeType.SetMark, CodeType.CaptureMark, CodeType.Position)
+
+# 消耗一个或多个词的叶指令
+LEAF_TYPES = (
+    CodeType.Word,
+    CodeType.WordSet,
+    CodeType.DynamicWord,
+    CodeType.DynamicWordSet,
+    CodeType.Any,
+)
+
+
+# 从entry出发、消耗第一个词的指令，匹配可能为空时返回None
+# SetLoop消耗的第一个词由它的叶指令判断，最少次数为0时还要越过它
+# 零宽断言不消耗词，越过断言继续，得到的集合只会更大
+def first_codes(codes: List[Code], entry) -> Optional[List[Code]]:
+    res = []
+    seen = set()
+    stack = [entry]
+    while stack:
+        pc = stack.pop()
+        if pc in seen:
+            continue
+        seen.add(pc)
+        code = codes[pc]
+        t = code.t
+        if t == CodeType.Alt or t == CodeType.RepeatCheck:
+            stack.extend(code.arg)
+        elif t in EMPTY_TYPES or t == CodeType.RepeatStart:
+            stack.append(code.arg[0])
+        elif t == CodeType.SetJump:
+            stack.append(codes[code.params["fore_id"]].arg[0])
+        elif t in LEAF_TYPES or t == CodeType.SetLoop:
+            if code.RightToLeft:
+                return None
+            res.append(code)
+            if t == CodeType.SetLoop and code.params["min"] == 0:
+                stack.append(code.arg[0])
+        else:  # Stop表示可以匹配空串；反向引用的分组可能为空
+            return None
+    return res
+
+
+# 匹配开头必须出现的词形字面量，开头不全是Word/WordSet时返回None
+def leading_literals(codes: List[Code]) -> Optional[List[str]]:
+    # 0号Alt的第一个分支为匹配主体
+    first = first_codes(codes, codes[0].arg[0])
+    if not first:
+        return None
+    literals = []
+    for code in first:
+        if code.t == CodeType.Word:
+            literals.append(code.wordn.shape)
+        elif code.t == CodeType.WordSet:
+            literals.extend(wn.shape for wn in code.wordn.word_list)
+        else:
+            return None
+    if "" in literals:
+        return None
+    return sorted(set(literals))
+
+
+# 多模式字符串匹配自动机，状态为字面量前缀构成的trie节点
+@dataclass
+class AhoCorasick:
+    patterns: List[str]
+    goto: List[Dict[str, int]] = field(default_factory=lambda: [{}])
+    fail: List[int] = field(default_factory=lambda: [0])
+    depth: List[int] = field(default_factory=lambda: [0])
+    # 在该状态结束的字面量序号，包含失败链上的
+    out: List[List[int]] = field(default_factory=lambda: [[]])
+
+    def __post_init__(self):
+        for ind, pattern in enumerate(self.patterns):
+            s = 0
+            for ch in pattern:
+                nxt = self.goto[s].get(ch)
+                if nxt is None:
+                    nxt = self.goto[s][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[s] + 1)
+                    self.out.append([])
+                s = nxt
+            self.out[s].append(ind)
+        queue = deque(self.goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, nxt in self.goto[s].items():
+                queue.append(nxt)
+                f = self.fail[s]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def step(self, s, ch) -> int:
+        goto, fail = self.goto, self.fail
+        while True:
+            nxt = goto[s].get(ch)
+            if nxt is not None:
+                return nxt
+            if s == 0:
+                return 0
+            s = fail[s]
+
+    # 产出(起始字符位置, 字面量序号)
+    # 文本末尾是某个字面量的前缀时产出(起始字符位置, -1)
+    def scan(self, text) -> Iterator[Tuple[int, int]]:
+        s = 0
+        for k, ch in enumerate(text):
+            s = self.step(s, ch)
+            for ind in self.out[s]:
+                yield k + 1 - len(self.patterns[ind]), ind
+        while s:
+            yield len(text) - self.depth[s], -1
+            s = self.fail[s]
+
+
+# 用程序开头的字面量在整句词形上扫描一遍，得到可能的起点
+@dataclass
+class LiteralScanner:
+    literals: List[str]
+    automaton: AhoCorasick = field(init=False)
+
+    def __post_init__(self):
+        self.automaton = AhoCorasick(self.literals)
+
+    # 每个位置一个0/1，字面量必须从词的边界开始
+    # Word在句末可以只匹配词形的前缀，句末的部分匹配同样作为起点
+    def starts(self, enc: EncodedSentence) -> bytearray:
+        res = bytearray(len(enc))
+        boundary = {}  # 字符位置 => 从该处开始的非空词
+        offset = 0
+        for i, shape in enumerate(enc.shapes):
+            if shape != "":
+                boundary[offset] = i
+                offset += len(shape)
+        for start, _ in self.automaton.scan("".join(enc.shapes)):
+            i = boundary.get(start)
+            if i is not None:
+                res[i] = 1
+        return res
+
+
+def literal_scanner(codes: List[Code]) -> Optional[LiteralScanner]:
+    literals = leading_literals(codes)
+    if literals is None:
+        return None
+    return LiteralScanner(literals)
+
+
+# 程序的FIRST集：能消耗匹配第一个词的叶指令
+# 起点的词必须是某个Word/WordSet词形的非空前缀，或满足某个动态词谓词
+@dataclass
+class FirstSet:
+    prefixes: FrozenSet[str]  # 词形字面量的所有非空前缀
+    predIds: List[int]  # Program.preds的下标
+    setIds: List[int]  # Program.predSets的下标
+
+    # 每个位置一个0/1，pred_bits/set_bits为Program.pred_bits的结果
+    def starts(
+        self, enc: EncodedSentence, pred_bits: List[bytearray], set_bits: List[bytearray]
+    ) -> bytearray:
+        rows = [pred_bits[k] for k in self.predIds]
+        rows.extend(set_bits[k] for k in self.setIds)
+        if self.prefixes:
+            prefixes = self.prefixes
+            rows.append(bytearray(shape in prefixes for shape in enc.shapes))
+        return union_bits(rows, len(enc))
+
+
+# 匹配可能为空或以Any开头时返回None，entry默认为匹配主体的入口
+def first_set(codes: List[Code], prog, entry=None) -> Optional[FirstSet]:
+    if entry is None:
+        entry = codes[0].arg[0]
+    first = first_codes(codes, entry)
+    if not first:
+        return None
+    prefixes, pred_ids, set_ids = set(), [], []
+    for code in first:
+        t = code.t
+        if t == CodeType.Word or t == CodeType.WordSet:
+            if t == CodeType.Word:
+                shapes = [code.wordn.shape]
+            else:
+                shapes = [wn.shape for wn in code.wordn.word_list]
+            for shape in shapes:
+                if shape == "":
+                    return None
+                prefixes.update(shape[:k] for k in range(1, len(shape) + 1))
+        elif t == CodeType.DynamicWord:
+            pred_ids.append(prog.param[code.id])
+        elif t == CodeType.DynamicWordSet:
+            set_ids.append(prog.param[code.id])
+        elif t == CodeType.SetLoop:
+            _, _, leaf_type, leaf_param = prog.runs[prog.param[code.id]]
+            if leaf_type == CodeType.DynamicWord:
+                pred_ids.append(leaf_param)
+            elif leaf_type == CodeType.DynamicWordSet:
+                set_ids.append(leaf_param)
+            else:
+                return None
+        else:
+            return None
+    return FirstSet(
+        prefixes=frozenset(prefixes),
+        predIds=sorted(set(pred_ids)),
+        setIds=sorted(set(set_ids)),
+    )
+
+
+# SetLoop之后的指令能消耗的第一个词，循环只能在满足它的位置结束
+# 返回 SetLoop的指令位置 => FirstSet，从右向左的循环不使用
+def loop_guides(codes: List[Code], prog) -> Dict[int, FirstSet]:
+    res = {}
+    for code in codes:
+        if code.t == CodeType.SetLoop and not code.RightToLeft:
+            fs = first_set(codes, prog, code.arg[0])
+            if fs is not None:
+                res[code.id] = fs
+    return res
+
+
+# 必要条件的合取范式：每个子句是若干原子的析取，句子必须满足所有子句
+# 原子 ("shape", 词形)：整句词形拼接后包含该词形，或以它的前缀结尾(Word在句末可部分匹配)
+# 原子 ("pos", 词性)：某个词的词性包含该字符串
+# 子句数和子句长度有上限，超出时丢弃子句，条件只会变弱
+CNF_MAX_CLAUSES = 32
+CNF_MAX_ATOMS = 16
+
+Atom = Tuple[str, str]
+Clause = FrozenSet[Atom]
+
+
+def cnf_and(a: List[Clause], b: List[Clause]) -> List[Clause]:
+    res = list(dict.fromkeys(a + b))
+    # 短子句排除的句子更多，优先保留
+    res.sort(key=len)
+    return res[:CNF_MAX_CLAUSES]
+
+
+# (a1∧a2)∨(b1∧b2) = (a1∨b1)∧(a1∨b2)∧(a2∨b1)∧(a2∨b2)
+def cnf_or(a: List[Clause], b: List[Clause]) -> List[Clause]:
+    res = []
+    for x in a:
+        for y in b:
+            clause = x | y
+            if len(clause) <= CNF_MAX_ATOMS:
+                res.append(clause)
+    return cnf_and(res, [])
+
+
+# 节点的匹配必须满足的条件
+def node_facts(node: Node) -> List[Clause]:
+    if isinstance(node, ConcatenateNode):
+        clauses = []
+        for sub in node.subs:
+            clauses = cnf_and(clauses, node_facts(sub))
+        return clauses
+    if isinstance(node, AlternateNode):
+        clauses = None
+        for sub in node.subs:
+            c = node_facts(sub)
+            clauses = c if clauses is None else cnf_or(clauses, c)
+        return clauses or []
+    if isinstance(node, CaptureNode):
+        return node_facts(node.sub)
+    if isinstance(node, RepeatNode):
+        if node.min <= 0:
+            return []
+        return node_facts(node.sub)
+    if isinstance(node, ConditionNode):
+        # 肯定断言的内容同样要在句子中出现
+        if node.is_positive:
+            return node_facts(node.sub)
+        return []
+    if isinstance(node, WordNode):
+        # 从右向左的Word按逆序的词比较，不是整句词形的子串
+        if node.shape == "" or node.RightToLeft:
+            return []
+        return [frozenset([("shape", node.shape)])]
+    if isinstance(node, WordSetNode):
+        shapes = [wn.shape for wn in node.word_list]
+        if "" in shapes or node.RightToLeft or not shapes:
+            return []
+        return [frozenset(("shape", s) for s in shapes)]
+    if isinstance(node, DynamicWordNode):
+        if node.pos == "":
+            return []
+        return [frozenset([("pos", node.pos)])]
+    if isinstance(node, DynamicWordSetNode):
+        atoms = []
+        for wn in node.word_list:
+            if not isinstance(wn, DynamicWordNode) or wn.pos == "":
+                return []
+            atoms.append(("pos", wn.pos))
+        if not atoms:
+            return []
+        return [frozenset(atoms)]
+    # Any、Empty、Position、Ref
+    return []
+
+
+# 在执行虚拟机之前按整句特征排除不可能匹配的句子
+@dataclass(eq=False)
+class FeatureFilter:
+    clauses: List[Clause]
+    minTokens: int
+
+    def atom_holds(self, atom: Atom, enc: EncodedSentence) -> bool:
+        kind, value = atom
+        if kind == "shape":
+            text = enc.cache.get("text")
+            if text is None:
+                text = enc.cache["text"] = "".join(enc.shapes)
+            if value in text:
+                return True
+            return any(text.endswith(value[:k]) for k in range(1, len(value)))
+        if len(value) == 1:
+            pos_union = enc.cache.get("posUnion")
+            if pos_union is None:
+                pos_union = 0
+                for mask in enc.posMasks:
+                    pos_union |= mask
+                enc.cache["posUnion"] = pos_union
+            return bool(pos_union & enc.features.pos_bit(value))
+        return any(value in w.get("pos", "") for w in enc.words)
+
+    def test(self, enc: EncodedSentence) -> bool:
+        if len(enc) < self.minTokens:
+            return False
+        for clause in self.clauses:
+            if not any(self.atom_holds(atom, enc) for atom in clause):
+                return False
+        return True
+
+
+# 没有可用的条件时返回None
+def feature_filter(node: Node) -> Optional[FeatureFilter]:
+    clauses = node_facts(node)
+    min_len = length_bounds(node)[0]
+    if not clauses and min_len == 0:
+        return None
+    return FeatureFilter(clauses=clauses, minTokens=min_len)
@@ -0,0 +1,161 @@
+from dataclasses import dataclass, field
+from array import array
+from syntax.code import Code, CodeType
+from syntax.tree import WordNode, DynamicWordNode
+from sentence import WordPredicate, EncodedSentence, evaluate_predicates, union_bits
+from typing import List, Dict, Tuple, Any, Iterable
+
+# 回溯虚拟机执行的紧凑程序：按指令位置排列的并行整数数组
+# 词形、词形集合、动态词谓词等对象去重后放在旁表中，数组中只保存旁表下标
+# 动态词谓词编译为WordPredicate，执行前在整个句子上一次算出取值，执行时只查位
+
+# flags中的位
+FLAG_RTL = 1  # 从右向左匹配
+FLAG_REVERSED = 2  # 反向引用逆序比较
+FLAG_LONGEST = 4  # WordSet取消耗词数最多的词形
+FLAG_LAZY = 8  # 非贪婪的RepeatCheck/SetLoop
+
+
+# WordSet的字符trie，每个节点是字符 => 子节点的dict
+# 键""为在该节点结束的词形在列表中的序号(重复时取最小)，键None为子树中最小的序号
+def build_word_trie(word_list: List[WordNode]) -> Dict[Any, Any]:
+    trie = {None: len(word_list)}
+    for ind, wn in enumerate(word_list):
+        node = trie
+        node[None] = min(node[None], ind)
+        for ch in wn.shape:
+            node = node.setdefault(ch, {None: ind})
+            node[None] = min(node[None], ind)
+        node.setdefault("", ind)
+    return trie
+
+
+def predicate_key(node: DynamicWordNode) -> Tuple[Any, ...]:
+    return (node.pos, node.pos2, node.length, node.word_struct, node.semantic_tag)
+
+
+@dataclass(eq=False)
+class Program:
+    op: array = field(default_factory=lambda: array("i"))  # 指令类型
+    next: array = field(default_factory=lambda: array("i"))  # arg[0]，没有时为-1
+    # Alt的分支为branches[branchStart[pc]:branchStart[pc+1]]，RepeatCheck为[循环体, 出口]
+    branchStart: array = field(default_factory=lambda: array("i"))
+    branches: array = field(default_factory=lambda: array("i"))
+    # SetMark/CaptureMark为分组号，Position为位置类型，Ref为引用的分组号，
+    # 肯定断言的SetJump为断言体至少消耗的词数，
+    # Word/WordSet/DynamicWord/DynamicWordSet/RepeatCheck/SetLoop为旁表下标，其余为-1
+    param: array = field(default_factory=lambda: array("i"))
+    flags: array = field(default_factory=lambda: array("i"))
+    # 旁表
+    words: List[str] = field(default_factory=list)
+    wordSets: List[Dict[Any, Any]] = field(default_factory=list)  # build_word_trie的结果
+    preds: List[WordPredicate] = field(default_factory=list)
+    predSets: List[List[int]] = field(default_factory=list)
+    loops: List[Tuple[int, int]] = field(default_factory=list)  # 计数循环的(最少, 最多)次数
+    # SetLoop的(最少次数, 最多次数, 叶指令类型, 叶指令的旁表下标)，Any的下标为-1
+    runs: List[Tuple[int, int, int, int]] = field(default_factory=list)
+    predIds: Dict[Tuple[Any, ...], int] = field(default_factory=dict)
+    wordIds: Dict[str, int] = field(default_factory=dict)
+
+    def __len__(self):
+        return len(self.op)
+
+    def intern_word(self, shape) -> int:
+        ind = self.wordIds.get(shape)
+        if ind is None:
+            ind = self.wordIds[shape] = len(self.words)
+            self.words.append(shape)
+        return ind
+
+    def intern_pred(self, node: DynamicWordNode) -> int:
+        key = predicate_key(node)
+        ind = self.predIds.get(key)
+        if ind is None:
+            ind = self.predIds[key] = len(self.preds)
+            self.preds.append(WordPredicate(node))
+        return ind
+
+    # 谓词在句子上的取值：(每个谓词的0/1数组, 每个谓词集合的0/1数组)，缓存在句子上
+    def pred_bits(self, enc: EncodedSentence) -> Tuple[List[bytearray], List[bytearray]]:
+        bits = enc.cache.get(self)
+        if bits is None:
+            self.prepare([enc])
+            bits = enc.cache[self]
+        return bits
+
+    # 一批句子一起计算谓词的取值
+    def prepare(self, sentences: Iterable[EncodedSentence]):
+        todo = [enc for enc in sentences if self not in enc.cache]
+        if not todo:
+            return
+        for enc, pred_bits in zip(todo, evaluate_predicates(self.preds, todo)):
+            set_bits = [
+                union_bits([pred_bits[k] for k in pred_set], len(enc))
+                for pred_set in self.predSets
+            ]
+            enc.cache[self] = (pred_bits, set_bits)
+
+    def add(self, code: Code, longest_wordset=False):
+        t = code.t
+        param = -1
+        if t == CodeType.SetMark or t == CodeType.CaptureMark:
+            param = code.params["cap_id"]
+        elif t == CodeType.Position:
+            param = code.params["position_type"]
+        elif t == CodeType.Ref:
+            param = code.params["ref_id"]
+        elif t == CodeType.SetJump:
+            param = code.params.get("min_len", 0) if code.params["is_positive"] else 0
+        elif t == CodeType.Word:
+            param = self.intern_word(code.wordn.shape)
+        elif t == CodeType.WordSet:
+            param = len(self.wordSets)
+            self.wordSets.append(build_word_trie(code.wordn.word_list))
+        elif t == CodeType.DynamicWord:
+            param = self.intern_pred(code.wordn)
+        elif t == CodeType.DynamicWordSet:
+            param = len(self.predSets)
+            self.predSets.append([self.intern_pred(wn) for wn in code.wordn.word_list])
+        elif t == CodeType.RepeatCheck:
+            param = len(self.loops)
+            self.loops.append((code.params["min"], code.params["max"]))
+        elif t == CodeType.SetLoop:
+            leaf_type = code.params["leaf_type"]
+            leaf_param = -1
+            if leaf_type == CodeType.DynamicWord:
+                leaf_param = self.intern_pred(code.wordn)
+            elif leaf_type == CodeType.DynamicWordSet:
+                leaf_param = len(self.predSets)
+                self.predSets.append(
+                    [self.intern_pred(wn) for wn in code.wordn.word_list]
+                )
+            param = len(self.runs)
+            self.runs.append(
+                (code.params["min"], code.params["max"], leaf_type, leaf_param)
+            )
+        flags = FLAG_RTL if code.RightToLeft else 0
+        if t == CodeType.SetJump and code.params["RightToLeft"]:
+            flags |= FLAG_RTL
+        if t == CodeType.Ref and code.params.get("isReversed"):
+            flags |= FLAG_REVERSED
+        if t == CodeType.WordSet and longest_wordset:
+            flags |= FLAG_LONGEST
+        if t == CodeType.RepeatCheck or t == CodeType.SetLoop:
+            if code.params["is_nongreedy"]:
+                flags |= FLAG_LAZY
+        self.op.append(t)
+        self.next.append(code.arg[0] if code.arg else -1)
+        self.branchStart.append(len(self.branches))
+        if t == CodeType.Alt or t == CodeType.RepeatCheck:
+            self.branches.extend(code.arg)
+        self.param.append(param)
+        self.flags.append(flags)
+
+
+# 指令按id排列，id即数组下标
+def pack_codes(codes: List[Code], longest_wordset=False) -> Program:
+    prog = Program()
+    for code in codes:
+        prog.add(code, longest_wordset)
+    prog.branchStart.append(len(prog.branches))
+    return prog
@@ -1,12 +1,34 @@
-from dataclasses import dataclass, fields
+from dataclasses import dataclass, field, fields
+import sys
+import time
 from syntax.code import Code, CodeType, PositionType, CodeNames
-from syntax.tree import WordNode, DynamicWordNode, WordSetNode, DynamicWordSetNode
+from syntax.tree import WordNode, WordSetNode, DynamicWordSetNode
+from match import Match
+from program import (
+    Program,
+    pack_codes,
+    FLAG_RTL,
+    FLAG_REVERSED,
+    FLAG_LONGEST,
+    FLAG_LAZY,
+)
+from sentence import EncodedSentence, encode_sentence
+from prefilter import (
+    LiteralScanner,
+    FeatureFilter,
+    FirstSet,
+    literal_scanner,
+    first_set,
+    loop_guides,
+)
 from typing import (
+    Optional,
+    Iterator,
     List,
     Any,
     Text,
     Dict,
-    Tuple,
+    Callable,
 )
 
 
@@ -39,20 +61,131 @@ def is_dynamic_word_match(node, word, DEBUG=False):
     return True
 
 
+# 以下叶指令的匹配函数供各执行引擎复用，shapes为EncodedSentence中的词形列
+# 返回匹配后的位置，失败返回-1
+def match_word_shape(shape, shapes, pos, end, RightToLeft=False) -> int:
+    if RightToLeft:
+        if pos <= 0:
+            return -1
+        while shape != "" and pos > 0:
+            pos -= 1
+            word_shape = shapes[pos]
+            if word_shape == "" or not shape.startswith(word_shape):
+                return -1
+            shape = shape[len(word_shape) :]
+        return pos
+    if pos >= end:
+        return -1
+    while shape != "" and pos < end:
+        word_shape = shapes[pos]
+        pos += 1
+        if word_shape == "" or not shape.startswith(word_shape):
+            return -1
+        shape = shape[len(word_shape) :]
+    return pos
+
+
+# trie为build_word_trie构建的字符trie，沿词形逐词向下走一遍
+# 默认在词的边界上结束的词形中，列表中最靠前的胜出；longest=True时消耗词数最多的胜出
+def match_word_set(trie, shapes, pos, end, RightToLeft=False, longest=False) -> int:
+    if (RightToLeft and pos <= 0) or (not RightToLeft and pos >= end):
+        return -1
+    node = trie
+    best = node.get("")
+    best_pos = pos if best is not None else -1
+    p = pos
+    while True:
+        if RightToLeft:
+            if p <= 0:
+                break
+            p -= 1
+            word_shape = shapes[p]
+        else:
+            if p >= end:
+                break
+            word_shape = shapes[p]
+            p += 1
+        if word_shape == "":
+            break
+        for ch in word_shape:
+            node = node.get(ch)
+            if node is None:
+                return best_pos
+        # 子树中最靠前的词形也排在已找到的之后，不必继续
+        if not longest and best is not None and node[None] > best:
+            break
+        ind = node.get("")
+        if ind is not None and (longest or best is None or ind < best):
+            best, best_pos = ind, p
+    return best_pos
+
+
+# line_breaks为EncodedSentence中词性为换行的标记
+def match_position(position_type, line_breaks, pos, end) -> bool:
+    if pos > end:
+        return False
+    if position_type == PositionType.BeginLine:
+        if pos == end:
+            return False
+        return pos == 0 or line_breaks[pos - 1]
+    elif position_type == PositionType.EndLine:
+        return pos == end or line_breaks[pos]
+    return False
+
+
+# 设置了截止时间时，每执行这么多步检查一次时钟
+BUDGET_CHECK_INTERVAL = 1024
+
+
+# 匹配超出步数预算或截止时间，steps为已执行的步数(指令数+回溯出栈数)
+class BudgetExhausted(Exception):
+    def __init__(self, steps, reason):
+        super().__init__(f"match budget exhausted ({reason}) after {steps} steps")
+        self.steps = steps
+        self.reason = reason  # "steps" 或 "deadline"
+
+
+# 单次匹配的可变状态，Runner本身只保存编译结果，可在多线程间共享
 @dataclass(repr=False)
-class Runner:
-    codes: List[Code] = None
+class MatchState:
     inputLst: List[Any] = None
+    # inputLst的编码形式，执行时才构建，输入变化时清空
+    sentence: Optional[EncodedSentence] = None
+    # 程序中谓词、谓词集合在sentence上的取值，下标为词的位置
+    predBits: List[bytearray] = field(default_factory=list)
+    setBits: List[bytearray] = field(default_factory=list)
+    # 搜索模式下可能的起点，每个位置一个0/1，None表示每个位置都要尝试
+    starts: Optional[bytearray] = None
+    # SetLoop的指令位置 => 循环可以结束的位置，每个位置一个0/1
+    guideBits: Dict[int, bytearray] = field(default_factory=dict)
     codePos: int = -1  # 按id执行
     wordStart: int = -1
     wordEnd: int = -1
     wordPos: int = -1
-    # 指令对传递信息
-    paramStack: List[Dict[Text, Any]] = None
-    # 记录回溯状态
-    trackStack: List[Tuple[int, int, List[Any]]] = None  # codepos,back_time,list[any]
-    matches: Dict[int, List[int]] = None
-    matchesInfo: Dict[int, Text] = None
+    # 指令对传递信息，每条记录3个整数(wordpos,paramStack长度,trackStack长度)，-1表示无
+    # SetMark只使用wordpos，SetJump记录执行时两个栈的长度
+    # RepeatStart的记录为(已完成的迭代数-1,本次迭代的起点,-1)，由RepeatCheck更新
+    paramStack: List[int] = field(default_factory=list)
+    # 记录回溯状态，每条记录由若干整数组成，最后一个是指令位置，其余字段由指令类型决定：
+    # Alt: wordpos,back_time,pc  CaptureMark: 分组原来的起点和终点(没有时为-1),分组起点,cap_id,pc
+    # SetMark/SetJump/RepeatStart: pc
+    # ForeJump: 断言体内的分组捕获按撤销顺序排列的(cap_id,原起点,原终点),捕获数,pc；没有捕获时不入栈
+    # RepeatCheck: 执行前的计数记录(2个),wordpos,回溯方式,pc
+    # SetLoop: 边界位置,当前位置,pc；贪婪时边界为最少次数处，非贪婪时为最多次数处
+    # 两个栈在多次执行之间复用，截断都在原列表上进行
+    trackStack: List[int] = field(default_factory=list)
+    matches: Dict[int, List[int]] = field(default_factory=dict)
+    # 由输入句子预先计算的数据(如词的等价类)，输入变化时清空
+    inputCache: Dict[Text, Any] = field(default_factory=dict)
+    # 记忆化回溯的位图及置过位的字节下标，在多次执行之间复用
+    visited: bytearray = field(default_factory=bytearray)
+    visitedKeys: List[int] = field(default_factory=list)
+    # 执行预算：步数上限，time.monotonic()表示的截止时间
+    steps: int = 0
+    maxSteps: Optional[int] = None
+    deadline: Optional[float] = None
+    # steps达到stepLimit时才检查预算，没有预算时为sys.maxsize
+    stepLimit: int = sys.maxsize
 
     def goto(self, codepos):
         self.codePos = codepos
@@ -64,447 +197,883 @@ class Runner:
         return self.inputLst[wordpos_]
 
     def track_to(self, trackpos):
-        self.trackStack = self.trackStack[:trackpos]
-
-    def track_push(self, back_time, param_lst):
-        self.trackStack.append((self.codePos, back_time, param_lst))
-
-    def track_pop(self):
-        return self.trackStack.pop()
+        del self.trackStack[trackpos:]
 
     def track_empty(self) -> bool:
         return len(self.trackStack) == 0
 
-    def param_push(self, item: Dict[Text, Any]):
-        self.paramStack.append(item)
+    # 整体捕获(0号分组)在Stop之前才写入，断言内泄漏的分组捕获不算匹配成功
+    def matched(self) -> bool:
+        return 0 in self.matches
+
+    # 第wordpos*code_count+codepos位表示该状态已经进入过
+    # 容量不够时才重新分配，否则只清除上次执行置过位的字节
+    def memo_table(self, code_count) -> bytearray:
+        size = ((self.wordEnd + 1) * code_count >> 3) + 1
+        if len(self.visited) < size:
+            self.visited = bytearray(size)
+        else:
+            visited = self.visited
+            for k in self.visitedKeys:
+                visited[k] = 0
+        self.visitedKeys.clear()
+        return self.visited
+
+    def set_budget(self, max_steps=None, deadline=None):
+        self.steps = 0
+        self.maxSteps = max_steps
+        self.deadline = deadline
+        self.stepLimit = sys.maxsize
+        self.charge()
+
+    # 步数达到stepLimit时调用，预算用尽时抛出BudgetExhausted，否则计算下次检查的位置
+    def charge(self):
+        if self.maxSteps is not None and self.steps >= self.maxSteps:
+            raise BudgetExhausted(self.steps, "steps")
+        limit = sys.maxsize
+        if self.deadline is not None:
+            if time.monotonic() >= self.deadline:
+                raise BudgetExhausted(self.steps, "deadline")
+            limit = self.steps + BUDGET_CHECK_INTERVAL
+        if self.maxSteps is not None:
+            limit = min(limit, self.maxSteps)
+        self.stepLimit = limit
+
+    # 撤销一次分组捕获，start为-1表示该分组原来没有捕获
+    def restore_capture(self, cap_id, start, end):
+        if start < 0:
+            self.matches.pop(cap_id, None)
+        else:
+            self.matches[cap_id] = [start, end]
+
+    # 恢复至SetJump时的栈长度
+    # 弹出的param不是SetJump的数据时长度为-1，保持原样
+    def truncate(self, param_len, track_len):
+        if param_len >= 0:
+            del self.paramStack[param_len:]
+        if track_len >= 0:
+            del self.trackStack[track_len:]
+
+    # 从wordstart位置的字符开始匹配，复用已有的栈
+    # input_lst可以是词对象列表，也可以是已编码的EncodedSentence
+    def reset(self, input_lst, wordstart):
+        sentence = None
+        if isinstance(input_lst, EncodedSentence):
+            sentence = input_lst
+            input_lst = sentence.words
+        self.wordStart = wordstart
+        self.wordEnd = len(input_lst)
+        self.paramStack.clear()
+        self.trackStack.clear()
+        self.wordPos = wordstart
+        self.matches.clear()
+        if self.inputLst is not input_lst:
+            self.inputCache.clear()
+            self.sentence = sentence
+        elif sentence is not None:
+            self.sentence = sentence
+        self.inputLst = input_lst
+        return self
+
+    # 同一输入只编码一次
+    def encode(self) -> EncodedSentence:
+        if self.sentence is None:
+            self.sentence = EncodedSentence(self.inputLst)
+        return self.sentence
+
+    # 搜索模式下换到下一个起点，不重新分配栈
+    def restart(self, wordstart):
+        self.wordStart = wordstart
+        self.wordPos = wordstart
+        self.paramStack.clear()
+        self.trackStack.clear()
+        self.matches.clear()
+        self.codePos = 0
+
+    # 归还状态池前释放对输入的引用，调用之间词列表可能被原地修改，编码不跨调用复用
+    def release(self):
+        self.inputLst = None
+        self.sentence = None
+        self.predBits = []
+        self.setBits = []
+        self.starts = None
+        self.guideBits = {}
+        self.set_budget()
+        self.inputCache.clear()
+        self.paramStack.clear()
+        self.trackStack.clear()
+        self.matches.clear()
+
+    def __repr__(self):
+        fields_filters = [
+            "inputLst",
+            "sentence",
+            "predBits",
+            "setBits",
+            "starts",
+            "guideBits",
+            "inputCache",
+            "visited",
+            "visitedKeys",
+            "stepLimit",
+        ]
+        fields_expr = [
+            f"{f.name}={getattr(self, f.name)}"
+            for f in fields(self)
+            if f.name not in fields_filters
+        ]
+        fields_expr = "(" + ",".join(fields_expr) + ")"
+        return f"MatchState{fields_expr}"
+
+
+# 记忆化回溯只对匹配结果只由(指令,位置)决定的程序成立
+# 反向引用依赖已捕获的内容，零宽断言的结果依赖paramStack中SetJump保存的位置，
+# 计数循环的结果依赖paramStack中的迭代次数
+def memo_supported(codes: List[Code]) -> bool:
+    for code in codes:
+        if code.t in (
+            CodeType.Ref,
+            CodeType.SetJump,
+            CodeType.GetJump,
+            CodeType.RepeatStart,
+            CodeType.RepeatCheck,
+        ):
+            return False
+    return True
+
+
+# RepeatCheck回溯帧中的回溯方式
+LOOP_UNDO = 0  # 恢复计数记录，继续回溯
+LOOP_EXIT = 1  # 恢复计数记录后改为退出循环
+LOOP_UNDO_EXIT = 2  # 退出时弹出了计数记录，重新压入，继续回溯
+LOOP_ITER = 3  # 非贪婪：退出失败后改为再迭代一次
+
+
+# 状态池上限，超出的MatchState直接丢弃
+STATE_POOL_SIZE = 16
+
+
+# 编译后的只读程序，匹配状态由MatchState保存
+@dataclass(repr=False)
+class Runner:
+    codes: List[Code] = None
+    matchesInfo: Dict[int, Text] = None
+    # list的pop/append是原子操作，多线程共享时无需加锁
+    statePool: List[MatchState] = field(default_factory=list, compare=False)
+    groupIndex: Dict[Text, int] = field(init=False, compare=False)
+    # 记录失败的(Alt指令,位置)，不再重复尝试，程序不支持时自动关闭
+    memoize: bool = False
+    # WordSet取消耗词数最多的词形，默认取列表中最靠前的
+    longestWordSet: bool = False
+    # codes的紧凑形式，执行时只读取它
+    program: Program = field(init=False, compare=False)
+    # 与指令一一对应的处理函数
+    ops: List[Callable[["MatchState", int], Any]] = field(init=False, compare=False)
+    tracingRunner: Optional["Runner"] = field(default=None, init=False, compare=False)
+    # 由语法树得到的必要条件，句子不满足时不执行虚拟机
+    featureFilter: Optional[FeatureFilter] = field(default=None, compare=False)
+    # 匹配至少消耗的词数，离句末更近的起点不必尝试
+    minLength: int = field(default=0, compare=False)
+    # 匹配开头全是词形字面量时，用它一次扫描出可能的起点
+    literalScanner: Optional[LiteralScanner] = field(init=False, compare=False)
+    # 能消耗第一个词的叶指令，起点的词不满足其中任何一个时跳过
+    firstSet: Optional[FirstSet] = field(init=False, compare=False)
+    # SetLoop之后的指令能消耗的第一个词，循环直接跳到满足它的位置结束
+    loopGuides: Dict[int, FirstSet] = field(init=False, compare=False)
+
+    def __post_init__(self):
+        self.memoize = self.memoize and memo_supported(self.codes)
+        self.program = pack_codes(self.codes, self.longestWordSet)
+        self.literalScanner = literal_scanner(self.codes)
+        self.firstSet = first_set(self.codes, self.program)
+        self.loopGuides = loop_guides(self.codes, self.program)
+        self.ops = self.make_ops()
+        self.groupIndex = {}
+        if self.matchesInfo is not None:
+            for ind, group_name in self.matchesInfo.items():
+                self.groupIndex[group_name] = ind
+
+    def acquire_state(self) -> MatchState:
+        try:
+            return self.statePool.pop()
+        except IndexError:
+            return MatchState()
+
+    def release_state(self, st: MatchState):
+        st.release()
+        if len(self.statePool) < STATE_POOL_SIZE:
+            self.statePool.append(st)
+
+    # 每条指令在编译时确定处理函数，执行时按codePos直接取用
+    # 处理函数执行一条指令并设置下一条指令的位置，只有Stop返回True
+    # 处理函数只读取program中的数组和旁表，不访问Code对象
+    def make_ops(self) -> List[Callable[["MatchState", int], Any]]:
+        table = {
+            CodeType.Stop: self.op_stop,
+            CodeType.Nop: self.op_nop,
+            CodeType.Alt: self.op_alt_memo if self.memoize else self.op_alt,
+            CodeType.SetMark: self.op_set_mark,
+            CodeType.CaptureMark: self.op_capture_mark,
+            CodeType.SetJump: self.op_set_jump,
+            CodeType.GetJump: self.op_get_jump,
+            CodeType.ForeJump: self.op_fore_jump,
+            CodeType.BackJump: self.op_back_jump,
+            CodeType.RepeatStart: self.op_repeat_start,
+            CodeType.RepeatCheck: self.op_repeat_check,
+            CodeType.SetLoop: self.op_set_loop,
+            CodeType.Word: self.op_word,
+            CodeType.WordSet: self.op_word_set,
+            CodeType.DynamicWord: self.op_dynamic_word,
+            CodeType.DynamicWordSet: self.op_dynamic_word_set,
+            CodeType.Any: self.op_any,
+            CodeType.Position: self.op_position,
+            CodeType.Ref: self.op_ref,
+        }
+        return [table[t] for t in self.program.op]
+
+    # DEBUG模式交给TracingRunner执行，首次使用时创建
+    def tracer(self) -> "Runner":
+        if self.tracingRunner is None:
+            self.tracingRunner = TracingRunner(
+                codes=self.codes,
+                matchesInfo=self.matchesInfo,
+                memoize=self.memoize,
+                longestWordSet=self.longestWordSet,
+                featureFilter=self.featureFilter,
+                minLength=self.minLength,
+            )
+        return self.tracingRunner
+
+    # 编码输入并取出谓词的取值，同一句子只计算一次
+    # 搜索模式下同时取出可能的起点
+    def bind_sentence(self, st: "MatchState", search=False):
+        enc = st.encode()
+        if self.program.preds:
+            st.predBits, st.setBits = self.program.pred_bits(enc)
+        st.starts = self.candidate_starts(enc) if search else None
+        st.guideBits = self.guide_bits(enc) if self.loopGuides else {}
+
+    # 句子满足正则的必要条件时返回True，返回False时不可能匹配，结果缓存在句子上
+    def may_match(self, input_lst) -> bool:
+        if self.featureFilter is None:
+            return True
+        enc = encode_sentence(input_lst)
+        ok = enc.cache.get(self.featureFilter)
+        if ok is None:
+            ok = enc.cache[self.featureFilter] = self.featureFilter.test(enc)
+        return ok
+
+    # 句子上可能的起点，没有可用的预筛选时返回None，结果缓存在句子上
+    # 开头全是字面量时字面量扫描更精确(可以跨多个词)，否则用FIRST集逐词判断
+    def candidate_starts(self, enc: EncodedSentence) -> Optional[bytearray]:
+        if self.literalScanner is None and self.firstSet is None:
+            return None
+        key = ("starts", self.program)
+        starts = enc.cache.get(key)
+        if starts is None:
+            if self.literalScanner is not None:
+                starts = self.literalScanner.starts(enc)
+            else:
+                starts = self.firstSet.starts(enc, *self.program.pred_bits(enc))
+            enc.cache[key] = starts
+        return starts
+
+    # 句子上每个SetLoop可以结束的位置，结果缓存在句子上
+    def guide_bits(self, enc: EncodedSentence) -> Dict[int, bytearray]:
+        key = ("guides", self.program)
+        bits = enc.cache.get(key)
+        if bits is None:
+            pred_bits, set_bits = self.program.pred_bits(enc)
+            bits = enc.cache[key] = {
+                pc: fs.starts(enc, pred_bits, set_bits)
+                for pc, fs in self.loopGuides.items()
+            }
+        return bits
 
-    def param_pop(self):
-        return self.paramStack.pop()
+    # 不小于i的第一个可能的起点，没有时返回-1
+    def next_start(self, st: "MatchState", i) -> int:
+        end = min(st.wordEnd, st.wordEnd - self.minLength + 1)
+        if i >= end:
+            return -1
+        if st.starts is None:
+            return i
+        return st.starts.find(1, i, end)
 
-    def param_peek(self, i):
-        return self.paramStack[len(self.paramStack) - i - 1]
+    # 预先编码一批句子并一起计算谓词的取值，结果可直接传给run/search/finditer
+    def prepare(self, inputs) -> List[EncodedSentence]:
+        sentences = [encode_sentence(x) for x in inputs]
+        self.program.prepare(sentences)
+        return sentences
 
-    def execute(self, DEBUG=False) -> bool:
-        self.goto(0)
+    # search=True时在同一次执行中依次尝试后续起点，直到找到最左匹配
+    def execute(self, st: "MatchState", DEBUG=False, search=False) -> bool:
+        if DEBUG:
+            return self.tracer().execute(st, False, search)
+        # 再次进入已经进入过的(Alt指令,位置)时，之前的尝试要么已经失败，
+        # 要么是当前路径上的空循环，都无需重试
+        # 搜索模式换起点时之前的尝试全部失败，位图继续有效
+        if self.memoize:
+            st.memo_table(len(self.program))
+        self.bind_sentence(st, search)
+        if not self.may_match(st.sentence):
+            return True  # 没有整体捕获表示匹配失败
+        ops = self.ops
+        st.codePos = 0
+        if search:
+            i = self.next_start(st, st.wordStart)
+            if i < 0:
+                return True  # 没有可能的起点，没有整体捕获表示匹配失败
+            st.restart(i)
         while True:
-            if self.codePos >= len(self.codes) or self.codePos < 0:
-                return False
-            code = self.codes[self.codePos]
-            if DEBUG:
-                print(
-                    f"code_type:{CodeNames[code.t]} ",
-                    f"wordpos:{self.wordPos} ",
-                    f"word:{self.get_word(self.wordPos)}",
-                )
-                print("trackStack(codepos,back_time,track_param):", self.trackStack)
-                print("paramStack:", self.paramStack)
-                print("------------")
-            if code.t == CodeType.Stop:
+            pc = st.codePos
+            st.steps += 1
+            if st.steps >= st.stepLimit:
+                st.charge()
+            if ops[pc](st, pc):
+                # 0号Alt的第二个分支直接跳到Stop，此时没有整体捕获，表示当前起点匹配失败
+                if search and not st.matched():
+                    i = self.next_start(st, st.wordStart + 1)
+                    if i >= 0:
+                        st.restart(i)
+                        continue
                 return True  # 匹配成功，存在以位置0开头的符合正则表达式的子串
 
-            elif code.t == CodeType.Nop:
-                self.goto(code.arg[0])  # 匹配空字符（词）
-                continue
-
-            elif code.t == CodeType.Alt:  # backtrace code
-                # 首次执行回溯指令保存状态
-                # trackpos,wordpos
-                self.track_push(0, [self.wordPos])  # 保存指令状态， 以便回溯返回
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.SetMark:  # backtrace code
-                self.param_push(
-                    {"codeid": code.id, "wordpos": self.wordPos}
-                )  # 把信息传给CaptureMark
-                self.track_push(0, [])  # 回溯时不需要恢复textpos
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.CaptureMark:  # backtrace code
-                cap_id = code.params["cap_id"]
-                # cap_name = code.params['name']
-                # 弹出Setmark的数据，因为
-                # SetMark SetMark [...] CaptureMark CaptureMark嵌套需要内部数据清除
-                # 为保证paramStack在回溯时变为原有数据，需要将param放入trackStack
-                param = self.param_pop()
-                cap_startpos = param.get("wordpos")
-                cap_stoppos = self.wordPos
-
-                self.matches[cap_id] = [cap_startpos, cap_stoppos]
-                # self.matchesInfo[cap_id] = cap_name
-                # 进入回溯，记录捕获信息
-                self.track_push(0, [cap_id, param])
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.SetJump:  # backtrace code
-                param_len = len(self.paramStack)
-                track_len = len(self.trackStack)
-
-                word_pos = self.wordPos
-                self.param_push(
-                    {
-                        "codeid": code.id,
-                        "paramStackLength": param_len,
-                        "trackStackLength": track_len,
-                        "wordpos": word_pos,
-                    }
-                )
-                self.track_push(0, [])
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.GetJump:
-                param = self.param_pop()
-                param_len = param.get("paramStackLength")
-                track_len = param.get("trackStackLength")
-                word_pos = param.get("wordpos")
-                self.paramStack = self.paramStack[:param_len]
-                self.trackStack = self.trackStack[:track_len]
-                self.wordPos = word_pos
-
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.ForeJump:  # backtrace code
-                param = self.param_pop()
-                param_len = param.get("paramStackLength")
-                track_len = param.get("trackStackLength")
-                word_pos = param.get("wordpos")
-                self.paramStack = self.paramStack[:param_len]
-                self.trackStack = self.trackStack[:track_len]
-                self.wordPos = word_pos
-                # 存储param，回溯时恢复Setjump状态
-                self.track_push(0, [param])
-                # 进入下一条指令
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.BackJump:
-                param = self.param_pop()
-                param_len = param.get("paramStackLength")
-                track_len = param.get("trackStackLength")
-                word_pos = param.get("wordpos")
-                self.paramStack = self.paramStack[:param_len]
-                self.trackStack = self.trackStack[:track_len]
-                self.wordPos = word_pos
-
-                self.backtrack()
-                continue
-
-            # leaf code
-            # 要求Word有词的词形构成且词之间连接在一起
-            elif code.t == CodeType.Word:  # 一个Word指令可能与多个字典输入匹配
-                ok = True
-                old_pos = self.wordPos
-                if code.RightToLeft:
-                    if self.wordPos <= 0:
-                        self.backtrack()
-                        continue
-                    # shape有多个字符
-                    # s为单个字符
-                    code_shape = code.wordn.shape
-                    while code_shape != "" and self.wordPos > 0:
-                        self.wordPos -= 1
-                        word = self.get_word(self.wordPos)
-                        word_shape = word.get("shape", "")
-                        if word_shape == "" or not code_shape.startswith(word_shape):
-                            ok = False
-                            break
-                        # 减去前缀
-                        code_shape = code_shape[len(word_shape) :]
+    def op_stop(self, st: "MatchState", pc):
+        return True
 
-                else:
-                    if self.wordPos >= self.wordEnd:
-                        self.backtrack()
-                        continue
+    def op_nop(self, st: "MatchState", pc):
+        st.codePos = self.program.next[pc]  # 匹配空字符（词）
 
-                    # shape有多个字符
-                    # s为单个字符
-                    code_shape = code.wordn.shape
-                    while code_shape != "" and self.wordPos < self.wordEnd:
-                        word = self.get_word(self.wordPos)
-                        self.wordPos += 1
-                        word_shape = word.get("shape", "")
-                        if word_shape == "" or not code_shape.startswith(word_shape):
-                            ok = False
-                            break
-                        # 减去前缀
-                        code_shape = code_shape[len(word_shape) :]
-
-                if not ok:
-                    self.wordPos = old_pos
-                    self.backtrack()
-                    continue
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.WordSet:
-                ok = False
-                old_pos = self.wordPos
-
-                if code.RightToLeft:
-                    if self.wordPos <= 0:
-                        self.backtrack()
-                        continue
-                    for wn in code.wordn.word_list:
-                        ok2 = True
-                        pos = self.wordPos
-
-                        code_shape = wn.shape
-                        while code_shape != "":
-                            pos -= 1
-                            word = self.get_word(pos)
-                            word_shape = word.get("shape", "")
-                            if word_shape == "" or not code_shape.startswith(
-                                word_shape
-                            ):
-                                ok2 = False
-                                break
-                            # 减去前缀
-                            code_shape = code_shape[len(word_shape) :]
-                        if ok2:
-                            self.wordPos = pos
-                            ok = True
-                            break
-                else:
-                    if self.wordPos >= self.wordEnd:
-                        self.backtrack()
-                        continue
+    def op_alt(self, st: "MatchState", pc):  # backtrace code
+        # 首次执行回溯指令保存状态
+        # wordpos,back_time,pc
+        st.trackStack += (st.wordPos, 0, pc)  # 保存指令状态， 以便回溯返回
+        st.codePos = self.program.next[pc]
 
-                    for wn in code.wordn.word_list:
-                        ok2 = True
-                        pos = self.wordPos
-
-                        code_shape = wn.shape
-                        while code_shape != "":
-                            word = self.get_word(pos)
-                            pos += 1
-                            word_shape = word.get("shape", "")
-
-                            if word_shape == "" or not code_shape.startswith(
-                                word_shape
-                            ):
-                                ok2 = False
-                                break
-                            # 减去前缀
-                            code_shape = code_shape[len(word_shape) :]
-                        if ok2:
-                            self.wordPos = pos
-                            ok = True
-                            break
-
-                if not ok:
-                    self.wordPos = old_pos
-                    self.backtrack()
-                    continue
-
-                self.goto(code.arg[0])
-                continue
-            # a
-            elif code.t == CodeType.DynamicWord:
-                old_pos = self.wordPos
-                if code.RightToLeft:
-                    if self.wordPos <= 0:
-                        self.backtrack()
-                        continue
-                    self.wordPos -= 1
-                    word = self.get_word(self.wordPos)
-                    ok = is_dynamic_word_match(code.wordn, word, DEBUG)
-                else:
-                    if self.wordPos >= self.wordEnd:
-                        self.backtrack()
-                        continue
-                    word = self.get_word(self.wordPos)
-                    self.wordPos += 1
-                    ok = is_dynamic_word_match(code.wordn, word, DEBUG)
-
-                if not ok:
-                    self.wordPos = old_pos
-                    self.backtrack()
-                    continue
-                self.goto(code.arg[0])
-                continue
-            # [a①1c①]
-            elif code.t == CodeType.DynamicWordSet:
-                ok = False
-                old_pos = self.wordPos
-
-                if code.RightToLeft:
-                    if self.wordPos <= 0:
-                        self.backtrack()
-                        continue
-                    self.wordPos -= 1
-                    word = self.get_word(self.wordPos)
-                    word_list: List[DynamicWordNode] = code.wordn.word_list
-                    for wn in word_list:
-                        if is_dynamic_word_match(wn, word, DEBUG):
-                            ok = True
-                            break
-                else:
-                    if self.wordPos >= self.wordEnd:
-                        self.backtrack()
-                        continue
+    def op_alt_memo(self, st: "MatchState", pc):
+        k = st.wordPos * len(self.program) + pc
+        visited = st.visited
+        if visited[k >> 3] >> (k & 7) & 1:
+            self.backtrack(st)
+            return
+        visited[k >> 3] |= 1 << (k & 7)
+        st.visitedKeys.append(k >> 3)
+        st.trackStack += (st.wordPos, 0, pc)
+        st.codePos = self.program.next[pc]
 
-                    word = self.get_word(self.wordPos)
-                    self.wordPos += 1
-                    word_list: List[DynamicWordNode] = code.wordn.word_list
-                    for wn in word_list:
-                        if is_dynamic_word_match(wn, word, DEBUG):
-                            ok = True
-                            break
-
-                if not ok:
-                    self.wordPos = old_pos
-                    self.backtrack()
-                    continue
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.Any:
-                if code.RightToLeft:
-                    if self.wordPos <= 0:
-                        self.backtrack()
-                        continue
-                    self.wordPos -= 1
+    def op_set_mark(self, st: "MatchState", pc):  # backtrace code
+        # 把信息传给CaptureMark
+        st.paramStack += (st.wordPos, -1, -1)
+        st.trackStack.append(pc)  # 回溯时不需要恢复textpos
+        st.codePos = self.program.next[pc]
 
-                else:
-                    if self.wordPos >= self.wordEnd:
-                        self.backtrack()
-                        continue
-                    self.wordPos += 1
-
-                self.goto(code.arg[0])
-                continue
-
-            elif code.t == CodeType.Position:
-                if self.wordPos > self.wordEnd:
-                    self.backtrack()
-                    continue
-                p_t = code.params.get("position_type")
-                if p_t == PositionType.BeginLine:
-                    if self.wordPos == self.wordEnd:
-                        self.backtrack()
-                        continue
-                    if (
-                        self.wordPos == 0
-                        or self.get_word(self.wordPos - 1).get("cixing", "") == "\n"
-                    ):
-                        self.goto(code.arg[0])
-                        continue
-                    else:
-                        self.backtrack()
-                        continue
-                elif p_t == PositionType.EndLine:
-                    if (
-                        self.wordPos == self.wordEnd
-                        or self.get_word(self.wordPos).get("cixing", "") == "\n"
-                    ):
-                        self.goto(code.arg[0])
-                        continue
+    def op_capture_mark(self, st: "MatchState", pc):  # backtrace code
+        cap_id = self.program.param[pc]
+        # 弹出Setmark的数据，因为
+        # SetMark SetMark [...] CaptureMark CaptureMark嵌套需要内部数据清除
+        # 为保证paramStack在回溯时变为原有数据，需要将param放入trackStack
+        # 分组内的SetJump都已被ForeJump/BackJump弹出，栈顶一定是SetMark的记录
+        ps = st.paramStack
+        start = ps[-3]
+        del ps[-3:]
+        # 进入回溯，记录捕获信息，循环中重复捕获时回溯恢复上一次的结果
+        prev = st.matches.get(cap_id)
+        if prev is None:
+            st.trackStack += (-1, -1, start, cap_id, pc)
+        else:
+            st.trackStack += (prev[0], prev[1], start, cap_id, pc)
+        st.matches[cap_id] = [start, st.wordPos]
+        st.codePos = self.program.next[pc]
+
+    def op_set_jump(self, st: "MatchState", pc):  # backtrace code
+        # 断言方向上剩余的词少于断言体的最少词数时，肯定断言不可能成立
+        min_len = self.program.param[pc]
+        if min_len > 0:
+            if self.program.flags[pc] & FLAG_RTL:
+                room = st.wordPos
+            else:
+                room = st.wordEnd - st.wordPos
+            if room < min_len:
+                self.backtrack(st)
+                return
+        ps = st.paramStack
+        ps += (st.wordPos, len(ps), len(st.trackStack))
+        st.trackStack.append(pc)
+        st.codePos = self.program.next[pc]
+
+    # 弹出SetJump的记录，恢复至SetJump时的栈长度和位置
+    def op_get_jump(self, st: "MatchState", pc):
+        ps = st.paramStack
+        word_pos = ps[-3]
+        param_len = ps[-2]
+        track_len = ps[-1]
+        del ps[-3:]
+        st.truncate(param_len, track_len)
+        st.wordPos = word_pos
+        st.codePos = self.program.next[pc]
+
+    # 断言体的回溯帧在track_len之上，按撤销顺序取出其中的分组捕获，每个为(cap_id,原起点,原终点)
+    def dropped_captures(self, st: "MatchState", track_len) -> List[int]:
+        op = self.program.op
+        ts = st.trackStack
+        res = []
+        i = len(ts)
+        while i > track_len:
+            t = op[ts[i - 1]]
+            if t == CodeType.CaptureMark:
+                res += (ts[i - 2], ts[i - 5], ts[i - 4])
+                i -= 5
+            elif t == CodeType.ForeJump:
+                k = ts[i - 2] * 3
+                res += ts[i - 2 - k : i - 2]
+                i -= k + 2
+            elif t == CodeType.Alt or t == CodeType.SetLoop:
+                i -= 3
+            elif t == CodeType.RepeatCheck:
+                i -= 5
+            else:
+                i -= 1
+        return res
+
+    # 两个栈恢复至SetJump执行前的状态，断言体内的回溯点一并丢弃
+    # 断言体内的分组捕获保留，回溯经过ForeJump时撤销
+    def op_fore_jump(self, st: "MatchState", pc):  # backtrace code
+        ps = st.paramStack
+        word_pos = ps[-3]
+        param_len = ps[-2]
+        track_len = ps[-1]
+        del ps[-3:]
+        undo = self.dropped_captures(st, track_len)
+        st.truncate(param_len, track_len)
+        st.wordPos = word_pos
+        if undo:
+            st.trackStack += undo
+            st.trackStack += (len(undo) // 3, pc)
+        st.codePos = self.program.next[pc]
+
+    # 断言不成立，断言体内的分组捕获立即撤销
+    def op_back_jump(self, st: "MatchState", pc):
+        ps = st.paramStack
+        word_pos = ps[-3]
+        param_len = ps[-2]
+        track_len = ps[-1]
+        del ps[-3:]
+        undo = self.dropped_captures(st, track_len)
+        for i in range(0, len(undo), 3):
+            st.restore_capture(undo[i], undo[i + 1], undo[i + 2])
+        st.truncate(param_len, track_len)
+        st.wordPos = word_pos
+        self.backtrack(st)
+
+    def op_repeat_start(self, st: "MatchState", pc):  # backtrace code
+        st.paramStack += (-1, st.wordPos, -1)
+        st.trackStack.append(pc)
+        st.codePos = self.program.next[pc]
+
+    # 进入循环和每次迭代结束时执行，按已完成的迭代数决定继续迭代或退出
+    # 超过最少次数后出现空迭代时不再迭代，避免空循环
+    def op_repeat_check(self, st: "MatchState", pc):  # backtrace code
+        prog = self.program
+        ps = st.paramStack
+        c0 = ps[-3]
+        s0 = ps[-2]
+        c = c0 + 1
+        pos = st.wordPos
+        lo, hi = prog.loops[prog.param[pc]]
+        exit_ok = c >= lo
+        iterate_ok = c < hi and not (exit_ok and c > 0 and pos == s0)
+        body = prog.branches[prog.branchStart[pc]]
+        if prog.flags[pc] & FLAG_LAZY:
+            if exit_ok:
+                del ps[-3:]
+                mode = LOOP_ITER if iterate_ok else LOOP_UNDO_EXIT
+                st.trackStack += (c0, s0, pos, mode, pc)
+                st.codePos = prog.branches[prog.branchStart[pc] + 1]
+                return
+            if iterate_ok:
+                ps[-3] = c
+                ps[-2] = pos
+                st.trackStack += (c0, s0, pos, LOOP_UNDO, pc)
+                st.codePos = body
+                return
+        else:
+            if iterate_ok:
+                ps[-3] = c
+                ps[-2] = pos
+                mode = LOOP_EXIT if exit_ok else LOOP_UNDO
+                st.trackStack += (c0, s0, pos, mode, pc)
+                st.codePos = body
+                return
+            if exit_ok:
+                del ps[-3:]
+                st.trackStack += (c0, s0, pos, LOOP_UNDO_EXIT, pc)
+                st.codePos = prog.branches[prog.branchStart[pc] + 1]
+                return
+        self.backtrack(st)
+
+    # 单个词的循环，连续满足条件的词在predBits/setBits上用find一次找到
+    # 贪婪：先消耗尽可能多的词，回溯时每次退回一个；非贪婪：先消耗最少的词，回溯时每次多消耗一个
+    # 有guideBits时只在之后的指令可能匹配的位置结束，直接跳过中间的位置
+    def op_set_loop(self, st: "MatchState", pc):  # backtrace code
+        prog = self.program
+        lo, hi, leaf_type, leaf_param = prog.runs[prog.param[pc]]
+        rtl = prog.flags[pc] & FLAG_RTL
+        pos = st.wordPos
+        room = min(pos if rtl else st.wordEnd - pos, hi)
+        lazy = prog.flags[pc] & FLAG_LAZY
+        n = min(room, lo) if lazy else room  # 先尝试消耗的词数
+        bits = None
+        if leaf_type == CodeType.DynamicWord:
+            bits = st.predBits[leaf_param]
+        elif leaf_type == CodeType.DynamicWordSet:
+            bits = st.setBits[leaf_param]
+        if bits is not None:
+            if rtl:
+                k = bits.rfind(0, pos - n, pos)
+                if k >= 0:
+                    n = pos - k - 1
+            else:
+                k = bits.find(0, pos, pos + n)
+                if k >= 0:
+                    n = k - pos
+        if n < lo:
+            self.backtrack(st)
+            return
+        step = -1 if rtl else 1
+        cur = pos + step * n
+        bound = pos + step * (room if lazy else lo)
+        guide = st.guideBits.get(pc)
+        if guide is not None:  # 只有从左向右的循环
+            if lazy:
+                p = guide.find(1, cur, bound + 1)
+                if p < 0 or (bits is not None and bits.find(0, cur, p) >= 0):
+                    self.backtrack(st)
+                    return
+            else:
+                p = guide.rfind(1, bound, cur + 1)
+                if p < 0:
+                    self.backtrack(st)
+                    return
+            cur = p
+        if cur != bound:
+            st.trackStack += (bound, cur, pc)
+        st.wordPos = cur
+        st.codePos = prog.next[pc]
+
+    # leaf code
+    # 要求Word有词的词形构成且词之间连接在一起，一个Word指令可能与多个字典输入匹配
+    def op_word(self, st: "MatchState", pc):
+        prog = self.program
+        pos = match_word_shape(
+            prog.words[prog.param[pc]],
+            st.sentence.shapes,
+            st.wordPos,
+            st.wordEnd,
+            prog.flags[pc] & FLAG_RTL,
+        )
+        if pos < 0:
+            self.backtrack(st)
+            return
+        st.wordPos = pos
+        st.codePos = prog.next[pc]
+
+    def op_word_set(self, st: "MatchState", pc):
+        prog = self.program
+        pos = match_word_set(
+            prog.wordSets[prog.param[pc]],
+            st.sentence.shapes,
+            st.wordPos,
+            st.wordEnd,
+            prog.flags[pc] & FLAG_RTL,
+            prog.flags[pc] & FLAG_LONGEST,
+        )
+        if pos < 0:
+            self.backtrack(st)
+            return
+        st.wordPos = pos
+        st.codePos = prog.next[pc]
+
+    # a
+    def op_dynamic_word(self, st: "MatchState", pc):
+        pos = st.wordPos
+        if self.program.flags[pc] & FLAG_RTL:
+            if pos <= 0 or not st.predBits[self.program.param[pc]][pos - 1]:
+                self.backtrack(st)
+                return
+            st.wordPos = pos - 1
+        else:
+            if pos >= st.wordEnd or not st.predBits[self.program.param[pc]][pos]:
+                self.backtrack(st)
+                return
+            st.wordPos = pos + 1
+        st.codePos = self.program.next[pc]
+
+    # [a①1c①]
+    def op_dynamic_word_set(self, st: "MatchState", pc):
+        pos = st.wordPos
+        if self.program.flags[pc] & FLAG_RTL:
+            if pos <= 0 or not st.setBits[self.program.param[pc]][pos - 1]:
+                self.backtrack(st)
+                return
+            st.wordPos = pos - 1
+        else:
+            if pos >= st.wordEnd or not st.setBits[self.program.param[pc]][pos]:
+                self.backtrack(st)
+                return
+            st.wordPos = pos + 1
+        st.codePos = self.program.next[pc]
+
+    def op_any(self, st: "MatchState", pc):
+        if self.program.flags[pc] & FLAG_RTL:
+            if st.wordPos <= 0:
+                self.backtrack(st)
+                return
+            st.wordPos -= 1
+        else:
+            if st.wordPos >= st.wordEnd:
+                self.backtrack(st)
+                return
+            st.wordPos += 1
+        st.codePos = self.program.next[pc]
+
+    def op_position(self, st: "MatchState", pc):
+        prog = self.program
+        if match_position(prog.param[pc], st.sentence.lineBreaks, st.wordPos, st.wordEnd):
+            st.codePos = prog.next[pc]
+            return
+        self.backtrack(st)
+
+    def op_ref(self, st: "MatchState", pc):
+        prog = self.program
+        m_start, m_end = st.matches[prog.param[pc]]  # 获得匹配结果
+        l = m_end - m_start
+        if not prog.flags[pc] & FLAG_RTL:
+            if l > st.wordEnd - st.wordPos:
+                self.backtrack(st)
+                return
+            pos = st.wordPos
+        else:
+            if l > st.wordPos - 0:
+                self.backtrack(st)
+                return
+            pos = st.wordPos - l
+
+        step_ = 1
+        if prog.flags[pc] & FLAG_REVERSED:
+            step_ = -1
+            m_start, m_end = m_end - 1, m_start - 1
+        input_lst = st.inputLst
+        for m_i in range(m_start, m_end, step_):
+            # 判断字典内容是否相同，old_w来源于匹配串
+            if input_lst[m_i] != input_lst[pos]:
+                self.backtrack(st)
+                return
+            pos += 1
+
+        st.wordPos = pos
+        st.codePos = prog.next[pc]
+
+    def backtrack(self, st: "MatchState"):  # codepos会变，wordpos不一定
+        prog = self.program
+        op = prog.op
+        ts = st.trackStack
+        ps = st.paramStack
+        while ts:
+            codepos = ts.pop()
+            st.steps += 1
+            t = op[codepos]
+            if t == CodeType.Alt:
+                st.wordPos = ts[-2]  # 恢复匹配串位置
+                back_time = ts[-1] + 1
+                ind = prog.branchStart[codepos] + back_time
+                if ind < prog.branchStart[codepos + 1]:
+                    ts[-1] = back_time
+                    ts.append(codepos)
+                    st.codePos = prog.branches[ind]
+                    return
+                del ts[-2:]
+            elif t == CodeType.SetLoop:
+                cur = ts[-1]
+                bound = ts[-2]
+                flags = prog.flags[codepos]
+                step = -1 if flags & FLAG_RTL else 1
+                guide = st.guideBits.get(codepos)
+                if flags & FLAG_LAZY:
+                    # 多消耗一个词，该词不满足条件时循环不能再延长
+                    _, _, leaf_type, leaf_param = prog.runs[prog.param[codepos]]
+                    bits = None
+                    if leaf_type == CodeType.DynamicWord:
+                        bits = st.predBits[leaf_param]
+                    elif leaf_type == CodeType.DynamicWordSet:
+                        bits = st.setBits[leaf_param]
+                    if guide is not None:
+                        p = guide.find(1, cur + 1, bound + 1)
+                        if p < 0 or (bits is not None and bits.find(0, cur, p) >= 0):
+                            del ts[-2:]
+                            continue
+                        cur = p
                     else:
-                        self.backtrack()
-                        continue
-                else:
-                    break
-
-            elif code.t == CodeType.Ref:
-                ref_id = code.params.get("ref_id")
-                isRevered = code.params.get("isReversed")
-                m_start, m_end = self.matches[ref_id]  # 获得匹配结果
-                l = m_end - m_start
-                if not code.RightToLeft:
-                    if l > self.wordEnd - self.wordPos:
-                        self.backtrack()
+                        if bits is not None and not bits[cur - 1 if step < 0 else cur]:
+                            del ts[-2:]
+                            continue
+                        cur += step
+                elif guide is not None:
+                    cur = guide.rfind(1, bound, cur)
+                    if cur < 0:
+                        del ts[-2:]
                         continue
-                    pos = self.wordPos
                 else:
-                    if l > self.wordPos - 0:
-                        self.backtrack()
-                        continue
-                    pos = self.wordPos - (m_end - m_start)
-
-                ok = True
-                step_ = 1
-                if isRevered:
-                    step_ = -1
-                    m_start, m_end = m_end - 1, m_start - 1
-                for m_i in range(m_start, m_end, step_):
-                    old_w = self.get_word(m_i)  # 来源于匹配串
-                    new_w = self.get_word(pos)
-                    pos += 1
-
-                    if old_w != new_w:  # 判断字典内容是否相同
-                        ok = False
-                        break
-
-                if not ok:
-                    self.backtrack()
-                    continue
-
-                self.wordPos = pos
-                self.goto(code.arg[0])
-                continue
-
-        return False
-
-    def backtrack(self):  # codepos会变，wordpos不一定
-        while not self.track_empty():
-            codepos, back_time, codeparams = self.track_pop()
-            back_time += 1
-            code = self.codes[codepos]
-            self.goto(codepos)
-            if code.t == CodeType.Alt:
-                (wordpos,) = codeparams  # 恢复匹配串位置
-                self.word_to(wordpos)
-                if back_time >= len(code.arg):
-                    continue
+                    cur -= step
+                if cur == bound:
+                    del ts[-2:]
                 else:
-                    self.track_push(back_time, [wordpos])
-                    self.goto(code.arg[back_time])
-                    break
+                    ts[-1] = cur
+                    ts.append(codepos)
+                st.wordPos = cur
+                st.codePos = prog.next[codepos]
+                return
             # 以下指令加入回溯的主要目的是为了恢复paramStack状态
-            elif code.t == CodeType.SetMark:
-                self.param_pop()  # 清空指令状态记录
-                continue  # 匹配失败，继续回溯
-
-            elif code.t == CodeType.CaptureMark:
-                cap_id, param = codeparams
-                self.param_push(param)  # 恢复至setmark的param和track状态
-                if self.matches.get(cap_id):
-                    del self.matches[cap_id]
-                continue  # 匹配失败，继续回溯
-
-            elif code.t == CodeType.SetJump:
-                self.param_pop()
-                continue  # 匹配失败，继续回溯
-
-            elif code.t == CodeType.ForeJump:
-                (param,) = codeparams
-                self.param_push(param)  # 恢复至刚执行至setjump时的状态
-                continue  # 匹配失败，继续回溯
-
-    # 从wordstart位置的字符开始匹配
-    def init_state(self, input_lst, wordstart):
-        self.wordStart = wordstart
-        self.wordEnd = len(input_lst)
-        self.paramStack = []
-        self.trackStack = []
-        self.wordPos = self.wordStart
-        self.matches = {}
-        self.inputLst = input_lst
+            elif (
+                t == CodeType.SetMark
+                or t == CodeType.SetJump
+                or t == CodeType.RepeatStart
+            ):
+                del ps[-3:]  # 清空指令状态记录，匹配失败，继续回溯
+            elif t == CodeType.CaptureMark:
+                cap_id = ts.pop()
+                ps += (ts.pop(), -1, -1)  # 恢复至setmark的param和track状态
+                st.restore_capture(cap_id, ts[-2], ts[-1])
+                del ts[-2:]
+            elif t == CodeType.ForeJump:
+                k = ts.pop() * 3
+                for i in range(len(ts) - k, len(ts), 3):
+                    st.restore_capture(ts[i], ts[i + 1], ts[i + 2])
+                del ts[len(ts) - k :]
+            elif t == CodeType.RepeatCheck:
+                mode = ts.pop()
+                pos = ts.pop()
+                s0 = ts.pop()
+                c0 = ts.pop()
+                if mode == LOOP_UNDO:
+                    ps[-3] = c0
+                    ps[-2] = s0
+                elif mode == LOOP_UNDO_EXIT:
+                    ps += (c0, s0, -1)
+                elif mode == LOOP_EXIT:
+                    del ps[-3:]
+                    ts += (c0, s0, pos, LOOP_UNDO_EXIT, codepos)
+                    st.wordPos = pos
+                    st.codePos = prog.branches[prog.branchStart[codepos] + 1]
+                    return
+                else:  # LOOP_ITER
+                    ps += (c0 + 1, pos, -1)
+                    ts += (c0, s0, pos, LOOP_UNDO, codepos)
+                    st.wordPos = pos
+                    st.codePos = prog.branches[prog.branchStart[codepos]]
+                    return
+        # 回溯栈为空，没有可尝试的分支，跳到最后一条Stop指令结束当前起点
+        st.codePos = -1
 
-    def run(self, input_lst: list, wordstart, DEBUG=False):
-        self.init_state(input_lst, wordstart)
-        ok = self.execute(DEBUG)
-        if not ok or len(self.matches.keys()) == 0:
-            return None
+    def group_spans(self, st: MatchState) -> Dict[Text, List[int]]:
         res = {}
         for ind, group_name in self.matchesInfo.items():
-            res[group_name] = self.matches[ind]
+            # 未参与匹配的分组不输出
+            if ind in st.matches:
+                res[group_name] = list(st.matches[ind])
         return res
 
+    # 只尝试以wordstart开头的匹配
+    # max_steps/deadline为执行预算，用尽时抛出BudgetExhausted；传入state时沿用state上的预算
+    def run(
+        self,
+        input_lst: list,
+        wordstart,
+        DEBUG=False,
+        state=None,
+        max_steps=None,
+        deadline=None,
+    ):
+        st = state if state is not None else self.acquire_state()
+        try:
+            if state is None:
+                st.set_budget(max_steps, deadline)
+            st.reset(input_lst, wordstart)
+            ok = self.execute(st, DEBUG)
+            if not ok or not st.matched():
+                return None
+            return self.group_spans(st)
+        finally:
+            if state is None:
+                self.release_state(st)
+
+    # 只复制区间，词对象在访问分组时才切片
+    def make_match(self, st: MatchState) -> Match:
+        spans = {}
+        for ind, span in st.matches.items():
+            spans[ind] = (span[0], span[1])
+        return Match(
+            inputLst=st.inputLst,
+            pos=st.wordStart,
+            spans=spans,
+            groupsInfo=self.matchesInfo,
+            groupIndex=self.groupIndex,
+        )
+
+    # 从wordstart开始查找最左侧的匹配，起点的推进在execute内部完成
+    def search(
+        self,
+        input_lst: list,
+        wordstart=0,
+        DEBUG=False,
+        state=None,
+        max_steps=None,
+        deadline=None,
+    ) -> Optional[Match]:
+        if wordstart >= len(input_lst):
+            return None
+        st = state if state is not None else self.acquire_state()
+        try:
+            if state is None:
+                st.set_budget(max_steps, deadline)
+            st.reset(input_lst, wordstart)
+            ok = self.execute(st, DEBUG, search=True)
+            if not ok or not st.matched():
+                return None
+            return self.make_match(st)
+        finally:
+            if state is None:
+                self.release_state(st)
+
+    # 从左到右依次产出匹配，默认下次从上次匹配的结尾继续，结果互不重叠
+    # overlapped=True时从上次匹配起点的下一位置继续，每个起点最多一个结果
+    # 执行预算由所有结果共用
+    def finditer(
+        self,
+        input_lst: list,
+        wordstart=0,
+        overlapped=False,
+        DEBUG=False,
+        max_steps=None,
+        deadline=None,
+    ) -> Iterator[Match]:
+        st = self.acquire_state()
+        try:
+            st.set_budget(max_steps, deadline)
+            i = wordstart
+            while i < len(input_lst):
+                m = self.search(input_lst, i, DEBUG, state=st)
+                if m is None:
+                    return
+                start = m.pos
+                end = m.end()
+                yield m
+                if overlapped or end <= start:  # 空匹配时向后移动一位
+                    i = start + 1
+                else:
+                    i = end
+        finally:
+            self.release_state(st)
+
     def groups_info(self):
         lst = [""] * len(self.matchesInfo.keys())
         for ind, group_name in self.matchesInfo.items():
@@ -512,7 +1081,16 @@ class Runner:
         return lst
 
     def __repr__(self):
-        fields_filters = ["codes", "inputLst"]
+        fields_filters = [
+            "codes",
+            "statePool",
+            "program",
+            "ops",
+            "tracingRunner",
+            "featureFilter",
+            "literalScanner",
+            "firstSet",
+        ]
         fields_expr = [
             f"{f.name}={getattr(self, f.name)}"
             for f in fields(self)
@@ -520,3 +1098,34 @@ class Runner:
         ]
         fields_expr = "(" + ",".join(fields_expr) + ")"
         return f"Runner{fields_expr}"
+
+
+# DEBUG模式的执行器，每条指令执行前打印指令和栈，动态词匹配失败时打印原因
+@dataclass(repr=False)
+class TracingRunner(Runner):
+    def make_ops(self) -> List[Callable[["MatchState", int], Any]]:
+        ops = super().make_ops()
+        return [self.traced(op) for op in ops]
+
+    def tracer(self) -> "Runner":
+        return self
+
+    def traced(self, op):
+        def trace(st: "MatchState", pc):
+            code = self.codes[pc]
+            word = None
+            if 0 <= st.wordPos < st.wordEnd:
+                word = st.inputLst[st.wordPos]
+            print(
+                f"code_type:{CodeNames[code.t]} ",
+                f"wordpos:{st.wordPos} ",
+                f"word:{word}",
+            )
+            print("trackStack:", st.trackStack)
+            print("paramStack:", st.paramStack)
+            print("------------")
+            if word is not None and code.t == CodeType.DynamicWord:
+                is_dynamic_word_match(code.wordn, word, True)
+            return op(st, pc)
+
+        return trace
@@ -0,0 +1,346 @@
+from dataclasses import dataclass, field
+from array import array
+import sys
+import threading
+from typing import List, Dict, Any, Text
+
+try:
+    import numpy as np
+except ImportError:  # 没有NumPy时逐词计算谓词
+    np = None
+
+# 句子的编码形式，每个输入只构建一次，叶指令只读取编码后的列
+# 词形字符串驻留；词性字母、词性子类编为位图；构词模式、语义类编为整数编号
+
+
+# 特征编号表中各项数目之和的上限，超出后换用新表，与DFA_CACHE_SIZE类似
+# 句子和谓词各自引用编码时使用的表，换表不影响已编码的句子
+FEATURE_TABLE_SIZE = 100000
+
+
+# 进程级的特征编号表，只增不减，由current_features在超出上限时整体替换
+@dataclass
+class FeatureTable:
+    posBits: Dict[Text, int] = field(default_factory=dict)  # 词性字母 => 位
+    pos2Bits: Dict[Text, int] = field(default_factory=dict)  # 词性+词性子类 => 位
+    posMasks: Dict[Text, int] = field(default_factory=dict)  # 词性字符串 => 位图
+    pos2Masks: Dict[Text, int] = field(default_factory=dict)  # 词性子类字符串 => 位图
+    structIds: Dict[Text, int] = field(default_factory=dict)
+    semanticIds: Dict[Text, int] = field(default_factory=dict)
+    semantics: List[Text] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def pos_bit(self, letter) -> int:
+        bit = self.posBits.get(letter)
+        if bit is None:
+            with self.lock:
+                bit = self.posBits.setdefault(letter, 1 << len(self.posBits))
+        return bit
+
+    def pos2_bit(self, key) -> int:
+        bit = self.pos2Bits.get(key)
+        if bit is None:
+            with self.lock:
+                bit = self.pos2Bits.setdefault(key, 1 << len(self.pos2Bits))
+        return bit
+
+    # 词性字符串中出现的所有字母
+    def pos_mask(self, pos) -> int:
+        mask = self.posMasks.get(pos)
+        if mask is None:
+            mask = 0
+            for letter in pos:
+                mask |= self.pos_bit(letter)
+            self.posMasks[pos] = mask
+        return mask
+
+    # 词性子类字符串中所有相邻的两个字符，如"v①n②"包含"v①"、"①n"、"n②"
+    def pos2_mask(self, pos2) -> int:
+        mask = self.pos2Masks.get(pos2)
+        if mask is None:
+            mask = 0
+            for i in range(len(pos2) - 1):
+                mask |= self.pos2_bit(pos2[i : i + 2])
+            self.pos2Masks[pos2] = mask
+        return mask
+
+    def struct_id(self, struct) -> int:
+        sid = self.structIds.get(struct)
+        if sid is None:
+            with self.lock:
+                sid = self.structIds.setdefault(struct, len(self.structIds))
+        return sid
+
+    def semantic_id(self, semantic) -> int:
+        sid = self.semanticIds.get(semantic)
+        if sid is None:
+            with self.lock:
+                sid = self.semanticIds.get(semantic)
+                if sid is None:
+                    sid = self.semanticIds[semantic] = len(self.semantics)
+                    self.semantics.append(semantic)
+        return sid
+
+    def size(self) -> int:
+        return (
+            len(self.posBits)
+            + len(self.pos2Bits)
+            + len(self.posMasks)
+            + len(self.pos2Masks)
+            + len(self.structIds)
+            + len(self.semanticIds)
+        )
+
+
+FEATURES = FeatureTable()
+features_lock = threading.Lock()
+
+
+# 编码句子时使用的特征表，超出FEATURE_TABLE_SIZE时换用新表，旧表随引用它的句子释放
+def current_features() -> FeatureTable:
+    global FEATURES
+    features = FEATURES
+    if features.size() > FEATURE_TABLE_SIZE:
+        with features_lock:
+            if FEATURES is features:
+                FEATURES = FeatureTable()
+            features = FEATURES
+    return features
+
+
+class EncodedSentence:
+    __slots__ = (
+        "words",
+        "shapes",
+        "lengths",
+        "posMasks",
+        "pos2Masks",
+        "structIds",
+        "semanticIds",
+        "lineBreaks",
+        "features",
+        "cache",
+    )
+
+    def __init__(self, words: List[Dict[Text, Any]]):
+        self.features = features = current_features()
+        self.words = words
+        self.shapes = shapes = [sys.intern(w.get("shape", "")) for w in words]
+        self.lengths = array("i", [len(s) for s in shapes])
+        self.posMasks = [features.pos_mask(w.get("pos", "")) for w in words]
+        self.pos2Masks = [features.pos2_mask(w.get("pos2", "")) for w in words]
+        self.structIds = array("i", [features.struct_id(w.get("struct", "")) for w in words])
+        self.semanticIds = array(
+            "i", [features.semantic_id(w.get("semantic", "")) for w in words]
+        )
+        # 位置限定^$使用的换行标记
+        self.lineBreaks = bytearray(w.get("cixing", "") == "\n" for w in words)
+        # 与该句子相关的预计算数据，如程序的谓词取值
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, i):
+        return self.words[i]
+
+    def __repr__(self):
+        return f"EncodedSentence({self.shapes})"
+
+
+# 动态词谓词编译为整数和位图比较，与is_dynamic_word_match一致
+# 位和编号随特征表变化，由bind在句子使用的特征表上计算
+class WordPredicate:
+    __slots__ = ("node", "pos2Key", "length", "semanticTag", "bound")
+
+    def __init__(self, node):
+        self.node = node
+        # 词性子类按"词性+子类"两个字符在pos2中出现来判断，其它长度直接比较字符串
+        self.pos2Key = node.pos + node.pos2 if node.pos2 != "" else ""
+        self.length = node.length
+        self.semanticTag = node.semantic_tag
+        self.bound = None
+
+    # 最近一次使用的特征表上的谓词，特征表替换后重新计算
+    def bind(self, features: FeatureTable) -> "BoundPredicate":
+        bound = self.bound
+        if bound is None or bound.features is not features:
+            bound = self.bound = BoundPredicate(self, features)
+        return bound
+
+    def test(self, enc: EncodedSentence, i) -> bool:
+        return self.bind(enc.features).test(enc, i)
+
+    def __repr__(self):
+        return repr(self.node)
+
+
+class BoundPredicate:
+    __slots__ = (
+        "node",
+        "features",
+        "posBit",
+        "pos2Bit",
+        "pos2Key",
+        "length",
+        "structId",
+        "semanticTag",
+        "semanticHits",
+    )
+
+    def __init__(self, pred: WordPredicate, features: FeatureTable):
+        node = pred.node
+        self.node = node
+        self.features = features
+        self.posBit = features.pos_bit(node.pos) if len(node.pos) == 1 else 0
+        self.pos2Key = pred.pos2Key
+        self.pos2Bit = features.pos2_bit(self.pos2Key) if len(self.pos2Key) == 2 else 0
+        self.length = pred.length
+        self.structId = (
+            features.struct_id(node.word_struct) if node.word_struct != "" else -1
+        )
+        self.semanticTag = pred.semanticTag
+        # 语义类编号 => 是否包含semanticTag
+        self.semanticHits = {}
+
+    def semantic_hit(self, sid) -> bool:
+        hit = self.semanticHits.get(sid)
+        if hit is None:
+            hit = self.semanticHits[sid] = (
+                self.semanticTag in self.features.semantics[sid]
+            )
+        return hit
+
+    def test(self, enc: EncodedSentence, i) -> bool:
+        if self.pos2Key != "":
+            if self.pos2Bit:
+                if not enc.pos2Masks[i] & self.pos2Bit:
+                    return False
+            elif self.pos2Key not in enc.words[i].get("pos2", ""):
+                return False
+        if self.posBit:
+            if not enc.posMasks[i] & self.posBit:
+                return False
+        elif self.node.pos != "" and self.node.pos not in enc.words[i].get("pos", ""):
+            return False
+        if self.length != -1 and self.length != enc.lengths[i]:
+            return False
+        if self.structId != -1 and self.structId != enc.structIds[i]:
+            return False
+        # 语义类匹配
+        if self.semanticTag != "" and self.semantic_hit(enc.semanticIds[i]):
+            return False
+        return True
+
+
+# 以下条件无法在编码列上向量化，整个谓词逐词计算
+def vectorizable(pred: BoundPredicate) -> bool:
+    if pred.pos2Key != "" and not pred.pos2Bit:
+        return False
+    if pred.node.pos != "" and not pred.posBit:
+        return False
+    return True
+
+
+# 位图超过63位时无法放入int64，该列不向量化
+def mask_column(masks):
+    if max(masks, default=0) >> 63:
+        return None
+    return np.array(masks, dtype=np.int64)
+
+
+# 谓词的位同样要放入int64才能与列按位与，否则该谓词逐词计算
+def fits_int64(pred: BoundPredicate) -> bool:
+    return not (pred.posBit >> 63 or pred.pos2Bit >> 63)
+
+
+# 一批句子上所有谓词的取值，返回 句子 => 谓词 => 每个词一个0/1的bytearray
+# 有NumPy时把整批句子的编码列拼接后按列比较，否则逐词调用BoundPredicate.test
+def evaluate_predicates(
+    preds: List[WordPredicate], sentences: List[EncodedSentence]
+) -> List[List[bytearray]]:
+    if np is None or not preds:
+        res = []
+        for enc in sentences:
+            bound = [pred.bind(enc.features) for pred in preds]
+            res.append(
+                [bytearray(b.test(enc, i) for i in range(len(enc))) for b in bound]
+            )
+        return res
+    # 编码时使用不同特征表的句子分开计算
+    features = sentences[0].features if sentences else None
+    if any(enc.features is not features for enc in sentences):
+        groups = {}
+        for ind, enc in enumerate(sentences):
+            groups.setdefault(id(enc.features), []).append(ind)
+        res = [None] * len(sentences)
+        for inds in groups.values():
+            group = evaluate_predicates(preds, [sentences[ind] for ind in inds])
+            for ind, bits in zip(inds, group):
+                res[ind] = bits
+        return res
+    total = sum(len(enc) for enc in sentences)
+    pos_col = mask_column([m for enc in sentences for m in enc.posMasks])
+    pos2_col = mask_column([m for enc in sentences for m in enc.pos2Masks])
+    lengths = np.array([n for enc in sentences for n in enc.lengths], dtype=np.int64)
+    struct_ids = np.array([n for enc in sentences for n in enc.structIds], dtype=np.int64)
+    semantic_ids = np.array(
+        [n for enc in sentences for n in enc.semanticIds], dtype=np.int64
+    )
+    rows = []
+    for pred in (pred.bind(features) for pred in preds):
+        if (
+            not vectorizable(pred)
+            or not fits_int64(pred)
+            or (pred.posBit and pos_col is None)
+            or (pred.pos2Bit and pos2_col is None)
+        ):
+            ok = np.fromiter(
+                (pred.test(enc, i) for enc in sentences for i in range(len(enc))),
+                dtype=bool,
+                count=total,
+            )
+            rows.append(ok.tobytes())
+            continue
+        ok = np.ones(total, dtype=bool)
+        if pred.pos2Bit:
+            ok &= (pos2_col & pred.pos2Bit) != 0
+        if pred.posBit:
+            ok &= (pos_col & pred.posBit) != 0
+        if pred.length != -1:
+            ok &= lengths == pred.length
+        if pred.structId != -1:
+            ok &= struct_ids == pred.structId
+        if pred.semanticTag != "" and total:
+            # 语义类编号 => 是否包含semanticTag，查表后取反
+            hits = np.fromiter(
+                (pred.semantic_hit(sid) for sid in range(int(semantic_ids.max()) + 1)),
+                dtype=bool,
+            )
+            ok &= ~hits[semantic_ids]
+        rows.append(ok.tobytes())
+    res = []
+    start = 0
+    for enc in sentences:
+        end = start + len(enc)
+        res.append([bytearray(row[start:end]) for row in rows])
+        start = end
+    return res
+
+
+# 多个谓词的或
+def union_bits(rows: List[bytearray], n) -> bytearray:
+    if not rows:
+        return bytearray(n)
+    if np is not None:
+        ok = np.zeros(n, dtype=np.uint8)
+        for row in rows:
+            ok |= np.frombuffer(row, dtype=np.uint8)
+        return bytearray(ok.tobytes())
+    return bytearray(max(col) for col in zip(*rows))
+
+
+def encode_sentence(words) -> EncodedSentence:
+    if isinstance(words, EncodedSentence):
+        return words
+    return EncodedSentence(words)
@@ -19,6 +19,8 @@ from .tree import (
     DynamicWordNode,
     DynamicWordSetNode,
     SthNode,
+    length_bounds,
+    unroll_repeats,
 )
 
 
@@ -34,6 +36,12 @@ class CodeType(IntEnum):
     ForeJump = 9  # 结束当前alt分支
     BackJump = 10  # 结束当前所有alt分支，回溯trackpos
 
+    # 计数循环{m,n}：RepeatStart压入计数记录，RepeatCheck在每次迭代前后决定继续或退出
+    RepeatStart = 11
+    RepeatCheck = 12
+    # 单个词的循环：一次消耗连续满足条件的词，只记录一个回溯帧
+    SetLoop = 13
+
     Stop = 49
 
     # leaf node
@@ -67,6 +75,9 @@ CodeNames = {
     CodeType.ForeJump: "ForeJump",
     # 恢复至最近的SetJump指令标记的状态，进入回溯
     CodeType.BackJump: "BackJump",
+    CodeType.RepeatStart: "RepeatStart",
+    CodeType.RepeatCheck: "RepeatCheck",
+    CodeType.SetLoop: "SetLoop",
     CodeType.Stop: "Stop",
     # leaf node
     CodeType.Any: "Any",
@@ -94,7 +105,8 @@ class Code:
         return replace(self)
 
 
-def dump_codes(codelst):
+# before为优化前的指令数，给出时在末尾打印优化前后的指令数
+def dump_codes(codelst, before=None):
     res_str = ""
     back_code_type = [
         CodeType.Alt,
@@ -102,6 +114,9 @@ def dump_codes(codelst):
         CodeType.CaptureMark,
         CodeType.SetJump,
         CodeType.ForeJump,
+        CodeType.RepeatStart,
+        CodeType.RepeatCheck,
+        CodeType.SetLoop,
     ]
     for _code in codelst:
         codemark = "*" if _code.t in back_code_type else " "
@@ -125,20 +140,32 @@ def dump_codes(codelst):
                 if _code.t == CodeType.DynamicWordSet:
                     word_list = [str(w) for w in _code.wordn.word_list]
                     res_str += "\t" + "[" + ",".join(word_list) + "]"
+            if _code.t == CodeType.SetLoop and _code.wordn is not None:
+                res_str += "\t" + str(_code.wordn)
             if _code.params is not None:
                 res_str += f"\t{_code.params}"
             res_str += f" -> {_code.arg}\n"
         else:
             print("dumpcode error\n")
+    if before is not None:
+        res_str += f"codes: {before} -> {len(codelst)}\n"
     return res_str
 
 
+# 只消耗一个词的叶指令，它们的循环可以生成SetLoop
+SINGLE_TOKEN_TYPES = (CodeType.Any, CodeType.DynamicWord, CodeType.DynamicWordSet)
+
+
 @dataclass
 class TreeParser:
     codestack: List[Code] = None
     paramStack: List[Any] = None
     auto_codeid: int = -1
     groupsInfo: Dict[int, Text] = None
+    # 是否生成计数循环和SetLoop指令
+    loopOps: bool = True
+    # loopOps为False时，循环体可以不消耗词的*、+仍生成计数循环指令，供Pike VM判断空迭代
+    emptyLoops: bool = False
 
     def printCodes(self):
         print(dump_codes(self.codestack))
@@ -150,6 +177,12 @@ class TreeParser:
         self.groupsInfo = {}
         return self
 
+    # 把codes中跳向old_ids的分支改为跳向new_id
+    def redirect(self, codes, old_ids, new_id):
+        for code in codes:
+            if code.arg is not None:
+                code.arg = [new_id if a in old_ids else a for a in code.arg]
+
     # curIndex既表示下一个要遍历的子树索引，又表示第几次遍历node
     # curIndex=0表示下一个要遍历node的第一个子孩子，同时表示第一次遍历到node
     # emit(node)用于生成node对应的指令，curIndex表示下一次指令会生成curIndex子节点的指令
@@ -162,6 +195,8 @@ class TreeParser:
             return True
 
         # 分支选择
+        # 每段指令的出口都跳向该段结束时的auto_codeid+1，段的入口为段中的第一条指令
+        # 生成循环等结构时按id改写前驱和出口，不能假设codestack[-1]是唯一的出口
         elif isinstance(node, AlternateNode):
             if curIndex == 0:
                 alt_pos = len(self.codestack)
@@ -171,16 +206,26 @@ class TreeParser:
                 self.paramStack.append(alt_pos)
                 return True
             elif 0 < curIndex < len(node.subs):
+                # 前一个分支的出口与下一个分支的入口id相同，下一个分支以循环开头时会被当作循环的前驱改写
+                # 先改为Alt专用的负数占位id，遍历结束时再跳向Alternate之后
+                alt_pos = self.paramStack[-curIndex]
+                exit_id = -self.codestack[alt_pos].id - 2
+                self.redirect(
+                    self.codestack[alt_pos + 1 :], [self.auto_codeid + 1], exit_id
+                )
+                # 前一个分支的结束位置
                 self.paramStack.append(len(self.codestack) - 1)
                 return True
             else:  # 遍历结束
                 code_ends = self.paramStack[-len(node.subs) + 1 :]
                 self.paramStack = self.paramStack[: -len(node.subs) + 1]
                 alt_pos = self.paramStack.pop()
+                exit_id = -self.codestack[alt_pos].id - 2
+                self.redirect(
+                    self.codestack[alt_pos + 1 :], [exit_id], self.auto_codeid + 1
+                )
                 for pos in code_ends:
-                    self.codestack[pos].arg = [self.auto_codeid + 1]
                     self.codestack[alt_pos].arg.append(self.codestack[pos + 1].id)
-                self.codestack[-1].arg = [self.auto_codeid + 1]
                 return True
         # 量词限定
         elif isinstance(node, RepeatNode):
@@ -197,23 +242,49 @@ class TreeParser:
                 unit = self.codestack[pos:]
                 self.codestack = self.codestack[:pos]
                 m, n, is_nongreedy = self.paramStack.pop()
-                if m == 0 and n == INTMAX:  # star
+                # 前驱跳向单元中id最小的指令，单元的入口为unit[0]，两者不一定相同
+                entry_ids = [unit[0].id, min(code.id for code in unit)]
+                if self.loopOps and len(unit) == 1 and unit[0].t in SINGLE_TOKEN_TYPES:
+                    # 循环体是单个词，SetLoop沿用叶指令的id和出口
+                    leaf = unit[0]
+                    self.codestack.append(
+                        Code(
+                            t=CodeType.SetLoop,
+                            arg=leaf.arg,
+                            params={
+                                "min": m,
+                                "max": n,
+                                "is_nongreedy": is_nongreedy,
+                                "leaf_type": leaf.t,
+                            },
+                            wordn=leaf.wordn,
+                            RightToLeft=leaf.RightToLeft,
+                            id=leaf.id,
+                        )
+                    )
+                    return True
+                # 循环体可以不消耗词时，Alt循环在回溯虚拟机上会在同一位置无限迭代，
+                # 改用计数循环，由RepeatCheck在空迭代后退出
+                nullable = length_bounds(node.sub)[0] == 0 and (
+                    self.loopOps or self.emptyLoops
+                )
+                if m == 0 and n == INTMAX and not nullable:  # star
                     alt_pos = len(self.codestack)
                     self.auto_codeid += 1
                     alt_id = self.auto_codeid
-                    self.codestack[-1].arg = [alt_id]
+                    # 单元的出口已经跳向alt_id
+                    self.redirect(self.codestack, entry_ids, alt_id)
                     self.codestack.append(
                         Code(t=CodeType.Alt, arg=[unit[0].id], id=self.auto_codeid)
                     )
                     self.codestack += unit
-                    unit[-1].arg = [alt_id]
                     self.codestack[alt_pos].arg.append(self.auto_codeid + 1)  # 跳出循环
                     if is_nongreedy:
                         self.codestack[alt_pos].arg.reverse()
                     return True
-                elif m == 1 and n == INTMAX:  # plus
+                elif m == 1 and n == INTMAX and not nullable:  # plus
                     unit_begin = unit[0].id
-                    self.codestack[-1].arg = [unit_begin]
+                    self.redirect(self.codestack, entry_ids, unit_begin)
                     self.codestack += unit
                     alt_pos = len(self.codestack)
                     self.auto_codeid += 1
@@ -231,48 +302,36 @@ class TreeParser:
                     alt_pos = len(self.codestack)
                     self.auto_codeid += 1
                     alt_id = self.auto_codeid
-                    self.codestack[-1].arg = [alt_id]
+                    self.redirect(self.codestack, entry_ids, alt_id)
                     self.codestack.append(
                         Code(t=CodeType.Alt, arg=[unit[0].id, alt_id + 1], id=alt_id)
                     )
                     self.codestack += unit
-                    unit[-1].arg = [self.auto_codeid + 1]
+                    # 单元的出口跳过Alt
+                    self.redirect(unit, [alt_id], alt_id + 1)
                     if is_nongreedy:
                         self.codestack[alt_pos].arg.reverse()
                     return True
-                elif 1000 > n >= m >= 1:
-                    unit_len = len(unit)
-                    for j in range(m):
-                        new_unit = [code.copy() for code in unit]
-                        for i in range(unit_len):
-                            new_unit[i].id += j * len(unit)
-                        self.codestack[-1].arg = [new_unit[0].id]
-                        self.codestack += new_unit
-                    self.auto_codeid = self.codestack[-1].id
-                    self.codestack[-1].arg = [self.auto_codeid + 1]
-                    if n > m:
-                        altpos = len(self.codestack)
-                        self.auto_codeid += 1
-                        self.codestack.append(
-                            Code(
-                                t=CodeType.Alt,
-                                arg=[self.auto_codeid + 1],
-                                id=self.auto_codeid,
-                            )
+                else:  # {m,n}，用计数循环指令，指令数与m、n无关
+                    # 单元的出口跳向auto_codeid+1，先分配RepeatCheck使出口直接回到它
+                    self.auto_codeid += 1
+                    check_id = self.auto_codeid
+                    self.auto_codeid += 1
+                    start_id = self.auto_codeid
+                    self.redirect(self.codestack, entry_ids, start_id)
+                    self.codestack.append(
+                        Code(t=CodeType.RepeatStart, arg=[check_id], id=start_id)
+                    )
+                    self.codestack.append(
+                        Code(
+                            t=CodeType.RepeatCheck,
+                            arg=[unit[0].id, start_id + 1],  # 进入循环体，退出循环
+                            params={"min": m, "max": n, "is_nongreedy": is_nongreedy},
+                            id=check_id,
                         )
-                        for j in range(n - m):
-                            new_unit = [code.copy() for code in unit]
-                            for i in range(len(new_unit)):
-                                self.auto_codeid += 1
-                                new_unit[i].id = self.auto_codeid
-                            self.codestack += new_unit
-                            self.codestack[-1].arg = [self.auto_codeid + 1]
-                            self.codestack[altpos].arg.append(self.auto_codeid + 1)
-                        if is_nongreedy:
-                            self.codestack[altpos].arg.reverse()
+                    )
+                    self.codestack += unit
                     return True
-                else:
-                    return False
         # 结果捕获
         elif isinstance(node, CaptureNode):
             if curIndex == 0:
@@ -281,6 +340,7 @@ class TreeParser:
                     Code(
                         t=CodeType.SetMark,
                         arg=[self.auto_codeid + 1],
+                        params={"cap_id": node.index},
                         id=self.auto_codeid,
                     )
                 )
@@ -310,20 +370,24 @@ class TreeParser:
                 test_code = self.codestack[pos:]
                 self.codestack = self.codestack[:pos]
                 is_positive = node.is_positive
+                # 断言前的指令跳向断言体的入口，断言体的出口跳向断言体之后的id
+                # 断言体以循环结尾时，最后一条指令是循环的回跳，不能直接改写codestack[-1]
+                entry_ids = [test_code[0].id, min(code.id for code in test_code)]
+                exit_id = self.auto_codeid + 1
+                # 断言体至少消耗的词数，断言方向上剩余的词不够时断言体不可能匹配
+                min_len = length_bounds(node.sub)[0]
 
                 if is_positive:
-                    if len(self.codestack) > 0:
-                        self.codestack[-1].arg = [self.auto_codeid + 1]
+                    self.redirect(self.codestack, entry_ids, self.auto_codeid + 1)
                     self.auto_codeid += 1
-                    self.codestack.append(
-                        Code(
-                            t=CodeType.SetJump,
-                            id=self.auto_codeid,
-                            arg=[test_code[0].id],
-                        )
+                    setjump = Code(
+                        t=CodeType.SetJump,
+                        id=self.auto_codeid,
+                        arg=[test_code[0].id],
                     )
+                    self.codestack.append(setjump)
                     self.codestack += test_code
-                    self.codestack[-1].arg = [self.auto_codeid + 1]
+                    self.redirect(test_code, [exit_id], self.auto_codeid + 1)
                     self.auto_codeid += 1
                     self.codestack.append(
                         Code(
@@ -332,26 +396,33 @@ class TreeParser:
                             arg=[self.auto_codeid + 1],
                         )
                     )
+                    # 断言的结构信息，供不回溯的执行引擎使用
+                    setjump.params = {
+                        "is_positive": True,
+                        "RightToLeft": node.RightToLeft,
+                        "test_id": test_code[0].id,
+                        "fore_id": self.auto_codeid,
+                        "min_len": min_len,
+                    }
 
                 elif not is_positive:
-                    if len(self.codestack) > 0:
-                        self.codestack[-1].arg = [self.auto_codeid + 1]
+                    self.redirect(self.codestack, entry_ids, self.auto_codeid + 1)
                     self.auto_codeid += 1
-                    self.codestack.append(
-                        Code(
-                            t=CodeType.SetJump,
-                            id=self.auto_codeid,
-                            arg=[self.auto_codeid + 1],
-                        )
+                    setjump = Code(
+                        t=CodeType.SetJump,
+                        id=self.auto_codeid,
+                        arg=[self.auto_codeid + 1],
                     )
+                    self.codestack.append(setjump)
                     alt_pos = len(self.codestack)
                     self.auto_codeid += 1
                     self.codestack.append(
                         Code(t=CodeType.Alt, arg=[test_code[0].id], id=self.auto_codeid)
                     )
                     self.codestack += test_code
-                    self.codestack[-1].arg = [self.auto_codeid + 1]
+                    self.redirect(test_code, [exit_id], self.auto_codeid + 1)
                     self.auto_codeid += 1
+                    back_id = self.auto_codeid
                     self.codestack.append(
                         Code(t=CodeType.BackJump, id=self.auto_codeid, arg=[])
                     )
@@ -364,6 +435,14 @@ class TreeParser:
                         )
                     )
                     self.codestack[alt_pos].arg.append(self.auto_codeid)
+                    setjump.params = {
+                        "is_positive": False,
+                        "RightToLeft": node.RightToLeft,
+                        "test_id": test_code[0].id,
+                        "back_id": back_id,
+                        "fore_id": self.auto_codeid,
+                        "min_len": min_len,
+                    }
                 return True
         # leaf node
         elif isinstance(node, AnyNode):
@@ -545,11 +624,20 @@ class TreeParser:
         return self.codestack
 
 
-def tree_to_code(root):
-    tp = TreeParser().Init_state()
+# loop_ops=False时在树上展开{m,n}，生成的指令只有Alt循环，供Pike VM、DFA等引擎使用
+# empty_loops=True时循环体可以不消耗词的*、+例外，生成RepeatStart/RepeatCheck
+def tree_to_code(root, loop_ops=True, empty_loops=False):
+    if not loop_ops:
+        root = unroll_repeats(root)
+        if root is None:
+            return None, None, False
+    else:
+        # 较小的{m,n}展开后执行比计数循环的指令少
+        root = unroll_repeats(root, small=True)
+    tp = TreeParser(loopOps=loop_ops, emptyLoops=empty_loops).Init_state()
     ok = tp.ScanTree(root)
     codes = tp.Codes()
     codes.sort(key=lambda x: x.id)
     if not ok:
-        return None, False
+        return None, None, False
     return codes, tp.groups_info(), ok
@@ -21,7 +21,7 @@ from .tree import (
     NodeType,
     PositionNodeType,
 )
-from .tree import simplify_node, reverse_subnode
+from .tree import simplify_node, optimize_node, reverse_subnode
 
 
 def is_special(ch):
@@ -257,7 +257,7 @@ class RegexParser:
         while self.textpos < self.regex_length:
             ch = self.getChar()
             if ch.isdigit():
-                num += num * 10 + int(ch)
+                num = num * 10 + int(ch)
             else:
                 break
             self.moveRight(1)
@@ -696,6 +696,7 @@ def regex_to_tree(regex_raw, regex_others: Optional[Dict[Text, Any]] = None):
         return None, False
 
     tree = simplify_node(tree)
+    tree = optimize_node(tree)
     new_tree = CaptureNode(index=0, name="<global>", sub=tree)
     tree.fa = new_tree
     return new_tree, ok
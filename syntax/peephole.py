@@ -0,0 +1,169 @@
+from dataclasses import replace
+from typing import List, Dict, Set
+from .code import Code, CodeType
+
+# tree_to_code之后、交给执行引擎之前的窥孔优化，不改变匹配结果：
+# 跳转穿过Nop和只有一个分支的Alt，Alt的分支是另一个Alt时展开为它的分支，
+# 删除否定断言内的分组捕获，连续的Any合并为计数的SetLoop，删除不可达的指令后重新编号
+# 优化后仍满足：id即下标，0号为入口Alt，最后一条为Stop
+
+# SetJump中保存的指令id
+ID_PARAMS = ("test_id", "fore_id", "back_id")
+
+# 展开Alt时一个Alt最多的分支数
+ALT_FLATTEN_LIMIT = 64
+
+
+def is_passthrough(code: Code) -> bool:
+    return code.t == CodeType.Nop or (code.t == CodeType.Alt and len(code.arg) == 1)
+
+
+# 沿Nop和单分支Alt找到真正执行的指令，遇到环时停在环上
+def thread(codes: Dict[int, Code], target) -> int:
+    seen = set()
+    while target not in seen and is_passthrough(codes[target]):
+        seen.add(target)
+        target = codes[target].arg[0]
+    return target
+
+
+# Alt的分支为另一个Alt时，在同一位置依次尝试它的分支，顺序不变
+def flatten_alt(codes: Dict[int, Code], code: Code) -> List[int]:
+    res = []
+    stack = list(reversed(code.arg))
+    seen = {code.id}
+    while stack:
+        target = stack.pop()
+        inner = codes[target]
+        if (
+            inner.t == CodeType.Alt
+            and target not in seen
+            and len(res) + len(stack) + len(inner.arg) <= ALT_FLATTEN_LIMIT
+        ):
+            seen.add(target)
+            stack.extend(reversed(inner.arg))
+        else:
+            res.append(target)
+    return res
+
+
+# 否定断言成立时匹配失败，断言体内的分组捕获不会出现在结果中，SetMark/CaptureMark改为Nop
+# 被反向引用的分组保留
+def drop_negative_captures(codes: Dict[int, Code]):
+    refs = {c.params["ref_id"] for c in codes.values() if c.t == CodeType.Ref}
+    for code in list(codes.values()):
+        if code.t != CodeType.SetJump or code.params["is_positive"]:
+            continue
+        back_id = code.params["back_id"]
+        stack = [code.params["test_id"]]
+        seen = set()
+        while stack:
+            pc = stack.pop()
+            if pc in seen or pc == back_id:
+                continue
+            seen.add(pc)
+            body = codes[pc]
+            if (
+                body.t == CodeType.SetMark or body.t == CodeType.CaptureMark
+            ) and body.params["cap_id"] not in refs:
+                codes[pc] = Code(
+                    id=pc, t=CodeType.Nop, arg=body.arg, RightToLeft=body.RightToLeft
+                )
+            if body.arg:
+                stack.extend(body.arg)
+            if body.t == CodeType.SetJump:
+                stack.append(body.params["test_id"])
+
+
+def predecessors(codes: Dict[int, Code]) -> Dict[int, int]:
+    count = {}
+    for code in codes.values():
+        for a in code.arg or []:
+            count[a] = count.get(a, 0) + 1
+        if code.params is not None:
+            for key in ID_PARAMS:
+                if key in code.params:
+                    count[code.params[key]] = count.get(code.params[key], 0) + 1
+    return count
+
+
+# 连续k个同方向的Any合并为最少、最多都为k的SetLoop，中间的Any只能由前一个进入
+def merge_any_runs(codes: Dict[int, Code]):
+    count = predecessors(codes)
+    for code in list(codes.values()):
+        if code.t != CodeType.Any or code.id not in codes:
+            continue
+        run = [code]
+        while True:
+            nxt = codes[run[-1].arg[0]]
+            if (
+                nxt.t != CodeType.Any
+                or nxt.RightToLeft != code.RightToLeft
+                or count.get(nxt.id, 0) != 1
+                or nxt is code
+            ):
+                break
+            run.append(nxt)
+        if len(run) < 2:
+            continue
+        codes[code.id] = Code(
+            id=code.id,
+            t=CodeType.SetLoop,
+            arg=list(run[-1].arg),
+            params={
+                "min": len(run),
+                "max": len(run),
+                "is_nongreedy": False,
+                "leaf_type": CodeType.Any,
+            },
+            RightToLeft=code.RightToLeft,
+        )
+        for c in run[1:]:
+            del codes[c.id]
+
+
+def reachable(codes: Dict[int, Code], stop) -> Set[int]:
+    seen = {0, stop}
+    stack = [0]
+    while stack:
+        code = codes[stack.pop()]
+        targets = list(code.arg or [])
+        if code.params is not None:
+            targets += [code.params[key] for key in ID_PARAMS if key in code.params]
+        for a in targets:
+            if a not in seen:
+                seen.add(a)
+                stack.append(a)
+    return seen
+
+
+# loop_ops=False时不生成SetLoop，供Pike VM、DFA等引擎使用
+def optimize_codes(codes: List[Code], loop_ops=True) -> List[Code]:
+    stop = codes[-1].id
+    table = {code.id: replace(code, arg=list(code.arg)) for code in codes}
+    drop_negative_captures(table)
+    for code in table.values():
+        if code.arg:
+            code.arg = [thread(table, a) for a in code.arg]
+        # 0号Alt为[匹配主体, Stop]，执行引擎依赖这个结构
+        if code.t == CodeType.Alt and code.id != 0:
+            code.arg = flatten_alt(table, code)
+        if code.t == CodeType.SetJump:
+            code.params = dict(code.params, test_id=thread(table, code.params["test_id"]))
+    if loop_ops:
+        merge_any_runs(table)
+    live = reachable(table, stop)
+    ids = sorted(pc for pc in table if pc in live)
+    new_id = {pc: ind for ind, pc in enumerate(ids)}
+    res = []
+    for pc in ids:
+        code = table[pc]
+        code.id = new_id[pc]
+        code.arg = [new_id[a] for a in code.arg]
+        if code.t == CodeType.SetJump:
+            code.params = dict(code.params)
+            for key in ID_PARAMS:
+                if key in code.params:
+                    code.params[key] = new_id[code.params[key]]
+        res.append(code)
+    return res
@@ -1,5 +1,6 @@
-from dataclasses import dataclass, fields
-from typing import List, Text, Optional, Union
+import sys
+from dataclasses import dataclass, fields, replace
+from typing import List, Text, Optional, Union, Tuple
 from enum import IntEnum
 
 
@@ -312,9 +313,9 @@ def simplify_node(node):
             sub_len = len(node.subs)
             if sub_len == 0:
                 return
-            # 合并相邻Word节点
+            # 合并Concatenate中相邻的Word节点，Alternate的分支是不同的选择，不能合并
             l = 0
-            while True:
+            while type(node) == ConcatenateNode:
                 while l < sub_len and type(node.subs[l]) != WordNode:
                     l += 1
 
@@ -353,6 +354,289 @@ def simplify_node(node):
         return node
 
 
+# 在一个位置至多一种匹配方式的叶节点，可以从Alternate的分支中提出
+DETERMINISTIC_LEAVES = (
+    WordNode,
+    WordSetNode,
+    DynamicWordNode,
+    DynamicWordSetNode,
+    AnyNode,
+    PositionNode,
+)
+
+
+# 叶节点的比较键，不含父节点
+def leaf_key(node: Node):
+    if not isinstance(node, DETERMINISTIC_LEAVES):
+        return None
+    key = [type(node).__name__]
+    for f in fields(node):
+        if f.name == "fa":
+            continue
+        value = getattr(node, f.name)
+        if f.name == "word_list":
+            value = tuple(repr(w) for w in value)
+        key.append(value)
+    return tuple(key)
+
+
+def branch_items(node: Node) -> List[Node]:
+    if type(node) == ConcatenateNode:
+        return node.subs
+    if type(node) == EmptyNode:
+        return []
+    return [node]
+
+
+def make_branch(items: List[Node], fa: Node, RightToLeft) -> Node:
+    if not items:
+        return EmptyNode(fa=fa, RightToLeft=RightToLeft)
+    if len(items) == 1:
+        items[0].fa = fa
+        return items[0]
+    res = ConcatenateNode(subs=items, fa=fa, RightToLeft=RightToLeft)
+    for sub in items:
+        sub.fa = res
+    return res
+
+
+# 相邻分支的公共前缀、后缀提出到Alternate之外：vn|va => v(?:n|a)，nv|av => (?:n|a)v
+# 前缀只提出叶节点，回溯时它没有别的匹配方式，各分支的尝试顺序不变
+def factor_branches(node: AlternateNode, suffix=False) -> List[Node]:
+    def edge(items, n):
+        return leaf_key(items[-1 - n] if suffix else items[n])
+
+    res = []
+    subs = node.subs
+    i = 0
+    while i < len(subs):
+        items = branch_items(subs[i])
+        key = edge(items, 0) if items else None
+        j = i + 1
+        while key is not None and j < len(subs):
+            other = branch_items(subs[j])
+            if not other or edge(other, 0) != key:
+                break
+            j += 1
+        if j - i < 2:
+            res.append(subs[i])
+            i += 1
+            continue
+        group = [list(branch_items(sub)) for sub in subs[i:j]]
+        n = 1
+        while n < min(len(items) for items in group):
+            key = edge(group[0], n)
+            if key is None or any(edge(items, n) != key for items in group[1:]):
+                break
+            n += 1
+        if suffix:
+            common = group[0][len(group[0]) - n :]
+            rests = [items[: len(items) - n] for items in group]
+        else:
+            common = group[0][:n]
+            rests = [items[n:] for items in group]
+        alt = AlternateNode(subs=[], RightToLeft=node.RightToLeft)
+        alt.subs = [make_branch(rest, alt, node.RightToLeft) for rest in rests]
+        alt = optimize_alternate(alt)
+        items = [alt] + common if suffix else common + [alt]
+        res.append(make_branch(items, node, node.RightToLeft))
+        i = j
+    return res
+
+
+# 相邻的DynamicWord/DynamicWordSet分支合并为DynamicWordSet
+# Word分支不合并为WordSet：句末的Word可以只匹配词形的前缀，WordSet要求完整的词形
+def fold_leaves(node: AlternateNode) -> List[Node]:
+    res = []
+    for sub in node.subs:
+        prev = res[-1] if res else None
+        if prev is None or prev.RightToLeft != sub.RightToLeft:
+            res.append(sub)
+            continue
+        dynamic = (DynamicWordNode, DynamicWordSetNode)
+        if type(prev) in dynamic and type(sub) in dynamic:
+            prev_list = prev.word_list if type(prev) == DynamicWordSetNode else [prev]
+            sub_list = sub.word_list if type(sub) == DynamicWordSetNode else [sub]
+            res[-1] = DynamicWordSetNode(
+                word_list=prev_list + sub_list, fa=node, RightToLeft=sub.RightToLeft
+            )
+            continue
+        res.append(sub)
+    return res
+
+
+def optimize_alternate(node: AlternateNode) -> Node:
+    node.subs = factor_branches(node)
+    node.subs = factor_branches(node, suffix=True)
+    node.subs = fold_leaves(node)
+    if len(node.subs) == 1:
+        node.subs[0].fa = node.fa
+        return node.subs[0]
+    return node
+
+
+# simplify_node之后的树优化，子树先于父节点处理
+def optimize_node(node: Node) -> Node:
+    if hasattr(node, "subs") and node.subs is not None:
+        for ind, sub in enumerate(node.subs):
+            node.subs[ind] = optimize_node(sub)
+            node.subs[ind].fa = node
+        if type(node) == AlternateNode:
+            return optimize_alternate(node)
+    elif hasattr(node, "sub") and node.sub is not None:
+        node.sub = optimize_node(node.sub)
+        node.sub.fa = node
+    return node
+
+
+# 没有上限时的最大词数，与量词的INT_MAX相同
+UNBOUNDED = sys.maxsize
+
+
+# 节点的匹配至少、至多消耗的词数，没有上限时最大值为UNBOUNDED
+# 多词的Word每个词至少一个字，最多消耗len(shape)个词
+def length_bounds(node: Node) -> Tuple[int, int]:
+    if isinstance(node, ConcatenateNode):
+        lo, hi = 0, 0
+        for sub in node.subs:
+            sub_lo, sub_hi = length_bounds(sub)
+            lo += sub_lo
+            hi = min(hi + sub_hi, UNBOUNDED)
+        return lo, hi
+    elif isinstance(node, AlternateNode):
+        bounds = [length_bounds(sub) for sub in node.subs]
+        if not bounds:
+            return 0, 0
+        return min(b[0] for b in bounds), max(b[1] for b in bounds)
+    elif isinstance(node, CaptureNode):
+        return length_bounds(node.sub)
+    elif isinstance(node, RepeatNode):
+        sub_lo, sub_hi = length_bounds(node.sub)
+        lo = sub_lo * max(node.min, 0)
+        if node.max == 0 or sub_hi == 0:
+            return lo, 0
+        if node.max >= UNBOUNDED or sub_hi >= UNBOUNDED:
+            return lo, UNBOUNDED
+        return lo, min(sub_hi * node.max, UNBOUNDED)
+    elif isinstance(node, ConditionNode):
+        return 0, 0
+    elif isinstance(node, WordNode):
+        if node.shape == "":
+            return 0, 0
+        return 1, len(node.shape)
+    elif isinstance(node, WordSetNode):
+        if not node.word_list:
+            return 0, 0
+        lo = min(1 if wn.shape != "" else 0 for wn in node.word_list)
+        return lo, max(len(wn.shape) for wn in node.word_list)
+    elif isinstance(node, (DynamicWordNode, DynamicWordSetNode, AnyNode)):
+        return 1, 1
+    elif isinstance(node, (PositionNode, EmptyNode)):
+        return 0, 0
+    # 反向引用与引用的分组等长，分组长度未知
+    return 0, UNBOUNDED
+
+
+# 树中是否有循环体可以不消耗词的循环，至多一次的?不算循环
+# 回溯虚拟机接受一次空迭代，同一(指令,位置)再次进入时直接失败的执行方式会丢掉这次迭代
+def has_empty_loop(node: Node) -> bool:
+    if isinstance(node, RepeatNode) and node.max > 1 and length_bounds(node.sub)[0] == 0:
+        return True
+    if hasattr(node, "subs") and node.subs is not None:
+        return any(has_empty_loop(sub) for sub in node.subs)
+    if hasattr(node, "sub") and node.sub is not None:
+        return has_empty_loop(node.sub)
+    return False
+
+
+# 展开后的副本数上限
+UNROLL_LIMIT = 1000
+
+
+# 回溯虚拟机上展开比计数循环更快的{m,n}：副本数乘以循环体节点数的上限
+SMALL_UNROLL_SIZE = 64
+
+
+def node_count(node: Node) -> int:
+    count = 1
+    if hasattr(node, "subs") and node.subs is not None:
+        count += sum(node_count(sub) for sub in node.subs)
+    if hasattr(node, "sub") and node.sub is not None:
+        count += node_count(node.sub)
+    return count
+
+
+# 有上界、展开后不大、循环体至少消耗一个词且不是单个词的{m,n}
+# 单个词的循环由SetLoop执行，循环体可以不消耗词时由RepeatCheck在空迭代后退出
+def is_small_repeat(node: RepeatNode) -> bool:
+    return (
+        node.max != UNBOUNDED
+        and node.max * node_count(node.sub) <= SMALL_UNROLL_SIZE
+        and length_bounds(node.sub)[0] > 0
+        and not isinstance(node.sub, (AnyNode, DynamicWordNode, DynamicWordSetNode))
+    )
+
+
+# 复制一棵树，把*、+、?以外的{m,n}展开为m个副本加嵌套的可选副本：
+# X{2,4} => XX(?:X(?:X)?)?，X{2,} => XXX*，超出UNROLL_LIMIT时返回None
+# small=True时只展开is_small_repeat的{m,n}，其余留给计数循环指令
+def unroll_repeats(node: Node, fa: Node = None, small=False) -> Optional[Node]:
+    if isinstance(node, RepeatNode):
+        m, n = node.min, node.max
+        if (m, n) in ((0, UNBOUNDED), (1, UNBOUNDED), (0, 1)) or (
+            small and not is_small_repeat(node)
+        ):
+            res = replace(node, fa=fa)
+            res.sub = unroll_repeats(node.sub, res, small)
+            return res if res.sub is not None else None
+        if m > UNROLL_LIMIT or (n != UNBOUNDED and n > UNROLL_LIMIT):
+            print(f"repeat {{{m},{n}}} is too large to unroll")
+            return None
+        res = ConcatenateNode(subs=[], fa=fa, RightToLeft=node.RightToLeft)
+        for _ in range(m):
+            res.subs.append(unroll_repeats(node.sub, res, small))
+        if n == UNBOUNDED:
+            tail = RepeatNode(
+                sub=None, _min=0, _max=UNBOUNDED, is_nongreedy=node.is_nongreedy,
+                fa=res, RightToLeft=node.RightToLeft,
+            )
+            tail.sub = unroll_repeats(node.sub, tail, small)
+            res.subs.append(tail)
+        elif n > m:
+            # 从最内层向外构造 (?:X(?:X)?)?
+            opt = None
+            for _ in range(n - m):
+                body = ConcatenateNode(subs=[], RightToLeft=node.RightToLeft)
+                body.subs.append(unroll_repeats(node.sub, body, small))
+                if opt is not None:
+                    opt.fa = body
+                    body.subs.append(opt)
+                opt = RepeatNode(
+                    sub=body, _min=0, _max=1, is_nongreedy=node.is_nongreedy,
+                    RightToLeft=node.RightToLeft,
+                )
+                body.fa = opt
+            opt.fa = res
+            res.subs.append(opt)
+        if any(sub is None for sub in res.subs):
+            return None
+        if not res.subs:
+            return EmptyNode(fa=fa, RightToLeft=node.RightToLeft)
+        return res
+    res = replace(node, fa=fa)
+    if hasattr(node, "subs") and node.subs is not None:
+        res.subs = [unroll_repeats(sub, res, small) for sub in node.subs]
+        if any(sub is None for sub in res.subs):
+            return None
+    if hasattr(node, "sub") and node.sub is not None:
+        res.sub = unroll_repeats(node.sub, res, small)
+        if res.sub is None:
+            return None
+    if hasattr(node, "word_list") and node.word_list is not None:
+        res.word_list = list(node.word_list)
+    return res
+
+
 def reverse_subnode(node: Node):
     if hasattr(node, "subs"):
         node.subs.reverse()
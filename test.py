@@ -1,10 +1,26 @@
 # Create your tests here.
+import contextlib
+import io
+import random
+import warnings
 from compile import (
     find_word_string,
     find_all_word_string,
     find_word_string_r,
     compile_regex,
+    compile_cache_info,
+    compile_cache_clear,
+    set_compile_cache_size,
+    BudgetExhausted,
+    EngineWarning,
 )
+from runner import MatchState, is_dynamic_word_match
+from pikevm import PikeRunner
+from syntax.code import CodeType
+from syntax.tree import DynamicWordNode
+import sentence as sentence_module
+import program as program_module
+from sentence import EncodedSentence, WordPredicate, evaluate_predicates
 
 word_lst1 = [{"shape": "发展", "semantic": "dev"}, {"shape": "建设", "semantic": "dev"}]
 word_lst2 = [
@@ -42,3 +58,490 @@ runner, ok = compile_regex("(?<pred>v)(n)")
 res, ok = find_word_string_r(runner, word_lst2)
 if ok:
     print("test4: ", res)
+
+# 断言体以循环结尾时，循环的出口要跳到断言之后，而不是回到SetJump
+for pattern in ["(?<=(v)*)v", "(?=(n)*?)a"]:
+    for engine in ["backtrack", "pike", "dfa"]:
+        runner, ok = compile_regex(pattern, engine=engine)
+        res = [m.spandict() for m in runner.finditer(word_lst2)]
+        print("test5: ", pattern, engine, res)
+
+# 编译缓存：相同的正则命中缓存，超出容量时淘汰最久未用的
+compile_cache_clear()
+set_compile_cache_size(2)
+r1, ok = compile_regex("v")
+r2, ok = compile_regex("v")
+assert r1 is r2
+compile_regex("n")
+compile_regex("a")  # 淘汰"v"
+r3, ok = compile_regex("v")
+assert r3 is not r1
+info = compile_cache_info()
+assert (info.hits, info.misses, info.currsize) == (1, 4, 2)
+print("test6: ", info)
+set_compile_cache_size(512)
+
+# search从指定位置开始找最左侧的匹配
+runner, ok = compile_regex("(?<pred>v)(n)")
+m = runner.search(word_lst2, 3)
+assert m.span() == (4, 6)
+print("test7: ", m)
+
+# finditer默认结果互不重叠，overlapped=True时每个起点各取一个结果
+runner, ok = compile_regex("d+")
+res = [m.span() for m in runner.finditer(word_lst2)]
+assert res == [(7, 8), (10, 12)]
+res = [m.span() for m in runner.finditer(word_lst2, overlapped=True)]
+assert res == [(7, 8), (10, 12), (11, 12)]
+# 空匹配之后向后移动一位
+runner, ok = compile_regex("d*")
+res = [m.span() for m in runner.finditer(word_lst2)]
+assert res[6:10] == [(6, 6), (7, 8), (8, 8), (9, 9)]
+print("test8: ", res)
+
+# Match按分组名或序号访问，view不复制词对象
+runner, ok = compile_regex("(?<pred>[va])(n)?")
+m = runner.search(word_lst2)
+assert m.span("pred") == m.span(1) == (2, 3)
+assert m.group(2) == m["<2>"] == [word_lst2[3]]
+assert m.view("pred").to_list() == m.group("pred")
+assert list(m.view(0)) == word_lst2[2:4]
+m = runner.search(word_lst2, 5)
+assert m.span(2) == (-1, -1) and m.group(2) is None
+print("test9: ", m, m.groupdict())
+
+# 各执行引擎与回溯虚拟机的结果一致
+patterns = [
+    "(?<haha>v)n",
+    "(?<pred>v)(n)",
+    "[va]+n",
+    "(?:d|a)+u",
+    "(?<x>n).*?的",
+    "d*",
+    "发展历史",
+    "[#发展|中国|历史]+",
+    "(?<=n)v",
+    "n(?!v)",
+    "a.*?w$",
+]
+for pattern in patterns:
+    runner, ok = compile_regex(pattern)
+    expected = [m.spandict() for m in runner.finditer(word_lst2)]
+    for options in [
+        {"engine": "pike"},
+        {"engine": "dfa"},
+        {"memoize": True},
+        {"engine": "dfa", "memoize": True},
+        {"engine": "codegen"},
+        {"engine": "codegen", "memoize": True},
+    ]:
+        runner, ok = compile_regex(pattern, **options)
+        res = [m.spandict() for m in runner.finditer(word_lst2)]
+        assert res == expected, (pattern, options, res, expected)
+    print("test10: ", pattern, expected)
+
+# 断言之后回溯的模式：断言的记录和断言体内的分组捕获不能残留到其它分支
+for pattern in [
+    "v(?=n)d|",
+    "(?=(?<y>n))nd|n",
+    "(?<=(?<y>v))n[ad]|n",
+    "(?=(?<y>n)(?=(?<z>v)))nd|n",
+    "(?:(?<x>[vn]))+n",
+]:
+    runner, ok = compile_regex(pattern)
+    expected = [m.spandict() for m in runner.finditer(word_lst2)]
+    for engine in ["pike", "dfa", "codegen"]:
+        runner, ok = compile_regex(pattern, engine=engine)
+        assert [m.spandict() for m in runner.finditer(word_lst2)] == expected, pattern
+assert expected == [{"x": [4, 5], "<global>": [2, 6]}]
+
+
+# 随机生成的模式，包含循环体可以不消耗词的循环和零宽断言
+def random_pattern(rng, depth):
+    k = rng.randrange(7) if depth > 0 else 0
+    if k == 0:
+        return rng.choice(["v", "n", "d", "a", ".", "[va]", "发展", "[#中国|历史]", "$", "^"])
+    sub = random_pattern(rng, depth - 1)
+    if k == 1:
+        return sub + random_pattern(rng, depth - 1)
+    if k == 2:
+        return f"(?:{sub}|{random_pattern(rng, depth - 1)})"
+    if k == 3:
+        quantifier = rng.choice(["*", "+", "?", "*?", "+?", "{1,2}"])
+        return f"(?:{sub}){quantifier}"
+    if k == 4:
+        return f"(?{rng.choice(['=', '!', '<=', '<!'])}{sub})"
+    if k == 5:
+        return f"(?<g>{sub})"
+    return f"(?:{sub})"
+
+
+# 循环体可以不消耗词时，各引擎都与回溯虚拟机相同，接受空迭代及其捕获后退出循环
+rng = random.Random(0)
+for _ in range(500):
+    pattern = random_pattern(rng, 3)
+    runner, ok = compile_regex(pattern)
+    expected = [m.spandict() for m in runner.finditer(word_lst2)]
+    for engine in ["pike", "auto", "dfa", "codegen"]:
+        runner, ok = compile_regex(pattern, engine=engine)
+        res = [m.spandict() for m in runner.finditer(word_lst2)]
+        assert res == expected, (pattern, engine, res, expected)
+for engine in ["backtrack", "pike"]:
+    runner, ok = compile_regex("(?:(?=v)|v)+", engine=engine)
+    assert runner.search(word_lst2, 2).span() == (2, 2)
+    runner, ok = compile_regex("(?:^|v)+", engine=engine)
+    assert runner.search(word_lst2).spandict() == {"<global>": [0, 0]}
+# auto在这样的循环和零宽断言上仍使用Pike VM
+for pattern in ["(a*)*n", "(?:(?<g0>(?!n)))*", "(?:(?:a|^)|(n))+", "(?:^|v)+"]:
+    runner, ok = compile_regex(pattern)
+    expected = [m.spandict() for m in runner.finditer(word_lst2)]
+    runner, ok = compile_regex(pattern, engine="auto")
+    assert isinstance(runner, PikeRunner), pattern
+    res = [m.spandict() for m in runner.finditer(word_lst2)]
+    assert res == expected, (pattern, res, expected)
+runner, ok = compile_regex("(a*)*n", engine="auto")
+assert runner.search(word_lst2).spandict() == {"<1>": [3, 3], "<global>": [3, 4]}
+runner, ok = compile_regex("(?:(?<g0>(?!n)))*", engine="auto")
+assert runner.search(word_lst2).spandict() == {"g0": [0, 0], "<global>": [0, 0]}
+# 反向引用不能在Pike VM上执行，auto发出EngineWarning后使用回溯虚拟机
+with warnings.catch_warnings(record=True) as caught:
+    warnings.simplefilter("always")
+    runner, ok = compile_regex("(v)n\\1", engine="auto", use_cache=False)
+assert not isinstance(runner, PikeRunner)
+assert [w.category for w in caught] == [EngineWarning]
+print("test10: ", pattern)
+
+# 嵌套在循环中的分支，不记忆化时回溯次数随句子长度指数增长
+word_lst3 = [{"shape": "重要", "pos": "a"}] * 200 + [{"shape": "是", "pos": "v"}]
+runner, ok = compile_regex("(?:a|a|aa)*n", memoize=True)
+assert runner.search(word_lst3) is None
+runner, ok = compile_regex("(?:a|a|aa)*v", memoize=True)
+m = runner.search(word_lst3)
+assert m.span() == (0, 201)
+# 不支持记忆化的正则发出EngineWarning，runner.memoize为False，按计数循环回溯
+with warnings.catch_warnings(record=True) as caught:
+    warnings.simplefilter("always")
+    for engine in ["backtrack", "dfa", "backtrack"]:
+        runner, ok = compile_regex(
+            "(?:(?=v))*n", use_cache=False, engine=engine, memoize=True
+        )
+        assert not runner.memoize
+        assert runner.search(word_lst2).span() == (3, 4)
+assert [w.category for w in caught] == [EngineWarning] * 3
+assert "memoize does not support" in str(caught[0].message)
+# 循环体可以不消耗词时空迭代会回到同一(Alt,位置)，同样不记忆化，结果和捕获与回溯虚拟机相同
+word_lst12 = [word_lst2[2], word_lst2[8], word_lst2[8], word_lst2[3], word_lst2[3]]
+with warnings.catch_warnings(record=True) as caught:
+    warnings.simplefilter("always")
+    for pattern in ["(a*)*n", "(?:(?:a|^)|(n))+"]:
+        runner, ok = compile_regex(pattern)
+        expected = [m.spandict() for m in runner.finditer(word_lst12[3:] + word_lst12)]
+        for engine in ["backtrack", "dfa", "codegen"]:
+            runner, ok = compile_regex(pattern, engine=engine, memoize=True)
+            assert not runner.memoize
+            res = [m.spandict() for m in runner.finditer(word_lst12[3:] + word_lst12)]
+            assert res == expected, (pattern, engine, res)
+assert [w.category for w in caught] == [EngineWarning] * 6
+assert expected[0] == {"<global>": [0, 0]}
+runner, ok = compile_regex("(a*)*n", memoize=True)
+assert runner.search(word_lst12).spandict() == {"<1>": [3, 3], "<global>": [1, 4]}
+print("test11: ", m)
+
+# 执行预算用尽时抛出BudgetExhausted，带上已执行的步数
+# 句末的n使句子满足必要条件，不会在执行前被排除
+runner, ok = compile_regex("(?:a|a|aa)*n")
+try:
+    runner.search(word_lst3[:30] + [word_lst2[1], word_lst2[3]], max_steps=10000)
+    assert False
+except BudgetExhausted as e:
+    assert e.reason == "steps" and e.steps >= 10000
+    print("test12: ", e)
+# DFA的每次转移计入执行步数，扫描长句时同样受预算限制
+runner, ok = compile_regex("n.*?d", engine="dfa")
+long_lst = word_lst3[:200] + [word_lst2[3], word_lst2[7]]
+assert runner.search(long_lst, max_steps=1000).span() == (200, 202)
+try:
+    runner.search(long_lst, max_steps=100)
+    assert False
+except BudgetExhausted as e:
+    assert e.reason == "steps"
+
+# DEBUG模式由TracingRunner逐条打印指令，匹配结果与不打印时相同
+runner, ok = compile_regex("(?<pred>[va])(n)?")
+with contextlib.redirect_stdout(io.StringIO()) as trace:
+    m = runner.search(word_lst2, 3, DEBUG=True)
+assert m.spandict() == runner.search(word_lst2, 3).spandict()
+assert "code_type:CaptureMark" in trace.getvalue()
+print("test13: ", m)
+
+# 执行时使用紧凑程序，相同的动态词谓词只保存一份
+runner, ok = compile_regex("(?<x>v)n(?:v|a)+")
+prog = runner.program
+assert len(prog) == len(runner.codes) and len(prog.preds) == 3
+assert prog.param[2] == 1  # 分组x的SetMark
+print("test14: ", len(prog), prog.preds)
+
+# 回溯栈和参数栈只保存整数记录，断言结束后截断回SetJump时的长度
+runner, ok = compile_regex("(?<pred>[va])(?=n)(n)")
+st = MatchState()
+m = runner.search(word_lst2, state=st)
+assert m.spandict() == {"pred": [2, 3], "<2>": [3, 4], "<global>": [2, 4]}
+assert st.paramStack == [] and all(type(x) is int for x in st.trackStack)
+print("test15: ", st.trackStack)
+
+# 预先编码的句子可直接作为输入，动态词谓词在编码列上判断
+sentence = EncodedSentence(word_lst2)
+for options in [{}, {"engine": "pike"}, {"engine": "codegen"}]:
+    runner, ok = compile_regex("(?<x>[va])n|^a", **options)
+    res = [m.spandict() for m in runner.finditer(sentence)]
+    assert res == [m.spandict() for m in runner.finditer(word_lst2)]
+assert sentence.posMasks[2] & sentence.features.pos_bit("v")
+# 特征表超出上限后换用新表，用旧表编码的句子仍按旧表判断
+table_size = sentence_module.FEATURE_TABLE_SIZE
+sentence_module.FEATURE_TABLE_SIZE = 50
+old_table = sentence.features
+for k in range(100):
+    EncodedSentence([{"shape": "词", "pos": "n", "semantic": f"s{k}"}])
+sentences = [sentence, EncodedSentence(word_lst2)]
+assert sentences[1].features is not old_table
+assert sentences[1].features.size() <= 50 + 3
+runner, ok = compile_regex("(?<x>[va])n")
+runner.prepare(sentences)
+assert [m.spandict() for m in runner.finditer(sentences[1])] == res
+assert [m.spandict() for m in runner.finditer(sentence)] == res
+sentence_module.FEATURE_TABLE_SIZE = table_size
+# 逐个起点调用run时先用prepare编码一次，之后每次调用直接使用编码后的句子
+# 传入词列表时每次调用各自编码，调用之间原地修改的词不会读到旧的编码
+word_lst11 = word_lst2 * 50
+encode_count = [0]
+encode_init = EncodedSentence.__init__
+
+
+def counting_init(self, words):
+    encode_count[0] += 1
+    encode_init(self, words)
+
+
+EncodedSentence.__init__ = counting_init
+try:
+    for options in [{}, {"engine": "pike"}, {"engine": "dfa"}, {"engine": "codegen"}]:
+        runner, ok = compile_regex("(?<x>[va])n", **options)
+        encode_count[0] = 0
+        (sentence11,) = runner.prepare([word_lst11])
+        res = [runner.run(sentence11, i) for i in range(len(word_lst11))]
+        assert encode_count[0] == 1, options
+        assert res[2] == {"x": [2, 3], "<global>": [2, 4]} and res[3] is None
+        buf = word_lst2[2:4]
+        assert runner.run(buf, 0) is not None
+        buf[1] = {"shape": "很", "pos": "d"}
+        assert runner.run(buf, 0) is None, options
+finally:
+    EncodedSentence.__init__ = encode_init
+print("test16: ", res[:5])
+
+# 谓词在执行前对整个句子一次算出，执行时只查位；一批句子可以一起预先计算
+runner, ok = compile_regex("(?<x>[va])n")
+sentences = runner.prepare([word_lst2, word_lst2[2:]])
+pred_bits, set_bits = runner.program.pred_bits(sentences[0])
+assert list(set_bits[0][:6]) == [0, 0, 1, 0, 1, 0]
+assert [m.span() for m in runner.finditer(sentences[1])] == [(0, 2), (2, 4)]
+print("test17: ", [list(bits) for bits in pred_bits])
+
+# 谓词取值的纯Python实现与NumPy实现都与is_dynamic_word_match一致，没有NumPy时只检查前者
+word_lst10 = [
+    {"shape": "发展", "pos": "vn", "pos2": "v①n②", "struct": "VO", "semantic": "dev"},
+    {"shape": "历史", "pos": "n", "pos2": "n③", "semantic": "time abs"},
+    {"shape": "建设", "pos": "v", "struct": "VV"},
+]
+preds = [
+    WordPredicate(DynamicWordNode(**params))
+    for params in [
+        {"pos": "v"},
+        {"pos": "vn"},
+        {"pos": "n", "pos2": "②"},
+        {"pos": "v", "pos2": "①n"},
+        {"pos": "n", "length": 2},
+        {"word_struct": "VO"},
+        {"semantic_tag": "abs"},
+        {"pos": "v", "semantic_tag": "dev", "length": 2},
+    ]
+]
+encs = [EncodedSentence(word_lst2), EncodedSentence(word_lst10), EncodedSentence([])]
+expected = [
+    [bytearray(is_dynamic_word_match(p.node, w) for w in enc.words) for p in preds]
+    for enc in encs
+]
+numpy_module = sentence_module.np
+sentence_module.np = None
+try:
+    assert evaluate_predicates(preds, encs) == expected
+finally:
+    sentence_module.np = numpy_module
+if numpy_module is not None:
+    assert evaluate_predicates(preds, encs) == expected
+# 特征表中的词性字母、词性子类超过63个后，新谓词的位放不进int64，该谓词逐词计算
+features = encs[0].features
+for k in range(64):
+    features.pos_bit(chr(0x2500 + k))
+    features.pos2_bit("x" + chr(0x2500 + k))
+preds += [
+    WordPredicate(DynamicWordNode(**params))
+    for params in [{"pos": "z"}, {"pos": "v", "pos2": "⑨"}, {"pos": "n", "pos2": "③"}]
+]
+assert preds[-3].bind(features).posBit >> 63 and preds[-2].bind(features).pos2Bit >> 63
+expected = [
+    [bytearray(is_dynamic_word_match(p.node, w) for w in enc.words) for p in preds]
+    for enc in encs
+]
+sentence_module.np = None
+try:
+    assert evaluate_predicates(preds, encs) == expected
+finally:
+    sentence_module.np = numpy_module
+assert evaluate_predicates(preds, encs) == expected
+runner, ok = compile_regex("v⑨|n③")
+assert [m.span() for m in runner.finditer(word_lst10)] == [(1, 2)]
+# 谓词取值保存在预先编码的句子上，逐个起点调用run时整句只计算一次
+evaluate_count = [0]
+evaluate_func = program_module.evaluate_predicates
+
+
+def counting_evaluate(preds, sentences):
+    evaluate_count[0] += 1
+    return evaluate_func(preds, sentences)
+
+
+program_module.evaluate_predicates = counting_evaluate
+try:
+    runner, ok = compile_regex("(?<x>[va])(?:n|d)")
+    (sentence11,) = runner.prepare([word_lst11])
+    res = [runner.run(sentence11, i) for i in range(len(word_lst11))]
+    assert evaluate_count[0] == 1
+finally:
+    program_module.evaluate_predicates = evaluate_func
+print("test17: ", numpy_module is not None, [list(bits) for bits in expected[1]])
+
+# 词形集合编译为字符trie，默认列表中靠前的词形胜出，可选消耗词数最多的词形
+word_lst4 = [{"shape": "发展", "pos": "v"}, {"shape": "历史", "pos": "n"}]
+runner, ok = compile_regex("(?<x>[#发展|发展历史])")
+assert runner.search(word_lst4).spandict()["x"] == [0, 1]
+runner, ok = compile_regex("(?<x>[#发展|发展历史])", longest_wordset=True)
+m = runner.search(word_lst4)
+assert m.spandict()["x"] == [0, 2]
+print("test18: ", m)
+
+# 匹配开头全是词形字面量时，先用Aho-Corasick扫描整句词形，只在可能的起点上执行
+runner, ok = compile_regex("[#中国发展|重要]")
+assert runner.literalScanner.literals == ["中国发展", "重要"]
+starts = runner.candidate_starts(EncodedSentence(word_lst2))
+assert [i for i, b in enumerate(starts) if b] == [3, 8]
+m = runner.search(word_lst2)
+assert m.span() == (3, 5)
+print("test19: ", m)
+
+# 由语法树得到必要条件的合取范式，句子不满足时不执行虚拟机
+runner, ok = compile_regex("(?:发展|历史)(?=n)[va]{2}")
+assert runner.featureFilter.minTokens == 3
+assert not runner.may_match(word_lst4)
+assert runner.may_match(word_lst2)
+print("test20: ", runner.featureFilter.clauses)
+
+# FIRST集：越过SetMark和零宽断言，起点的词必须能被第一个叶指令消耗
+runner, ok = compile_regex("(?<=v)(?<x>n|[#中国])a?")
+assert runner.literalScanner is None
+starts = runner.candidate_starts(EncodedSentence(word_lst2))
+assert [i for i, b in enumerate(starts) if b] == [3, 5]
+assert [m.span() for m in runner.finditer(word_lst2)] == [(3, 4), (5, 6)]
+print("test21: ", runner.firstSet.predIds, sorted(runner.firstSet.prefixes))
+
+# 匹配长度的上下界：离句末不足最少词数的起点不再尝试，肯定逆序断言左侧的词不够时直接失败
+runner, ok = compile_regex("(?<=[#中国发展]v)nn+")
+assert runner.minLength == 2
+assert runner.program.param[4] == 2  # SetJump
+assert runner.search(word_lst2[:6], 4) is None
+print("test22: ", runner.search(word_lst2[:2]), runner.search([word_lst2[3]] * 2))
+
+# {m,n}编译为计数循环，指令数与上下界无关；Pike VM使用在树上展开的指令，结果相同
+word_lst5 = [word_lst2[2], word_lst2[3]] * 4
+runner, ok = compile_regex("(?:vn){2,50}")
+assert len(runner.codes) < 12 and runner.program.loops == [(2, 50)]
+assert runner.search(word_lst5).span() == (0, 8)
+runner, ok = compile_regex("(?:vn){2,50}?")
+assert runner.search(word_lst5).span() == (0, 4)
+# 较小的{m,n}在树上展开，不生成计数循环
+runner, ok = compile_regex("(?:v(n)){2,3}")
+assert runner.program.loops == []
+assert runner.search(word_lst5).spandict() == {"<1>": [5, 6], "<global>": [0, 6]}
+runner, ok = compile_regex("(?:vn){2,3}?")
+assert runner.program.loops == [] and runner.search(word_lst5).span() == (0, 4)
+for options in [{}, {"engine": "pike"}, {"engine": "codegen"}, {"memoize": True}]:
+    runner, ok = compile_regex("(?<x>vn){1,}?(?:v|a)n{2}", **options)
+    assert [m.spandict() for m in runner.finditer(word_lst5 + [word_lst2[3]])] == [
+        {"x": [4, 6], "<global>": [0, 9]}
+    ]
+runner, ok = compile_regex("n{3,5000}")
+assert ok and len(runner.codes) < 8
+assert runner.search(word_lst5) is None
+# 循环体为断言、循环在断言内时，回溯不能破坏paramStack上的计数记录
+word_lst9 = [{"shape": "国", "pos": "d"}, word_lst2[2], word_lst2[3], word_lst2[4]]
+for options in [{}, {"engine": "pike"}, {"engine": "codegen"}]:
+    runner, ok = compile_regex("(?<!国(?!a){2})", **options)
+    assert [m.span() for m in runner.finditer(word_lst9)] == [(0, 0), (2, 2), (3, 3)]
+    for pattern in ["(?<!d(?!a){2})v", "(?<!d(?!a)(?!a))v"]:
+        runner, ok = compile_regex(pattern, **options)
+        assert [m.span() for m in runner.finditer(word_lst9)] == [(3, 4)], pattern
+print("test23: ", runner.program.loops)
+
+# 单个词的循环生成SetLoop，连续的一段词只占一个回溯帧，回溯时每次退回或延长一个词
+word_lst6 = [word_lst2[2]] * 300 + [word_lst2[3], word_lst2[2]]
+runner, ok = compile_regex("v+n")
+st = MatchState()
+assert runner.search(word_lst6, state=st).span() == (0, 301)
+assert len(st.trackStack) <= 12  # 0号Alt、SetMark、SetLoop、CaptureMark各一帧
+for options in [{}, {"engine": "codegen"}, {"engine": "pike"}]:
+    runner, ok = compile_regex("(?<x>.*)v", **options)
+    assert runner.search(word_lst6).spandict()["x"] == [0, 301]
+    runner, ok = compile_regex("(?<x>v{2,}?)[nv]{2}", **options)
+    assert runner.search(word_lst6, 298).spandict()["x"] == [298, 300]
+    runner, ok = compile_regex("(?<=n.*?)v", **options)
+    assert runner.search(word_lst6).span() == (301, 302)
+runner, ok = compile_regex("(?<=n.*?)v")
+print("test24: ", runner.program.runs)
+
+# 循环之后是字面量或谓词时，SetLoop直接跳到之后的指令可能匹配的位置，不逐个尝试中间的位置
+word_lst7 = [word_lst2[3]] + [word_lst2[2]] * 300 + [word_lst2[4], word_lst2[2]]
+for pattern in ["(?<a>n).*?发展", "(?<a>n).*发展", "(?<a>n)v*?[#发展|历史]"]:
+    runner, ok = compile_regex(pattern)
+    st = MatchState()
+    assert runner.search(word_lst7, state=st).spandict()["<global>"] == [0, 302]
+    assert st.steps < 20
+print("test25: ", runner.loopGuides)
+
+# 窥孔优化：连续的Any合并为一条SetLoop，嵌套的Alt展开，否定断言内的分组不出现在结果中
+runner, ok = compile_regex("n...(?:vn|a|nv)")
+assert [code.t for code in runner.codes[2:4]] == [CodeType.DynamicWord, CodeType.SetLoop]
+assert len(runner.codes[4].arg) == 3
+for options in [{}, {"engine": "codegen"}, {"engine": "pike"}, {"memoize": True}]:
+    runner, ok = compile_regex(".*?v(?!(?<b>n))", **options)
+    assert runner.search(word_lst5 + [word_lst2[2]]).spandict() == {"<global>": [0, 9]}
+print("test26: ", len(runner.codes))
+
+# Alternate的优化：提出公共前缀后单个词的分支合并为DynamicWordSet
+# Word分支保持原样，句末的Word仍可以只匹配词形的前缀
+runner, ok = compile_regex("历史|发展|中国")
+assert [code.t for code in runner.codes].count(CodeType.WordSet) == 0
+assert [m.span() for m in runner.finditer(word_lst7)] == [(0, 1), (301, 302)]
+word_lst8 = [{"shape": "是", "pos": "v"}, {"shape": "中", "pos": "n"}]
+for pattern in ["中国", "中国|d", "中国|美国", "(?:中国)|(?:美国)", "v中国|v美国"]:
+    runner, ok = compile_regex(pattern)
+    assert runner.search(word_lst8).span()[1] == 2, pattern
+runner, ok = compile_regex("|".join(f"v{q}" for q in "nadw") + "|发展|发")
+assert len(runner.codes) < 12
+for options in [{}, {"engine": "pike"}, {"engine": "dfa"}]:
+    runner, ok = compile_regex("(?<x>v|vn)n|v发展|v", **options)
+    matches = runner.finditer(word_lst7[:1] + word_lst7[-3:])
+    assert [m.span() for m in matches] == [(1, 3), (3, 4)]
+    # 以循环开头的分支，前一个分支的出口不能被当作循环的前驱
+    runner, ok = compile_regex("(?:a|(?:xy)*n)v", **options)
+    assert runner.search(word_lst7).span() == (0, 2)
+print("test27: ", len(runner.codes))